@@ -3,8 +3,11 @@ Module for adjusting classification results to classify labels as dogs or not do
 This module reads dog names from a file and updates results with dog classifications.
 """
 
+from classifier import get_imagenet_classes
+from dog_name_index import DogNameIndex
 
-def adjust_results4_isadog(results_dic, dogfile):
+
+def adjust_results4_isadog(results_dic, dogfile, class_ids=None):
     """
     Adjusts results_dic to include whether pet and classifier labels are dogs.
     
@@ -12,9 +15,15 @@ def adjust_results4_isadog(results_dic, dogfile):
     - pet_is_dog: 1 if pet label is in dog names, 0 otherwise
     - classifier_is_dog: 1 if any dog name appears in classifier label, 0 otherwise
     
+    When the predicted ImageNet class ids are given, classifier_is_dog is
+    looked up for all images at once from a table of which classes are dogs
+    instead of scanning each classifier label.
+    
     Args:
         results_dic (dict): Dictionary with results from classification
         dogfile (str): Path to text file containing dog names (one per line)
+        class_ids (dict): Top-1 ImageNet class id per filename, as returned by
+                          classify_images (default: None)
     
     Returns:
         None (modifies results_dic in place)
@@ -24,16 +33,19 @@ def adjust_results4_isadog(results_dic, dogfile):
         Updates each results_dic[filename] to include two new values:
         [pet_label, classifier_label, match, pet_is_dog, classifier_is_dog]
     """
-    # Create dictionary of dog names from dogfile
-    dognames_dic = {}
+    # Get the precompiled dog name index for dogfile (built once per process)
+    dog_index = DogNameIndex.from_file(dogfile)
+    
+    for dog_name in dog_index.duplicates:
+        print(f"Warning: Dog name '{dog_name}' appears more than once in {dogfile}")
     
-    # Read dogfile and populate dognames_dic
-    with open(dogfile, 'r') as f:
-        for line in f:
-            dog_name = line.rstrip()
-            if dog_name in dognames_dic:
-                print(f"Warning: Dog name '{dog_name}' appears more than once in {dogfile}")
-            dognames_dic[dog_name] = 1
+    # Classify every predicted class id as dog or not dog in one lookup
+    classifier_is_dog_by_file = {}
+    if class_ids:
+        filenames = [filename for filename in results_dic if filename in class_ids]
+        is_dog = dog_index.classes_are_dogs([class_ids[filename] for filename in filenames],
+                                            get_imagenet_classes())
+        classifier_is_dog_by_file = dict(zip(filenames, is_dog.tolist()))
     
     # Adjust results_dic for each image
     for filename in results_dic:
@@ -42,14 +54,12 @@ def adjust_results4_isadog(results_dic, dogfile):
         classifier_label = results_dic[filename][1]
         
         # Determine if pet label is a dog
-        pet_is_dog = 1 if pet_label in dognames_dic else 0
+        pet_is_dog = dog_index.is_dog(pet_label)
         
         # Determine if classifier label contains any dog name
-        classifier_is_dog = 0
-        for dog_name in dognames_dic:
-            if dog_name in classifier_label:
-                classifier_is_dog = 1
-                break
+        classifier_is_dog = classifier_is_dog_by_file.get(filename)
+        if classifier_is_dog is None:
+            classifier_is_dog = dog_index.contains_dog_name(classifier_label)
         
         # Append both values to results_dic[filename]
         results_dic[filename].extend([pet_is_dog, classifier_is_dog])
@@ -0,0 +1,138 @@
+"""
+Benchmark of the confidence-gated cascade's throughput / accuracy trade-off.
+This module classifies a folder once with every architecture of a cascade,
+timing each one, then replays the cascade decision for a range of
+thresholds. For each threshold it reports the escalation rate, the expected
+time per image (every image pays for the first model, escalated images also
+for the next ones), the speedup over running only the last model, and the
+accuracy figures of print_results.
+
+Usage:
+    python bench_cascade.py --dir pet_images/ --cascade alexnet,vgg
+    python bench_cascade.py --cascade resnet,vgg --thresholds 0.3,0.5,0.7,0.9 \\
+        --weights resnet=r.pth,vgg=v.pth
+"""
+
+import argparse
+import os
+from time import perf_counter
+
+from adjust_results4_isadog import adjust_results4_isadog
+from calculates_results_stats import calculates_results_stats
+from cascade import cascade_name, dog_class_table, escalation_needed, parse_cascade
+from classifier import get_imagenet_classes, predict_batch_multi
+from classify_images import label_results
+from get_pet_labels import iter_pet_labels
+from model_registry import get_model, parse_weights
+
+
+DEFAULT_THRESHOLDS = '0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9'
+
+
+def accuracy(filenames, pet_labels, predictions, dogfile):
+    """Runs the usual result stages on one prediction per image; returns the stats."""
+    imagenet_classes = get_imagenet_classes()
+    results_dic = {filename: label_results(pet_label, prediction[0][0], imagenet_classes)
+                   for filename, pet_label, prediction in zip(filenames, pet_labels, predictions)}
+    adjust_results4_isadog(results_dic, dogfile,
+                           {filename: prediction[0][0]
+                            for filename, prediction in zip(filenames, predictions)})
+    return calculates_results_stats(results_dic)
+
+
+def replay(cascade, threshold, predictions, dog_table):
+    """
+    Replays the cascade on stored predictions.
+
+    Returns:
+        tuple: (deciding prediction per image, number of images each
+                architecture classified)
+    """
+    n_images = len(predictions[cascade.models[0]])
+    chosen = [None] * n_images
+    counts = dict.fromkeys(cascade.models, 0)
+    remaining = range(n_images)
+    for stage, model in enumerate(cascade.models):
+        counts[model] = len(remaining)
+        last_stage = stage == len(cascade.models) - 1
+        escalated = []
+        for i in remaining:
+            chosen[i] = predictions[model][i]
+            if not last_stage and escalation_needed(chosen[i], threshold, dog_table,
+                                                    cascade.dog_margin):
+                escalated.append(i)
+        remaining = escalated
+    return chosen, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cascade trade-off per threshold')
+    parser.add_argument('--dir', type=str, default='pet_images/',
+                        help='folder of images to classify')
+    parser.add_argument('--cascade', type=str, default='alexnet,vgg',
+                        help='architectures of the cascade, cheapest first')
+    parser.add_argument('--thresholds', type=str, default=DEFAULT_THRESHOLDS,
+                        help='comma-separated top-1 confidence thresholds to compare')
+    parser.add_argument('--dog-margin', type=float, default=0.2,
+                        help='borderline dog-call margin, 0 disables the check')
+    parser.add_argument('--dogfile', type=str, default='dognames.txt',
+                        help='text file of dog names')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='arch=path pairs of local state_dict files')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='number of images per forward pass')
+    parser.add_argument('--decode-workers', type=int, default=4,
+                        help='threads decoding images ahead of the models')
+    args = parser.parse_args()
+
+    try:
+        cascade = parse_cascade(args.cascade, 0.0, args.dog_margin, args.dogfile)
+        weights = parse_weights(args.weights, cascade.models)
+        thresholds = [float(threshold) for threshold in args.thresholds.split(',')]
+    except ValueError as e:
+        parser.error(str(e))
+
+    labeled_files = list(iter_pet_labels(args.dir))
+    filenames = [filename for filename, _ in labeled_files]
+    pet_labels = [pet_label for _, pet_label in labeled_files]
+    img_paths = [os.path.join(args.dir, filename) for filename in filenames]
+
+    # Every architecture on every image, timed with decoding included as in
+    # a real cascade stage; models are loaded before the clock starts
+    predictions, seconds = {}, {}
+    for model in cascade.models:
+        get_model(model, weights[model])
+        start = perf_counter()
+        predictions[model] = predict_batch_multi(img_paths, [model], args.batch_size, weights,
+                                                 workers=args.decode_workers)[model]
+        seconds[model] = (perf_counter() - start) / len(img_paths)
+
+    dog_table = dog_class_table(args.dogfile) if cascade.dog_margin > 0 else None
+    last = cascade.models[-1]
+
+    print("{} images from {}, cascade {}, dog margin {}\n".format(
+        len(img_paths), args.dir, cascade_name(cascade), cascade.dog_margin))
+    print("{:>12} {:>10} {:>10} {:>10} {:>9} {:>8} {:>8} {:>8} {:>8}".format(
+        'Threshold', 'escalated', 'ms/image', 'images/s', 'speedup',
+        'match', 'dogs', 'breed', 'notdogs'))
+
+    def report(name, escalated, cost, chosen):
+        stats = accuracy(filenames, pet_labels, chosen, args.dogfile)
+        print("{:>12} {:>10} {:10.2f} {:10.1f} {:8.2f}x {:7.1f}% {:7.1f}% {:7.1f}% {:7.1f}%".format(
+            name, escalated, cost * 1000, 1 / cost, seconds[last] / cost,
+            stats['pct_match'], stats['pct_correct_dogs'], stats['pct_correct_breed'],
+            stats['pct_correct_notdogs']))
+
+    # The single architectures bound the trade-off
+    for model in cascade.models:
+        report(model + ' only', '-', seconds[model], predictions[model])
+
+    for threshold in thresholds:
+        chosen, counts = replay(cascade, threshold, predictions, dog_table)
+        cost = sum(counts[model] * seconds[model] for model in cascade.models) / len(img_paths)
+        escalated = counts[cascade.models[1]] / len(img_paths)
+        report("{:g}".format(threshold), "{:.1%}".format(escalated), cost, chosen)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark comparing the per-label linear scan over dog names with the
+precompiled DogNameIndex.
+This module builds a synthetic set of classifier labels (1,000,000 by default)
+and times both approaches on it, checking that they agree.
+
+Usage:
+    python bench_dog_name_index.py --n-labels 1000000 --dogfile dognames.txt
+"""
+
+import argparse
+import ast
+import random
+import string
+from time import perf_counter
+
+from dog_name_index import DogNameIndex
+
+
+def linear_scan(dog_names, label):
+    """The original adjust_results4_isadog check: one substring test per name."""
+    for dog_name in dog_names:
+        if dog_name in label:
+            return 1
+    return 0
+
+
+def synthetic_labels(n_labels, imagenet_labels, seed=0):
+    """
+    Builds n_labels labels: half drawn from the ImageNet classes (as real
+    classifier output is) and half random strings that are all distinct, so
+    the index's memo cannot answer them.
+    """
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + ' '
+    labels = []
+    for i in range(n_labels):
+        if i % 2:
+            labels.append(rng.choice(imagenet_labels))
+        else:
+            labels.append(''.join(rng.choice(alphabet) for _ in range(30)) + str(i))
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dog name matching')
+    parser.add_argument('--n-labels', type=int, default=1000000,
+                        help='number of synthetic labels to classify')
+    parser.add_argument('--dogfile', type=str, default='dognames.txt',
+                        help='text file that contains valid dog names')
+    parser.add_argument('--classes', type=str, default='imagenet1000_clsid_to_human.txt',
+                        help='ImageNet class id to label file')
+    args = parser.parse_args()
+
+    with open(args.dogfile) as f:
+        dog_names = [line.rstrip() for line in f]
+    with open(args.classes) as f:
+        imagenet_labels = [label.lower().strip() for label in ast.literal_eval(f.read()).values()]
+
+    labels = synthetic_labels(args.n_labels, imagenet_labels)
+
+    start = perf_counter()
+    expected = [linear_scan(dog_names, label) for label in labels]
+    linear_time = perf_counter() - start
+
+    start = perf_counter()
+    index = DogNameIndex(dog_names)
+    build_time = perf_counter() - start
+
+    start = perf_counter()
+    found = [index.contains_dog_name(label) for label in labels]
+    index_time = perf_counter() - start
+
+    assert found == expected, "DogNameIndex disagrees with the linear scan"
+
+    print("{:28}: {:,}".format('Labels', len(labels)))
+    print("{:28}: {:,}".format('Dog names', len(dog_names)))
+    print("{:28}: {:8.3f} s".format('Linear scan', linear_time))
+    print("{:28}: {:8.3f} s".format('DogNameIndex build', build_time))
+    print("{:28}: {:8.3f} s".format('DogNameIndex match', index_time))
+    print("{:28}: {:8.1f}x".format('Speedup', linear_time / index_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark comparing the --precision / --optimize execution options.
+This module classifies the same preprocessed images with each architecture
+under several execution options and reports throughput, speedup over the
+fp32 eager baseline, and how often the top-1 class agrees with that baseline.
+
+Configurations are written the way options_tag prints them: a precision
+followed by optimizations, joined with '+', e.g. 'int8+channels_last+jit'.
+
+Usage:
+    python bench_execution_options.py --dir pet_images/ --arch all --repeat 3
+    python bench_execution_options.py --weights resnet=r.pth,alexnet=a.pth,vgg=v.pth
+"""
+
+import argparse
+import os
+from time import perf_counter
+
+from classifier import preprocess_image
+from execution_options import DEFAULT_OPTIONS, options_tag, parse_execution_options
+from get_pet_labels import iter_pet_labels
+from model_registry import evict, get_model, parse_model_names, parse_weights
+
+
+DEFAULT_CONFIGS = 'fp32,fp32+channels_last,fp32+jit,int8,int8+channels_last+jit'
+
+
+def parse_config(config):
+    """Parses 'precision+optimization+...' into ExecutionOptions."""
+    precision, *optimize = config.split('+')
+    return parse_execution_options(precision, ','.join(optimize) or 'none')
+
+
+def run(model, batches):
+    """Returns the top-1 class id of every image in batches, in order."""
+    import torch
+
+    top1 = []
+    with torch.inference_mode():
+        for batch in batches:
+            top1.extend(model(batch).argmax(dim=1).tolist())
+    return top1
+
+
+def bench_config(model_name, weights, options, batches, repeat):
+    """
+    Times one architecture under one set of execution options.
+
+    Returns:
+        tuple: (seconds per pass over all batches, top-1 class ids)
+    """
+    model = get_model(model_name, weights, options=options)
+
+    # The first pass also pays for tracing or compiling
+    top1 = run(model, batches)
+    start = perf_counter()
+    for _ in range(repeat):
+        run(model, batches)
+    elapsed = (perf_counter() - start) / repeat
+
+    evict(model_name, weights, options=options)
+    return elapsed, top1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark precision and optimization options')
+    parser.add_argument('--dir', type=str, default='pet_images/',
+                        help='folder of images to classify')
+    parser.add_argument('--arch', type=str, default='all',
+                        help="architectures: resnet, alexnet, vgg, a comma-separated list, or 'all'")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='local state_dict file, or arch=path pairs with several architectures')
+    parser.add_argument('--configs', type=str, default=DEFAULT_CONFIGS,
+                        help='comma-separated configurations to compare with fp32 '
+                             '(default: {})'.format(DEFAULT_CONFIGS))
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='number of images per forward pass')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed passes over the images per configuration')
+    args = parser.parse_args()
+
+    try:
+        model_names = parse_model_names(args.arch)
+        weights_by_model = parse_weights(args.weights, model_names)
+        configs = [parse_config(config) for config in args.configs.split(',')]
+    except ValueError as e:
+        parser.error(str(e))
+    configs = [DEFAULT_OPTIONS] + [options for options in configs if options != DEFAULT_OPTIONS]
+
+    import torch
+
+    # Decode once so only the forward passes are timed
+    img_paths = [os.path.join(args.dir, filename) for filename, _ in iter_pet_labels(args.dir)]
+    tensors = [preprocess_image(img_path) for img_path in img_paths]
+    batches = [torch.stack(tensors[start:start + args.batch_size])
+               for start in range(0, len(tensors), args.batch_size)]
+
+    print("{} images from {}, batch size {}, {} torch threads\n".format(
+        len(tensors), args.dir, args.batch_size, torch.get_num_threads()))
+    print("{:8} {:28} {:>10} {:>10} {:>9} {:>10}".format(
+        'Arch', 'Options', 'ms/image', 'images/s', 'speedup', 'top-1 agree'))
+
+    for model_name in model_names:
+        baseline_time, baseline_top1 = None, None
+        for options in configs:
+            elapsed, top1 = bench_config(model_name, weights_by_model[model_name], options,
+                                         batches, args.repeat)
+            if baseline_top1 is None:
+                baseline_time, baseline_top1 = elapsed, top1
+
+            agree = sum(a == b for a, b in zip(top1, baseline_top1)) / max(1, len(top1))
+            print("{:8} {:28} {:10.2f} {:10.1f} {:8.2f}x {:10.1%}".format(
+                model_name, options_tag(options), elapsed / len(tensors) * 1000,
+                len(tensors) / elapsed, baseline_time / elapsed, agree))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark tracking the cold-start latency of check_images.py.
+This module runs check_images.py --help in fresh interpreters, reports the
+wall time of each start, and lists the slowest imports from python -X importtime
+so regressions in import-time work are easy to spot.
+
+Usage:
+    python bench_importtime.py --runs 5 --top 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_images.py')
+
+
+def time_startup(args):
+    """Runs check_images.py once in a new interpreter and returns the wall time."""
+    start = perf_counter()
+    subprocess.run([sys.executable, SCRIPT] + args, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return perf_counter() - start
+
+
+def slowest_imports(args, top):
+    """
+    Runs check_images.py under -X importtime and returns the top modules by
+    cumulative import time as (microseconds, module) pairs.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # Lines look like: "import time:   self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), module.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark check_images.py cold start')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of fresh interpreter starts to time')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest imports to list')
+    parser.add_argument('args', nargs='*', default=['--help'],
+                        help='arguments passed to check_images.py (default: --help)')
+    args = parser.parse_args()
+
+    # Warm the OS file cache so only interpreter work is measured
+    time_startup(args.args)
+    times = [time_startup(args.args) for _ in range(args.runs)]
+
+    print("{:28}: {}".format('Command', ' '.join(['check_images.py'] + args.args)))
+    print("{:28}: {:8.3f} s".format('Median cold start', statistics.median(times)))
+    print("{:28}: {:8.3f} s".format('Fastest cold start', min(times)))
+
+    print("\nSlowest imports (cumulative):")
+    for cumulative, module in slowest_imports(args.args, args.top):
+        print("{:10.1f} ms  {}".format(cumulative / 1000.0, module))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Benchmark comparing the old per-call preprocessing with the shared engine.
+This module preprocesses a folder into batches two ways, each in a fresh
+interpreter so peak memory is comparable:
+
+    legacy  builds transforms.Compose for every image, decodes at full size,
+            allocates a tensor per image and torch.stack's every batch
+    engine  reuses one Preprocessor (decoding JPEGs in draft mode with
+            --draft) and writes every image into a reused batch buffer
+            (image_pipeline)
+
+and reports time per image, the torch ops allocating memory and the bytes
+they allocate per image (from the torch profiler), and peak RSS growth over
+the post-import baseline. It then compares draft and full JPEG decoding:
+how far the model inputs move and how often one architecture's top-1
+prediction stays the same.
+
+Usage:
+    python bench_preprocessing.py --dir pet_images/ --batch-size 32 --passes 3
+    python bench_preprocessing.py --draft --arch resnet --weights resnet.pth
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+
+MODES = ('legacy', 'engine')
+
+
+def legacy_batches(img_paths, batch_size):
+    """Yields batches the way classifier.preprocess_image used to build them."""
+    import torch
+    import torchvision.transforms as transforms
+    from PIL import Image
+
+    from classifier import CROP_SIZE, NORM_MEAN, NORM_STD, RESIZE_SIZE
+
+    for start in range(0, len(img_paths), batch_size):
+        tensors = []
+        for img_path in img_paths[start:start + batch_size]:
+            img = Image.open(img_path).convert('RGB')
+            preprocess = transforms.Compose([
+                transforms.Resize(RESIZE_SIZE),
+                transforms.CenterCrop(CROP_SIZE),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=NORM_MEAN, std=NORM_STD)
+            ])
+            tensors.append(preprocess(img))
+        yield torch.stack(tensors)
+
+
+def engine_batches(img_paths, batch_size):
+    """Yields batches from the shared preprocessor and reused buffers."""
+    from classifier import get_image_preprocessor
+    from image_pipeline import iter_batches
+
+    preprocessor = get_image_preprocessor()
+    for _, batch in iter_batches(img_paths, preprocessor, preprocessor.output_shape,
+                                 batch_size, workers=0):
+        yield batch
+
+
+def draft_agreement(img_paths, model_name, weights, batch_size):
+    """
+    Compares draft and full JPEG decoding on every image.
+
+    Returns:
+        dict: max_input_diff and mean_input_diff (absolute difference of the
+              normalized inputs), agree (images whose top-1 class is the
+              same both ways) and images
+    """
+    import torch
+
+    from classifier import get_image_preprocessor, predict_batch_multi, set_jpeg_draft
+
+    inputs, top1 = {}, {}
+    for draft in (False, True):
+        set_jpeg_draft(draft)
+        preprocessor = get_image_preprocessor()
+        inputs[draft] = torch.stack([preprocessor(img_path) for img_path in img_paths])
+        predictions = predict_batch_multi(img_paths, [model_name], batch_size,
+                                          {model_name: weights})[model_name]
+        top1[draft] = [class_ids[0] for class_ids, _ in predictions]
+    set_jpeg_draft(False)
+
+    difference = (inputs[True] - inputs[False]).abs()
+    return {'max_input_diff': difference.max().item(),
+            'mean_input_diff': difference.mean().item(),
+            'agree': sum(full == draft for full, draft in zip(top1[False], top1[True])),
+            'images': len(img_paths)}
+
+
+def child(mode, img_paths, batch_size, passes, draft=False):
+    """Measures one mode in this process and prints the numbers as JSON."""
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    import torchvision.transforms  # noqa: F401 (imported before the baseline)
+    from PIL import Image  # noqa: F401
+
+    import classifier
+    import image_pipeline  # noqa: F401
+    from profiling import current_rss_mb, peak_rss_mb
+
+    classifier.set_jpeg_draft(draft)
+
+    batches = legacy_batches if mode == 'legacy' else engine_batches
+
+    # Baseline after the imports, so only preprocessing memory is counted
+    baseline_rss = current_rss_mb()
+
+    start = perf_counter()
+    for _ in range(passes):
+        for _ in batches(img_paths, batch_size):
+            pass
+    elapsed = perf_counter() - start
+    peak_rss = peak_rss_mb()
+
+    # Count tensor allocations over one more pass
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in batches(img_paths, batch_size):
+            pass
+    # Memory is attributed to the op that allocated it
+    allocations = [event.self_cpu_memory_usage for event in prof.events()
+                   if event.self_cpu_memory_usage > 0]
+
+    print(json.dumps({'mode': mode,
+                      'ms_per_image': elapsed / (passes * len(img_paths)) * 1000,
+                      'allocs_per_image': len(allocations) / len(img_paths),
+                      'alloc_kb_per_image': sum(allocations) / len(img_paths) / 1e3,
+                      'peak_rss_growth_mb': (peak_rss - baseline_rss
+                                             if peak_rss is not None and baseline_rss is not None
+                                             else None),
+                      'torch_threads': torch.get_num_threads()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image preprocessing allocations')
+    parser.add_argument('--dir', type=str, default='pet_images/',
+                        help='folder of images to preprocess')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='number of images per batch')
+    parser.add_argument('--passes', type=int, default=3,
+                        help='timed passes over the folder')
+    parser.add_argument('--draft', action='store_true',
+                        help='decode JPEGs in draft mode in the engine mode')
+    parser.add_argument('--arch', type=str, default='resnet',
+                        help="architecture comparing draft and full decoding, or 'none' to skip")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='local state_dict file of --arch')
+    parser.add_argument('--child', choices=MODES, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    from get_pet_labels import iter_pet_labels
+
+    img_paths = sorted(os.path.join(args.dir, filename)
+                       for filename, _ in iter_pet_labels(args.dir))
+
+    if args.child:
+        child(args.child, img_paths, args.batch_size, args.passes, args.draft)
+        return
+
+    # One fresh interpreter per mode so peak RSS is not shared
+    results = {}
+    for mode in MODES:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode,
+                                 '--dir', args.dir, '--batch-size', str(args.batch_size),
+                                 '--passes', str(args.passes)] + (['--draft'] if args.draft else []),
+                                stdout=subprocess.PIPE, text=True, check=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print("{} images from {}, batch size {}, {} passes\n".format(
+        len(img_paths), args.dir, args.batch_size, args.passes))
+    print("{:8} {:>10} {:>14} {:>16} {:>14}".format(
+        'Mode', 'ms/image', 'allocs/image', 'alloc KB/image', 'peak RSS +MB'))
+    for mode in MODES:
+        result = results[mode]
+        growth = result['peak_rss_growth_mb']
+        print("{:8} {:10.2f} {:14.2f} {:16.1f} {:>14}".format(
+            mode, result['ms_per_image'], result['allocs_per_image'],
+            result['alloc_kb_per_image'], 'n/a' if growth is None else "{:.1f}".format(growth)))
+
+    legacy, engine = results['legacy'], results['engine']
+    print("\nengine vs legacy: {:.2f}x faster, {:.1f} fewer tensor allocations and "
+          "{:.1f} KB less allocated per image".format(
+              legacy['ms_per_image'] / engine['ms_per_image'],
+              legacy['allocs_per_image'] - engine['allocs_per_image'],
+              legacy['alloc_kb_per_image'] - engine['alloc_kb_per_image']))
+
+    if args.arch != 'none':
+        agreement = draft_agreement(img_paths, args.arch, args.weights, args.batch_size)
+        print("\ndraft vs full JPEG decode ({}): top-1 agrees on {}/{} images ({:.1%}); "
+              "input |diff| max {:.3f}, mean {:.4f}".format(
+                  args.arch, agreement['agree'], agreement['images'],
+                  agreement['agree'] / agreement['images'] if agreement['images'] else 0.0,
+                  agreement['max_input_diff'], agreement['mean_input_diff']))
+
+
+if __name__ == "__main__":
+    main()
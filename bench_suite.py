@@ -0,0 +1,325 @@
+"""
+Benchmark suite timing every stage of the check_images pipeline.
+This module builds a synthetic folder of JPEGs named like the pet images
+(or uses a real folder) and randomly initialized weights for every
+architecture, so it runs offline, then times each stage separately:
+
+    get_pet_labels            listing the folder and building the labels
+    preprocess                decoding and preprocessing one image at a time
+    preprocess_pipeline       the threaded decode pipeline into batch buffers
+    model_load:<arch>         building a model and loading its weights
+    forward:<arch>            batched forward passes with top-k
+    adjust_results4_isadog    the dog checks, with class ids
+    calculates_results_stats  the statistics
+    print_results             the printed summary, with both listings
+
+Every stage is timed --repeat times (fast stages run in loops of at least
+--min-time seconds per sample) and reported as the median, minimum and
+per-item time. --json-out writes the results, and --compare checks them
+against a stored run and exits with status 1 when a stage got slower by more
+than --threshold.
+
+Usage:
+    python bench_suite.py --n-images 64 --arch all --json-out baseline.json
+    python bench_suite.py --n-images 64 --arch all --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+
+from adjust_results4_isadog import adjust_results4_isadog
+from calculates_results_stats import calculates_results_stats
+from classifier import get_image_preprocessor, get_imagenet_classes, predict_tensors
+from classify_images import label_results
+from get_pet_labels import get_pet_labels, pet_label_from_filename
+from image_pipeline import iter_batches
+from model_registry import ARCHITECTURES, evict, get_model, parse_model_names
+from print_results import print_results
+
+
+# Pet labels of the synthetic images that are not dogs
+NOT_DOG_LABELS = ('cat', 'rabbit', 'polar bear', 'gecko', 'fox squirrel', 'skunk')
+
+# Bump when stages are added, renamed or measured differently
+_FORMAT_VERSION = 1
+
+
+def make_synthetic_images(images_dir, n_images, size=(500, 375), dogfile='dognames.txt',
+                          seed=0):
+    """
+    Writes n_images JPEGs named like the pet images ('Boston_terrier_00042.jpg'),
+    about three quarters of them dogs. Each is a smooth random gradient with
+    some noise, so it compresses and decodes like a photo rather than like
+    pure noise. Sizes vary by up to 25% around size.
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    with open(dogfile) as f:
+        dog_names = [line.strip().split(',')[0] for line in f if line.strip()]
+
+    for i in range(n_images):
+        label = rng.choice(dog_names) if i % 4 else rng.choice(NOT_DOG_LABELS)
+        filename = "{}_{:05d}.jpg".format(label.replace(' ', '_').capitalize(), i)
+        width = int(size[0] * rng.uniform(0.75, 1.25))
+        height = int(size[1] * rng.uniform(0.75, 1.25))
+
+        coarse = Image.fromarray(np_rng.integers(0, 256, (6, 8, 3), dtype=np.uint8))
+        pixels = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.int16)
+        pixels = pixels + np_rng.integers(-12, 13, pixels.shape, dtype=np.int16)
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(
+            os.path.join(images_dir, filename), quality=90)
+
+
+def make_random_weights(weights_dir, model_names, seed=0):
+    """Saves a randomly initialized state_dict per architecture; returns their paths."""
+    import torch
+    import torchvision.models as models
+
+    paths = {}
+    for model_name in model_names:
+        torch.manual_seed(seed)
+        model = getattr(models, ARCHITECTURES[model_name][0])(weights=None)
+        paths[model_name] = os.path.join(weights_dir, model_name + '.pth')
+        torch.save(model.state_dict(), paths[model_name])
+    return paths
+
+
+def measure(run, repeat, min_time, setup=None):
+    """
+    Times run(setup()) repeat times.
+
+    The number of calls per sample is doubled until a sample takes at least
+    min_time, and setup() (untimed) prepares a fresh argument for every call.
+
+    Returns:
+        list: Seconds per call, one value per sample
+    """
+    def sample(number):
+        args = [setup() if setup else None for _ in range(number)]
+        start = perf_counter()
+        for arg in args:
+            run(arg)
+        return perf_counter() - start
+
+    number = 1
+    while sample(number) < min_time and number < 1 << 16:
+        number *= 2
+
+    return [sample(number) / number for _ in range(repeat)]
+
+
+def summarize(samples, items):
+    """Reduces timing samples to the numbers stored in the JSON results."""
+    median = statistics.median(samples)
+    return {'median_s': median, 'min_s': min(samples), 'items': items,
+            'per_item_ms': median / max(1, items) * 1000}
+
+
+def run_suite(images_dir, model_names, weights, batch_size, workers, repeat, min_time,
+              dogfile):
+    """
+    Times every stage on the images in images_dir.
+
+    Returns:
+        dict: summarize() results keyed by stage name, in pipeline order
+    """
+    results = {}
+
+    def record(stage, items, run, setup=None):
+        results[stage] = summarize(measure(run, repeat, min_time, setup), items)
+        print("  {:30} {:10.3f} ms  ({:.3f} ms/item)".format(
+            stage, results[stage]['median_s'] * 1000, results[stage]['per_item_ms']),
+            file=sys.stderr)
+
+    filenames = sorted(get_pet_labels(images_dir))
+    img_paths = [os.path.join(images_dir, filename) for filename in filenames]
+    n_images = len(img_paths)
+
+    record('get_pet_labels', n_images, lambda _: get_pet_labels(images_dir))
+
+    preprocessor = get_image_preprocessor()
+    record('preprocess', n_images,
+           lambda _: [preprocessor(img_path) for img_path in img_paths])
+    record('preprocess_pipeline', n_images,
+           lambda _: [None for _ in iter_batches(img_paths, preprocessor,
+                                                 preprocessor.output_shape,
+                                                 batch_size, workers)])
+
+    # Decode once; the forward passes only see ready tensors
+    batches = [batch.clone() for _, batch in iter_batches(img_paths, preprocessor,
+                                                          preprocessor.output_shape,
+                                                          batch_size, workers=0)]
+
+    def load(model_name):
+        evict(model_name, weights[model_name])
+        get_model(model_name, weights[model_name])
+
+    predictions = {}
+    for model_name in model_names:
+        record('model_load:' + model_name, 1, lambda _: load(model_name))
+        record('forward:' + model_name, n_images,
+               lambda _: [predict_tensors(batch, model_name, weights[model_name])
+                          for batch in batches])
+        predictions[model_name] = [prediction for batch in batches
+                                   for prediction in predict_tensors(batch, model_name,
+                                                                     weights[model_name])]
+        evict(model_name, weights[model_name])
+
+    # The result stages run on the first architecture's predictions
+    imagenet_classes = get_imagenet_classes()
+    class_ids = {filename: class_ids[0]
+                 for filename, (class_ids, _) in zip(filenames, predictions[model_names[0]])}
+    labeled = {filename: label_results(pet_label_from_filename(filename), class_ids[filename],
+                                       imagenet_classes)
+               for filename in filenames}
+
+    def fresh_results():
+        return {filename: list(values) for filename, values in labeled.items()}
+
+    record('adjust_results4_isadog', n_images,
+           lambda results_dic: adjust_results4_isadog(results_dic, dogfile, class_ids),
+           fresh_results)
+
+    results_dic = fresh_results()
+    adjust_results4_isadog(results_dic, dogfile, class_ids)
+    record('calculates_results_stats', n_images,
+           lambda _: calculates_results_stats(results_dic))
+
+    results_stats = calculates_results_stats(results_dic)
+
+    def print_quietly(_):
+        with contextlib.redirect_stdout(io.StringIO()):
+            print_results(results_dic, results_stats, model_names[0], True, True)
+
+    record('print_results', n_images, print_quietly)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each stage next to the baseline and returns the regressed stages.
+
+    A stage regresses when its median is more than threshold (a fraction)
+    slower than the baseline's; stages missing from either side are listed
+    but never count as regressions.
+    """
+    regressions = []
+    print("\n{:30} {:>12} {:>12} {:>9}".format('Stage', 'baseline ms', 'current ms', 'change'))
+    for stage in list(baseline['stages']) + [s for s in results if s not in baseline['stages']]:
+        old = baseline['stages'].get(stage)
+        new = results.get(stage)
+        if old is None or new is None:
+            print("{:30} {:>12} {:>12} {:>9}".format(
+                stage, '-' if old is None else "{:.3f}".format(old['median_s'] * 1000),
+                '-' if new is None else "{:.3f}".format(new['median_s'] * 1000), 'n/a'))
+            continue
+        change = new['median_s'] / old['median_s'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(stage)
+            flag = '  REGRESSION'
+        print("{:30} {:12.3f} {:12.3f} {:+8.1%}{}".format(
+            stage, old['median_s'] * 1000, new['median_s'] * 1000, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the pipeline')
+    parser.add_argument('--n-images', type=int, default=64,
+                        help='number of synthetic images to generate')
+    parser.add_argument('--image-size', type=str, default='500x375',
+                        help='typical synthetic image size as WIDTHxHEIGHT')
+    parser.add_argument('--dir', type=str, default=None,
+                        help='benchmark this folder of images instead of synthetic ones')
+    parser.add_argument('--arch', type=str, default='all',
+                        help="architectures: resnet, alexnet, vgg, a comma-separated list, or 'all'")
+    parser.add_argument('--dogfile', type=str, default='dognames.txt',
+                        help='text file of dog names')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='number of images per forward pass')
+    parser.add_argument('--decode-workers', type=int, default=4,
+                        help='threads used by the preprocess_pipeline stage')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed samples per stage')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum seconds per sample; fast stages are looped')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic images and weights')
+    parser.add_argument('--json-out', type=str, default=None,
+                        help='write the results to this JSON file (e.g. to use as a baseline)')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown over the baseline median that counts as a regression '
+                             '(default: 0.10 for 10%%)')
+    args = parser.parse_args()
+
+    try:
+        model_names = parse_model_names(args.arch)
+        size = tuple(int(side) for side in args.image_size.lower().split('x'))
+        if len(size) != 2:
+            raise ValueError("--image-size must look like 500x375")
+    except ValueError as e:
+        parser.error(str(e))
+
+    import torch
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images_dir = args.dir
+        if images_dir is None:
+            images_dir = os.path.join(tmp_dir, 'images')
+            os.mkdir(images_dir)
+            make_synthetic_images(images_dir, args.n_images, size, args.dogfile, args.seed)
+        weights = make_random_weights(tmp_dir, model_names, args.seed)
+
+        print("Timing {} images from {}, batch size {}, {} torch threads".format(
+            len(os.listdir(images_dir)), args.dir or 'a synthetic folder', args.batch_size,
+            torch.get_num_threads()), file=sys.stderr)
+        stages = run_suite(images_dir, model_names, weights, args.batch_size,
+                           args.decode_workers, args.repeat, args.min_time, args.dogfile)
+
+    report = {
+        'version': _FORMAT_VERSION,
+        'config': {'n_images': args.n_images if args.dir is None else None,
+                   'image_size': list(size), 'dir': args.dir, 'arch': model_names,
+                   'batch_size': args.batch_size, 'decode_workers': args.decode_workers,
+                   'repeat': args.repeat, 'seed': args.seed},
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__,
+                        'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads(),
+                        'machine': platform.machine()},
+        'stages': stages,
+    }
+
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print("Warning: the baseline was run with different settings", file=sys.stderr)
+        regressions = compare(stages, baseline, args.threshold)
+        if regressions:
+            print("\n{} stage(s) regressed by more than {:.0%}: {}".format(
+                len(regressions), args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+        print("\nNo regressions over {:.0%}".format(args.threshold))
+    elif not args.json_out:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
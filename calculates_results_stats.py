@@ -39,6 +39,9 @@
 #       in the return statement with the results_stats_dic dictionary that you create 
 #       with this function
 # 
+from results_store import ResultsStore
+
+
 def calculates_results_stats(results_dic):
     """
     Calculates statistics of the results of the program run using classifier's model 
@@ -57,6 +60,8 @@ def calculates_results_stats(results_dic):
                     idx 4 = 1/0 (int)  where 1 = Classifier classifies image 
                             'as-a' dog and 0 = Classifier classifies image  
                             'as-NOT-a' dog.
+             A ResultsStore is counted with vectorized reductions over its
+             flag columns instead of a Python loop.
     Returns:
      results_stats_dic - Dictionary that contains the results statistics (either
                     a percentage or a count) where the key is the statistic's 
@@ -77,32 +82,63 @@ def calculates_results_stats(results_dic):
     results_stats_dic['n_correct_notdogs'] = 0
     results_stats_dic['n_correct_breed'] = 0
     
-    # Loop through results_dic to count statistics
-    for key in results_dic:
-        # Count total images
-        results_stats_dic['n_images'] += 1
+    # Columnar results: count with vectorized reductions over the flag columns
+    if isinstance(results_dic, ResultsStore):
+        match, pet_is_dog, classifier_is_dog = results_dic.flag_columns()
+        results_stats_dic['n_images'] = int(match.size)
+        results_stats_dic['n_match'] = int(match.sum())
+        results_stats_dic['n_dogs_img'] = int(pet_is_dog.sum())
+        results_stats_dic['n_correct_breed'] = int((pet_is_dog & match).sum())
+        results_stats_dic['n_correct_dogs'] = int((pet_is_dog & classifier_is_dog).sum())
+        results_stats_dic['n_correct_notdogs'] = int(((pet_is_dog | classifier_is_dog) == 0).sum())
+    
+    else:
+        # Loop through results_dic to count statistics
+        for key in results_dic:
+            # Count total images
+            results_stats_dic['n_images'] += 1
         
-        # Count matches
-        if results_dic[key][2] == 1:
-            results_stats_dic['n_match'] += 1
+            # Count matches
+            if results_dic[key][2] == 1:
+                results_stats_dic['n_match'] += 1
         
-        # Count dog images
-        if results_dic[key][3] == 1:
-            results_stats_dic['n_dogs_img'] += 1
+            # Count dog images
+            if results_dic[key][3] == 1:
+                results_stats_dic['n_dogs_img'] += 1
             
-            # Count correctly classified dog breeds
-            if results_dic[key][2] == 1:
-                results_stats_dic['n_correct_breed'] += 1
+                # Count correctly classified dog breeds
+                if results_dic[key][2] == 1:
+                    results_stats_dic['n_correct_breed'] += 1
             
-            # Count correctly classified dogs
-            if results_dic[key][4] == 1:
-                results_stats_dic['n_correct_dogs'] += 1
+                # Count correctly classified dogs
+                if results_dic[key][4] == 1:
+                    results_stats_dic['n_correct_dogs'] += 1
         
-        # Count correctly classified non-dogs
-        else:
-            if results_dic[key][4] == 0:
-                results_stats_dic['n_correct_notdogs'] += 1
+            # Count correctly classified non-dogs
+            else:
+                if results_dic[key][4] == 0:
+                    results_stats_dic['n_correct_notdogs'] += 1
+    
+    # Derive the not-dog count and the percentages from the counts
+    derive_results_stats(results_stats_dic)
     
+    # Return results_stats_dic
+    return results_stats_dic
+
+
+def derive_results_stats(results_stats_dic):
+    """
+    Fills in the statistics derived from the raw counts: the number of not-dog
+    images and every percentage. Shared by calculates_results_stats and the
+    mergeable StatsAccumulator so both report identical values.
+    Parameters:
+      results_stats_dic - Dictionary holding at least the counts n_images,
+                     n_dogs_img, n_match, n_correct_dogs, n_correct_notdogs
+                     and n_correct_breed; it is updated in place
+    Returns:
+     results_stats_dic - The same dictionary with n_notdogs_img and the pct_*
+                     statistics added
+    """
     # Calculate number of not-dog images
     results_stats_dic['n_notdogs_img'] = (results_stats_dic['n_images'] - 
                                            results_stats_dic['n_dogs_img'])
@@ -124,5 +160,4 @@ def calculates_results_stats(results_dic):
     else:
         results_stats_dic['pct_correct_notdogs'] = 0.0
     
-    # Return results_stats_dic
     return results_stats_dic
@@ -0,0 +1,121 @@
+"""
+Module for running CNN models as a confidence-gated cascade.
+This module describes a cascade of architectures from cheapest to most
+expensive (e.g. alexnet then vgg) and decides, from one stage's top-k
+softmax scores, whether an image is settled or must go to the next model:
+when the top-1 confidence is below a threshold, or when the dog / not-dog
+call is borderline because the top-k probability is split between dog and
+non-dog classes.
+"""
+
+from collections import namedtuple
+
+from model_registry import parse_model_names
+
+
+# models runs in order; every stage but the last keeps an image when its
+# top-1 score is at least threshold and its dog call is not borderline by
+# dog_margin (0 disables the dog check), with the dog classes of dogfile
+Cascade = namedtuple('Cascade', ['models', 'threshold', 'dog_margin', 'dogfile'])
+
+
+def parse_cascade(models, threshold=0.5, dog_margin=0.0, dogfile='dognames.txt'):
+    """
+    Builds a Cascade from the --cascade, --cascade-threshold and
+    --cascade-dog-margin values.
+
+    Args:
+        models (str): Comma-separated architectures, cheapest first
+        threshold (float): Minimum top-1 softmax score to settle an image
+        dog_margin (float): Dog calls whose dog and non-dog shares of the
+                            top-k probability differ by less than this
+                            fraction are escalated; 0 disables the check
+        dogfile (str): Text file of dog names
+
+    Returns:
+        Cascade: The cascade
+
+    Raises:
+        ValueError: If an architecture is not recognized, fewer than two
+                    different ones are given, or a value is out of range
+    """
+    if models.strip().lower() == 'all':
+        raise ValueError("List the cascade architectures in order, e.g. 'alexnet,vgg'")
+    names = parse_model_names(models)
+    if len(names) < 2:
+        raise ValueError("A cascade needs at least two architectures, e.g. 'alexnet,vgg'")
+    if not 0.0 <= threshold <= 1.0:
+        raise ValueError("The cascade threshold must be between 0 and 1")
+    if not 0.0 <= dog_margin <= 1.0:
+        raise ValueError("The cascade dog margin must be between 0 and 1")
+    return Cascade(tuple(names), threshold, dog_margin, dogfile)
+
+
+def cascade_name(cascade):
+    """
+    Names a cascade in results and reports.
+
+    Returns:
+        str: For example 'alexnet>vgg'
+    """
+    return '>'.join(cascade.models)
+
+
+def dog_class_table(dogfile):
+    """Returns the table of which ImageNet class ids are dogs for dogfile."""
+    from classifier import get_imagenet_classes
+    from dog_name_index import DogNameIndex
+
+    return DogNameIndex.from_file(dogfile).class_table(get_imagenet_classes())
+
+
+def escalation_needed(prediction, threshold, dog_table=None, dog_margin=0.0):
+    """
+    Decides whether a cascade stage's prediction is too unsure to keep.
+
+    Args:
+        prediction (tuple): (top-k class ids, softmax scores) of one image,
+                            best class first
+        threshold (float): Minimum top-1 score to keep the prediction
+        dog_table (sequence): Which class ids are dogs, from dog_class_table,
+                              or None to skip the dog check
+        dog_margin (float): The dog call is borderline when the top-k scores
+                            on dog and non-dog classes differ by less than
+                            this fraction of their sum
+
+    Returns:
+        bool: True when the next architecture should classify the image
+    """
+    class_ids, scores = prediction
+    if scores[0] < threshold:
+        return True
+
+    if dog_table is not None and dog_margin > 0:
+        dog_score = sum(score for class_id, score in zip(class_ids, scores) if dog_table[class_id])
+        total = sum(scores)
+        if total > 0 and abs(2 * dog_score - total) < dog_margin * total:
+            return True
+
+    return False
+
+
+def format_cascade_counts(cascade, counts):
+    """
+    Describes how far images went down a cascade, e.g.
+    'Cascade alexnet>vgg: 40 images, 12 (30.0%) escalated to vgg'.
+
+    Args:
+        cascade (Cascade): The cascade
+        counts (dict): Images classified per architecture, as filled in by
+                       classify_images_cascade
+
+    Returns:
+        str: The summary line
+    """
+    n_images = counts.get(cascade.models[0], 0)
+    parts = ["\nCascade {}: {} images".format(cascade_name(cascade), n_images)]
+    for model in cascade.models[1:]:
+        escalated = counts.get(model, 0)
+        parts.append("{} ({:.1%}) escalated to {}".format(
+            escalated, escalated / n_images if n_images else 0.0, model))
+    return ", ".join(parts)
@@ -8,13 +8,36 @@ This module contains the main function that uses a pre-trained CNN model
 to classify images of pets from a folder.
 """
 
-from time import time
-from get_input_args import get_input_args
-from get_pet_labels import get_pet_labels
-from classify_images import classify_images
+import asyncio
+import json
+import os
+import sys
+from time import perf_counter, sleep, time
+import profiling
+from get_input_args import (get_build_index_args, get_input_args, get_merge_args,
+                            get_pack_args, get_query_index_args, get_serve_args)
+from get_pet_labels import iter_pet_labels, shard_filter
+from classifier import TOPK, get_imagenet_classes, preprocess_config, set_jpeg_draft
+from cascade import format_cascade_counts
+from dedup import format_dedup_report, group_duplicates
+from classify_images import (classify_images_parallel, classify_images_stream, label_results,
+                             rescore_images)
+from embedding_index import build_index, load_index
+from embeddings import iter_embeddings, write_embeddings
+from image_archives import ArchiveReader, pack_archives
+from inference_client import classify_images_remote
+from inference_server import InferenceServer, run_server
+from model_registry import set_execution_options, weights_version
 from adjust_results4_isadog import adjust_results4_isadog
 from calculates_results_stats import calculates_results_stats
-from print_results import print_results
+from print_results import print_comparison, print_results
+from prediction_cache import PredictionCache
+from prediction_file import PredictionWriter, load_predictions
+from results_store import ResultsStore
+from tensor_cache import TensorCache
+from stats_accumulator import StatsAccumulator, merge_stats_files, save_stats
+from watch_folder import (FolderWatcher, Manifest, format_refresh, format_watch_stats,
+                          watch_settings)
 
 
 def main():
@@ -32,20 +55,178 @@ def main():
     # Get command-line arguments
     in_arg = get_input_args()
     
-    # Get pet image labels
-    pet_image_labels = get_pet_labels(in_arg.dir)
+    # Build the models with the requested precision and optimizations
+    set_execution_options(in_arg.execution_options)
+    set_jpeg_draft(in_arg.draft)
     
-    # Classify the images
-    classify_images(in_arg.dir, pet_image_labels, in_arg.arch)
+    # Watch mode keeps classifying new files until interrupted
+    if in_arg.watch:
+        watch_main(in_arg)
+        return
     
-    # Adjust results to classify labels as dogs or not dogs
-    adjust_results4_isadog(pet_image_labels, in_arg.dogfile)
+    # Start the stage timers and traces when asked
+    profiler = profiling.enable() if in_arg.profile else None
+    tracer = profiling.TraceRecorder(in_arg.cprofile, in_arg.torch_trace)
+    tracer.start()
     
-    # Calculate results statistics
-    results_stats = calculates_results_stats(pet_image_labels)
+    # Rescoring reads saved predictions instead of classifying anything
+    rescore = None
+    if in_arg.rescore is not None:
+        in_arg.models, rescore = load_predictions(in_arg.rescore)
     
-    # Print results
-    print_results(pet_image_labels, results_stats, in_arg.arch)
+    # Open the on-disk prediction cache unless disabled or a server classifies
+    cache = None
+    if not in_arg.no_cache and in_arg.server is None and rescore is None:
+        cache = PredictionCache(in_arg.cache_file, in_arg.cache_size,
+                                rebuild=in_arg.rebuild_cache)
+    
+    # Get pet image labels lazily as the folder is scanned, or as the
+    # archives named by --dir are read (keeping the image bytes in memory)
+    images_dir = in_arg.dir
+    if in_arg.archives is not None:
+        images_dir = ArchiveReader(in_arg.archives, in_arg.recursive)
+        pet_image_labels = images_dir.labeled_files()
+    else:
+        pet_image_labels = iter_pet_labels(in_arg.dir, recursive=in_arg.recursive)
+    
+    # Keep only this process's share of the folder when sharding
+    if in_arg.shard is not None:
+        pet_image_labels = shard_filter(pet_image_labels, *in_arg.shard)
+    
+    # Classify one image per group of duplicates when asked; hashing needs
+    # the full listing, so the folder is scanned up front
+    duplicates = {}
+    if in_arg.dedup:
+        pet_image_labels = list(pet_image_labels)
+        dedup_start = perf_counter()
+        with profiling.stage('dedup_hash', len(pet_image_labels)):
+            representatives = group_duplicates([os.path.join(in_arg.dir, filename)
+                                                for filename, _ in pet_image_labels],
+                                               in_arg.dedup_distance,
+                                               max(1, in_arg.decode_workers))
+        dedup_seconds = perf_counter() - dedup_start
+        for index, representative in enumerate(representatives):
+            if representative != index:
+                duplicates.setdefault(pet_image_labels[representative][0], []).append(
+                    pet_image_labels[index])
+        pet_image_labels = [labeled_file for index, labeled_file in enumerate(pet_image_labels)
+                            if representatives[index] == index]
+    
+    # Decode new or changed images into the tensor cache before classifying;
+    # this needs the full listing, so the folder is scanned up front
+    tensor_cache = None
+    if in_arg.tensor_cache and in_arg.server is None and rescore is None:
+        pet_image_labels = list(pet_image_labels)
+        tensor_cache = TensorCache(in_arg.dir, in_arg.tensor_cache_file)
+        with profiling.stage('tensor_cache_update', len(pet_image_labels)):
+            tensor_cache.update([os.path.join(in_arg.dir, filename)
+                                 for filename, _ in pet_image_labels],
+                                prune=in_arg.shard is None,
+                                workers=max(1, in_arg.decode_workers))
+    
+    # Classify the images as they are found, decoding each one once for all
+    # architectures, in this process, spread over --workers processes, or
+    # by a running inference server
+    classify_options = {'batch_size': in_arg.batch_size, 'workers': in_arg.decode_workers,
+                        'prefetch': in_arg.prefetch, 'ordered': not in_arg.unordered,
+                        'cache': cache, 'tensor_cache': tensor_cache}
+    cascade_counts = {}
+    if rescore is not None:
+        classified = rescore_images(rescore, in_arg.models)
+    elif in_arg.server is not None:
+        classified = classify_images_remote(in_arg.server, in_arg.dir, pet_image_labels,
+                                            in_arg.models, in_arg.batch_size)
+    elif in_arg.workers > 1:
+        classified = classify_images_parallel(in_arg.dir, pet_image_labels, in_arg.models,
+                                              in_arg.weights_by_model, in_arg.workers,
+                                              **classify_options)
+    else:
+        classified = classify_images_stream(images_dir, pet_image_labels, in_arg.models,
+                                            in_arg.weights_by_model,
+                                            cascade=in_arg.cascade_options,
+                                            cascade_counts=cascade_counts, **classify_options)
+    
+    # Keep the top-k predictions for a later --rescore when asked
+    writer = None
+    if in_arg.save_predictions:
+        writer = PredictionWriter(in_arg.save_predictions, in_arg.models, TOPK)
+    
+    # One columnar results store per architecture
+    results_dics = {model: ResultsStore() for model in in_arg.models}
+    class_ids = {model: {} for model in in_arg.models}
+    imagenet_classes = get_imagenet_classes() if duplicates else None
+    classify_start = perf_counter()
+    for filename, results, predictions in classified:
+        # Duplicates share the prediction but keep their own pet label
+        labeled = [(filename, results)]
+        for member, pet_label in duplicates.get(filename, ()):
+            labeled.append((member, {model: label_results(pet_label, predictions[model][0][0],
+                                                          imagenet_classes)
+                                     for model in in_arg.models}))
+        
+        for name, name_results in labeled:
+            for model in in_arg.models:
+                results_dics[model][name] = name_results[model]
+                class_ids[model][name] = predictions[model][0][0]
+            if writer is not None:
+                writer.add(name, predictions)
+    
+    if writer is not None:
+        writer.close()
+    
+    # The whole classification, from listing files to the last prediction
+    n_images = len(results_dics[in_arg.models[0]])
+    classify_seconds = perf_counter() - classify_start
+    if profiler is not None:
+        profiler.add('classify', classify_seconds, n_images)
+    
+    if cache is not None:
+        cache.close()
+    if tensor_cache is not None:
+        tensor_cache.close()
+    
+    results_stats_dics = {}
+    for model, results_dic in results_dics.items():
+        # Adjust results to classify labels as dogs or not dogs
+        with profiling.stage('adjust_results4_isadog', len(results_dic)):
+            adjust_results4_isadog(results_dic, in_arg.dogfile, class_ids[model])
+        
+        # Calculate results statistics
+        with profiling.stage('calculates_results_stats', len(results_dic)):
+            results_stats_dics[model] = calculates_results_stats(results_dic)
+        
+        # Print results
+        with profiling.stage('print_results', len(results_dic)):
+            print_results(results_dic, results_stats_dics[model], model)
+    
+    # Compare the architectures when several were run
+    if len(results_stats_dics) > 1:
+        print_comparison(results_stats_dics)
+    
+    # Save mergeable counts so shard runs can be combined later
+    if in_arg.stats_out:
+        save_stats(in_arg.stats_out, {model: StatsAccumulator(results_stats)
+                                      for model, results_stats in results_stats_dics.items()})
+    
+    if cache is not None:
+        print("\nPrediction cache: {} hits, {} misses".format(cache.hits, cache.misses))
+    if in_arg.dedup:
+        print(format_dedup_report(n_images, len(pet_image_labels), dedup_seconds,
+                                  classify_seconds))
+    if cascade_counts:
+        print(format_cascade_counts(in_arg.cascade_options, cascade_counts))
+    if tensor_cache is not None:
+        print("Tensor cache: {} decoded, {} reused".format(tensor_cache.decoded,
+                                                          tensor_cache.reused))
+    
+    # Print and save the profile next to the results
+    tracer.stop()
+    if profiler is not None:
+        report = profiler.report(n_images, worker_processes=in_arg.workers > 1)
+        print(profiling.format_report(report))
+        with open(in_arg.profile, 'w') as f:
+            json.dump(report, f, indent=2)
+        profiling.disable()
     
     # TODO: 0 - Record the end time
     end_time = time()
@@ -61,5 +242,211 @@ def main():
     print(f"\nTotal Time Elapsed: {hours:02d}:{minutes:02d}:{seconds:02d}")
 
 
+def watch_main(in_arg):
+    """
+    Classifies the images of --dir, then keeps the models loaded and every
+    --watch-interval seconds classifies only the files added or modified
+    since, until interrupted. Results and running statistics are kept in the
+    --manifest file, so a restarted watch resumes where it stopped.
+    
+    Args:
+        in_arg (argparse.Namespace): Parsed command-line arguments
+    """
+    manifest = Manifest(in_arg.manifest, in_arg.models,
+                        watch_settings(in_arg.models, in_arg.weights_by_model,
+                                       in_arg.execution_options, in_arg.dogfile,
+                                       in_arg.cascade_options))
+    if manifest.reset:
+        print("{} was made with other settings; classifying every image again".format(
+            in_arg.manifest))
+    
+    cache = None
+    if not in_arg.no_cache:
+        cache = PredictionCache(in_arg.cache_file, in_arg.cache_size,
+                                rebuild=in_arg.rebuild_cache)
+    
+    def classify(labeled_files):
+        return classify_images_stream(in_arg.dir, labeled_files, in_arg.models,
+                                      in_arg.weights_by_model, in_arg.batch_size,
+                                      in_arg.decode_workers, in_arg.prefetch,
+                                      not in_arg.unordered, cache,
+                                      cascade=in_arg.cascade_options)
+    
+    watcher = FolderWatcher(in_arg.dir, manifest, classify, in_arg.dogfile, in_arg.recursive)
+    print("Watching {} every {:g} s (Ctrl+C to stop)".format(in_arg.dir, in_arg.watch_interval))
+    try:
+        first = True
+        while True:
+            start = perf_counter()
+            counts = watcher.refresh()
+            
+            # Report refreshes that found anything, and print the running
+            # statistics whenever they moved
+            moved = counts['added'] or counts['modified'] or counts['deleted']
+            if first or moved or counts['failed'] or counts['pending']:
+                print(format_refresh(counts, perf_counter() - start))
+            if first or moved:
+                for model, accumulator in manifest.stats.items():
+                    print(format_watch_stats(model, accumulator.results_stats_dic()))
+                if in_arg.stats_out:
+                    save_stats(in_arg.stats_out, manifest.stats)
+            first = False
+            sleep(in_arg.watch_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manifest.close()
+        if cache is not None:
+            cache.close()
+
+
+def merge_main(argv=None):
+    """
+    Combines the counts saved by sharded runs (--shard i/N --stats-out FILE)
+    and prints the same summary a single run over the whole folder prints.
+    
+    Args:
+        argv (list): Arguments after 'merge', or None to use sys.argv
+    """
+    merge_arg = get_merge_args(argv)
+    
+    # Sum the raw counts per architecture, then derive the percentages
+    accumulators = merge_stats_files(merge_arg.stats_files)
+    results_stats_dics = {model: accumulator.results_stats_dic()
+                          for model, accumulator in accumulators.items()}
+    
+    # Only the summary is available; per-image results stay with the shards
+    for model, results_stats in results_stats_dics.items():
+        print_results({}, results_stats, model)
+    
+    if len(results_stats_dics) > 1:
+        print_comparison(results_stats_dics)
+    
+    if merge_arg.stats_out:
+        save_stats(merge_arg.stats_out, accumulators)
+
+
+def serve_main(argv=None):
+    """
+    Runs the local inference server until interrupted, keeping the models
+    loaded so clients (check_images.py --server URL) skip the startup cost.
+    
+    Args:
+        argv (list): Arguments after 'serve', or None to use sys.argv
+    """
+    serve_arg = get_serve_args(argv)
+    set_execution_options(serve_arg.execution_options)
+    set_jpeg_draft(serve_arg.draft)
+    
+    server = InferenceServer(serve_arg.models, serve_arg.weights_by_model, serve_arg.dogfile,
+                             serve_arg.max_batch, serve_arg.max_wait_ms,
+                             decode_workers=serve_arg.decode_workers, roots=serve_arg.root)
+    try:
+        asyncio.run(run_server(server, serve_arg.host, serve_arg.port))
+    except KeyboardInterrupt:
+        pass
+
+
+def build_index_main(argv=None):
+    """
+    Embeds every image of a folder with a model's penultimate layer and
+    builds a similarity index over the embeddings.
+    
+    Args:
+        argv (list): Arguments after 'build-index', or None to use sys.argv
+    """
+    build_arg = get_build_index_args(argv)
+    start_time = time()
+    
+    filenames = [filename for filename, _ in iter_pet_labels(build_arg.dir, build_arg.recursive)]
+    meta = write_embeddings(build_arg.out, build_arg.dir, filenames, build_arg.arch,
+                            build_arg.weights, build_arg.batch_size, build_arg.decode_workers)
+    embed_time = time() - start_time
+    
+    try:
+        build_index(build_arg.out, build_arg.index, build_arg.pq_subspaces)
+    except ValueError as e:
+        sys.exit("build-index: {}".format(e))
+    
+    print("Embedded {} images with {} ({} values each) in {:.1f} s".format(
+        meta['count'], meta['arch'], meta['dim'], embed_time))
+    print("Built a {} index in {} in {:.1f} s".format(
+        build_arg.index, build_arg.out, time() - start_time - embed_time))
+
+
+def query_index_main(argv=None):
+    """
+    Prints the indexed images most similar to each given image.
+    
+    Args:
+        argv (list): Arguments after 'query-index', or None to use sys.argv
+    """
+    query_arg = get_query_index_args(argv)
+    
+    try:
+        meta, index = load_index(query_arg.index_dir,
+                                 None if query_arg.index == 'auto' else query_arg.index)
+    except (OSError, ValueError) as e:
+        sys.exit("query-index: {}".format(e))
+    
+    # Embeddings of other weights are not comparable with the stored ones
+    if weights_version(meta['arch'], query_arg.weights) != meta['weights']:
+        sys.exit("query-index: {} was built with other {} weights ({}); pass the same "
+                 "--weights".format(query_arg.index_dir, meta['arch'], meta['weights']))
+    
+    # Queries are embedded with the index's JPEG draft setting; any other
+    # preprocessing difference also makes the embeddings incomparable
+    set_jpeg_draft(meta['preprocess'].endswith('|draft'))
+    if preprocess_config() != meta['preprocess']:
+        sys.exit("query-index: {} was built with other preprocessing ({}, now {}); rebuild "
+                 "it".format(query_arg.index_dir, meta['preprocess'], preprocess_config()))
+    
+    for indices, queries in iter_embeddings(query_arg.images, meta['arch'], query_arg.weights):
+        start = perf_counter()
+        neighbours = index.search(queries, query_arg.topk, query_arg.rerank)
+        search_ms = (perf_counter() - start) * 1000 / len(indices)
+        
+        for i, matches in zip(indices, neighbours):
+            print("\n{} ({:.2f} ms search):".format(query_arg.images[i], search_ms))
+            for filename, similarity in matches:
+                print("  {:.4f}  {}".format(similarity, filename))
+
+
+def pack_main(argv=None):
+    """
+    Packs a folder of images into tar or zip shards that --dir can read
+    without extracting them.
+    
+    Args:
+        argv (list): Arguments after 'pack', or None to use sys.argv
+    """
+    pack_arg = get_pack_args(argv)
+    start_time = time()
+    
+    filenames = sorted(filename for filename, _ in iter_pet_labels(pack_arg.dir,
+                                                                   pack_arg.recursive))
+    shard_paths = pack_archives(pack_arg.dir, filenames, pack_arg.out, pack_arg.prefix,
+                                pack_arg.shard_size_mb, pack_arg.format)
+    
+    print("Packed {} images into {} shards in {:.1f} s; classify them with --dir '{}'".format(
+        len(filenames), len(shard_paths), time() - start_time,
+        os.path.join(pack_arg.out, "{}-*.{}".format(pack_arg.prefix, pack_arg.format))))
+
+
 if __name__ == "__main__":
-    main()
+    # 'check_images.py merge FILE...' combines shard outputs,
+    # 'check_images.py serve' keeps the models loaded for --server clients,
+    # 'build-index' / 'query-index' find visually similar images, and
+    # 'pack' writes a folder into archive shards for --dir
+    if sys.argv[1:2] == ['merge']:
+        merge_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['serve']:
+        serve_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['build-index']:
+        build_index_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['query-index']:
+        query_index_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['pack']:
+        pack_main(sys.argv[2:])
+    else:
+        main()
@@ -10,20 +10,150 @@
 #
 ##
 
+# torch, torchvision and PIL are imported inside the functions that use them
+# so importing this module (and running check_images.py --help) stays fast
 import ast
-from PIL import Image
-import torchvision.transforms as transforms
-from torch.autograd import Variable
-import torchvision.models as models
-from torch import __version__
+import os
+import pickle
+from time import perf_counter
+import profiling
+from model_registry import ARCHITECTURES, get_model
+from image_pipeline import iter_batches
+from preprocessing import get_preprocessor
 
 
-# obtain ImageNet labels - this only needs to be done once
-with open('imagenet1000_clsid_to_human.txt') as imagenet_classes_file:
-    imagenet_classes_dict = ast.literal_eval(imagenet_classes_file.read())
+# ImageNet labels live next to this file; the parsed dictionary is cached in
+# a pickle beside it so later runs skip ast.literal_eval on the text file
+IMAGENET_CLASSES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'imagenet1000_clsid_to_human.txt')
+IMAGENET_CLASSES_CACHE = os.path.splitext(IMAGENET_CLASSES_FILE)[0] + '.pickle'
 
+_imagenet_classes_dict = None
 
-def classifier(img_path, model_name):
+# ImageNet preprocessing applied to every image before classification
+RESIZE_SIZE = 256
+CROP_SIZE = 224
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+
+# Let the JPEG decoder downscale large images while decoding (--draft); off
+# by default so the inputs match torchvision's full-resolution decode
+JPEG_DRAFT = False
+
+# Identifies the preprocessing in cache keys; change it whenever the
+# preprocessing above changes so stale predictions are not reused
+PREPROCESS_CONFIG = "rgb|resize={}|crop={}|mean={}|std={}".format(
+    RESIZE_SIZE, CROP_SIZE, NORM_MEAN, NORM_STD)
+
+# Number of top predictions kept per image
+TOPK = 5
+
+
+def get_imagenet_classes():
+    """
+    Returns the ImageNet class id to label dictionary, loading it on first use.
+    
+    Returns:
+        imagenet_classes_dict - class id to human readable label (dict)
+    """
+    global _imagenet_classes_dict
+    
+    # obtain ImageNet labels - this only needs to be done once
+    if _imagenet_classes_dict is None:
+        _imagenet_classes_dict = _load_imagenet_classes()
+    return _imagenet_classes_dict
+
+
+def _load_imagenet_classes():
+    """
+    Loads the ImageNet labels from the pickle cache, rebuilding it from the
+    text file when it is missing or older than the text file.
+    """
+    try:
+        if os.path.getmtime(IMAGENET_CLASSES_CACHE) >= os.path.getmtime(IMAGENET_CLASSES_FILE):
+            with open(IMAGENET_CLASSES_CACHE, 'rb') as cache_file:
+                return pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    
+    with open(IMAGENET_CLASSES_FILE) as imagenet_classes_file:
+        classes_dict = ast.literal_eval(imagenet_classes_file.read())
+    
+    # A read-only install just parses the text file every time
+    try:
+        with open(IMAGENET_CLASSES_CACHE, 'wb') as cache_file:
+            pickle.dump(classes_dict, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+    
+    return classes_dict
+
+
+def __getattr__(name):
+    """Keeps classifier.imagenet_classes_dict working, loaded on first access."""
+    if name == 'imagenet_classes_dict':
+        return get_imagenet_classes()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def set_jpeg_draft(enabled):
+    """
+    Turns draft decoding of JPEGs on or off for this process (--draft).
+    
+    Parameters:
+        enabled - True decodes JPEGs at a reduced size, faster but not
+                  pixel-identical to the full decode (bool)
+    Returns:
+        None
+    """
+    global JPEG_DRAFT
+    JPEG_DRAFT = bool(enabled)
+
+
+def get_jpeg_draft():
+    """
+    Returns:
+        enabled - whether JPEGs are draft decoded in this process (bool)
+    """
+    return JPEG_DRAFT
+
+
+def preprocess_config():
+    """
+    Identifies the preprocessing currently in use, for cache keys.
+    
+    Returns:
+        config - PREPROCESS_CONFIG, marked when JPEGs are draft decoded (str)
+    """
+    return PREPROCESS_CONFIG + ("|draft" if JPEG_DRAFT else "")
+
+
+def get_image_preprocessor():
+    """
+    Returns the shared preprocessor for the settings above, built on first use.
+    
+    Returns:
+        preprocessor - resize, crop and normalize pipeline (Preprocessor)
+    """
+    return get_preprocessor(RESIZE_SIZE, CROP_SIZE, NORM_MEAN, NORM_STD, JPEG_DRAFT)
+
+
+def preprocess_image(img_path, out=None):
+    """
+    Loads an image and applies the ImageNet preprocessing the models expect.
+    
+    Parameters:
+        img_path - path to the image file, or a binary file object such as
+                   io.BytesIO holding the encoded image (str or file)
+        out - 3x224x224 tensor to write the result into, such as a row of a
+              reusable batch, or None to allocate one (torch.Tensor)
+    Returns:
+        img_tensor - normalized 3x224x224 image tensor, out if given (torch.Tensor)
+    """
+    return get_image_preprocessor()(img_path, out)
+
+
+def classifier(img_path, model_name, weights=None, device='cpu'):
     """
     Classifies images using a pretrained CNN model.
     
@@ -31,55 +161,207 @@ def classifier(img_path, model_name):
         img_path - path to the image file (str)
         model_name - CNN model architecture to use for classification. 
                      Must be one of: resnet, alexnet, vgg (str)
+        weights - path to a local state_dict file to load instead of the
+                  torchvision pretrained weights, for offline use (str)
+        device - torch device to run the model on (str)
     Returns:
         breed - The classifier label as a string
     """
     # check model name is one we can use
-    if model_name not in ['resnet', 'alexnet', 'vgg']:
+    if model_name not in ARCHITECTURES:
         print("Model name '{}' not recognized. Acceptable values: resnet, alexnet, vgg".format(model_name))
         return None
     
-    # Load ONLY the requested model (lazy loading)
-    if model_name == 'resnet':
-        model = models.resnet18(pretrained=True)
-    elif model_name == 'alexnet':
-        model = models.alexnet(pretrained=True)
-    elif model_name == 'vgg':
-        model = models.vgg16(pretrained=True)
-    
-    # Set model to evaluation mode
-    model.eval()
-    
-    # Process image
-    img = Image.open(img_path)
-    
-    # Image preprocessing
-    preprocess = transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], 
-                           std=[0.229, 0.224, 0.225])
-    ])
-    
-    img_tensor = preprocess(img)
-    img_tensor.unsqueeze_(0)
-    
-    # PyTorch pretrained models require the data type to be a variable
-    pytorch_ver = __version__.split('.')
-    
-    # Check for version 0.4.0 or higher
-    if int(pytorch_ver[0]) > 0 or int(pytorch_ver[1]) >= 4:
-        img_tensor = img_tensor
-    else:
-        # Older PyTorch versions
-        data = Variable(img_tensor, volatile=True) if pytorch_ver[0] < '0.4.0' else Variable(img_tensor)
-        img_tensor = data
+    # Fetch the requested model from the registry; it is built and set to
+    # evaluation mode only on the first call, then kept warm
+    model = get_model(model_name, weights, device)
+    
+    # Process image into a batch of one
+    img_tensor = preprocess_image(img_path).unsqueeze_(0).to(device)
     
-    # Apply model to get predictions
-    output = model(img_tensor)
+    # Apply model to get predictions, without recording autograd history
+    import torch
+    with torch.inference_mode():
+        output = model(img_tensor)
     
     # Get the predicted label
-    pred_idx = output.data.numpy().argmax()
+    pred_idx = output.data.cpu().numpy().argmax()
+    
+    return get_imagenet_classes()[pred_idx]
+
+
+def _topk(model, batch, topk):
+    """
+    Runs one forward pass and returns (class_ids, scores) per row of batch,
+    best class first.
+    """
+    import torch
+    
+    # inference_mode skips the autograd bookkeeping no_grad still does
+    with torch.inference_mode():
+        output = model(batch)
+    
+    # Top-k class indices and probabilities per row of the batch
+    scores, class_ids = torch.softmax(output, dim=1).topk(topk, dim=1)
+    return list(zip(class_ids.cpu().tolist(), scores.cpu().tolist()))
+
+
+def predict_tensors(batch, model_name, weights=None, device='cpu', topk=TOPK):
+    """
+    Classifies images that are already preprocessed and stacked, for callers
+    that decode images themselves (such as the inference server).
+    
+    Parameters:
+        batch - NxCxHxW tensor of images from preprocess_image (torch.Tensor)
+        model_name - CNN model architecture to use for classification. 
+                     Must be one of: resnet, alexnet, vgg (str)
+        weights - path to a local state_dict file to load instead of the
+                  torchvision pretrained weights, for offline use (str)
+        device - torch device to run the model on (str)
+        topk - number of classes kept per image (int)
+    Returns:
+        predictions - (class_ids, scores) per row of batch, best class first
+                      (list of tuples of lists)
+    """
+    model = get_model(model_name, weights, device)
+    return _topk(model, batch.to(device), topk)
+
+
+def predict_batch_multi(img_paths, model_names, batch_size=32, weights=None, device='cpu',
+                        workers=0, prefetch=2, ordered=True, topk=TOPK, needed=None,
+                        tensor_cache=None):
+    """
+    Runs batched inference for several architectures, decoding and
+    preprocessing each image only once and fanning the shared batch out to
+    every model.
+    
+    Parameters:
+        img_paths - paths to the image files (list of str)
+        model_names - CNN model architectures to use, each one of: resnet,
+                      alexnet, vgg (list of str)
+        batch_size - number of images per forward pass (int)
+        weights - local state_dict file per architecture, None entries (or
+                  None for all) use the pretrained weights (dict)
+        device - torch device to run the models on (str)
+        workers - number of decode threads, 0 decodes inline (int)
+        prefetch - number of decoded batches queued ahead of the models (int)
+        ordered - True runs batches in img_paths order, False runs each
+                  batch as soon as it is decoded (bool)
+        topk - number of classes kept per image (int)
+        needed - positions in img_paths each architecture must classify, or
+                 None for all of them; images no architecture needs are not
+                 decoded (dict of sets)
+        tensor_cache - memory-mapped cache of decoded images to read batches
+                       from instead of decoding, or None (TensorCache)
+    Returns:
+        predictions - dictionary keyed by architecture of (class_ids, scores)
+                      per image in img_paths order, best class first, with
+                      None for images that were not needed (dict of lists)
+    """
+    weights = weights or {}
+    models = {model_name: get_model(model_name, weights.get(model_name), device)
+              for model_name in model_names}
+    predictions = {model_name: [None] * len(img_paths) for model_name in model_names}
+    
+    # Decode only the images at least one architecture still needs
+    if needed is None:
+        needed = {model_name: range(len(img_paths)) for model_name in model_names}
+    needed = {model_name: set(needed.get(model_name, ())) for model_name in model_names}
+    positions = sorted(set().union(*needed.values()))
+    
+    # Each batch is an NxCxHxW tensor plus the positions list indexes it holds
+    # Batches are written into reused buffers, valid until the next one
+    positioned_paths = [img_paths[i] for i in positions]
+    if tensor_cache is not None:
+        batches = tensor_cache.iter_batches(positioned_paths, batch_size)
+    else:
+        preprocessor = get_image_preprocessor()
+        batches = iter_batches(positioned_paths, profiling.timed_loader(preprocessor),
+                               preprocessor.output_shape, batch_size, workers, prefetch,
+                               ordered)
+    
+    # With --profile, time the waits for decoded batches
+    for batch_indices, batch in profiling.timed_iter('decode_wait', batches):
+        batch_start = perf_counter()
+        indices = [positions[i] for i in batch_indices]
+        batch = batch.to(device)
+        
+        for model_name, model in models.items():
+            # Only the rows this architecture has not classified yet
+            rows = [row for row, index in enumerate(indices) if index in needed[model_name]]
+            if not rows:
+                continue
+            model_batch = batch if len(rows) == len(indices) else batch[rows]
+            
+            with profiling.stage('forward:' + model_name, len(rows)):
+                model_predictions = _topk(model, model_batch, topk)
+            for row, prediction in zip(rows, model_predictions):
+                predictions[model_name][indices[row]] = prediction
+        
+        profiling.images_done([img_paths[index] for index in indices], batch_start)
+    
+    return predictions
+
+
+def predict_batch(img_paths, model_name, batch_size=32, weights=None, device='cpu',
+                  workers=0, prefetch=2, ordered=True, topk=TOPK):
+    """
+    Runs batched inference and keeps the top-k classes with softmax scores
+    for every image. With workers > 0 the images are decoded and
+    preprocessed on a thread pool while the model runs.
+    
+    Parameters:
+        img_paths - paths to the image files (list of str)
+        model_name - CNN model architecture to use for classification. 
+                     Must be one of: resnet, alexnet, vgg (str)
+        batch_size - number of images per forward pass (int)
+        weights - path to a local state_dict file to load instead of the
+                  torchvision pretrained weights, for offline use (str)
+        device - torch device to run the model on (str)
+        workers - number of decode threads, 0 decodes inline (int)
+        prefetch - number of decoded batches queued ahead of the model (int)
+        ordered - True runs batches in img_paths order, False runs each
+                  batch as soon as it is decoded (bool)
+        topk - number of classes kept per image (int)
+    Returns:
+        predictions - (class_ids, scores) per image in the same order as
+                      img_paths, best class first (list of tuples of lists)
+    """
+    predictions = predict_batch_multi(img_paths, [model_name], batch_size,
+                                      {model_name: weights}, device, workers,
+                                      prefetch, ordered, topk)
+    return predictions[model_name]
+
+
+def classify_batch(img_paths, model_name, batch_size=32, weights=None, device='cpu',
+                   workers=0, prefetch=2, ordered=True):
+    """
+    Classifies a list of images, pushing batch_size images through the model
+    per forward pass instead of one at a time. With workers > 0 the images
+    are decoded and preprocessed on a thread pool while the model runs.
+    
+    Parameters:
+        img_paths - paths to the image files (list of str)
+        model_name - CNN model architecture to use for classification. 
+                     Must be one of: resnet, alexnet, vgg (str)
+        batch_size - number of images per forward pass (int)
+        weights - path to a local state_dict file to load instead of the
+                  torchvision pretrained weights, for offline use (str)
+        device - torch device to run the model on (str)
+        workers - number of decode threads, 0 decodes inline (int)
+        prefetch - number of decoded batches queued ahead of the model (int)
+        ordered - True runs batches in img_paths order, False runs each
+                  batch as soon as it is decoded (bool)
+    Returns:
+        labels - classifier labels in the same order as img_paths (list of str)
+    """
+    # check model name is one we can use
+    if model_name not in ARCHITECTURES:
+        print("Model name '{}' not recognized. Acceptable values: resnet, alexnet, vgg".format(model_name))
+        return None
+    
+    predictions = predict_batch(img_paths, model_name, batch_size, weights, device,
+                                workers, prefetch, ordered, topk=1)
     
-    return imagenet_classes_dict[pred_idx]
+    imagenet_classes_dict = get_imagenet_classes()
+    return [imagenet_classes_dict[class_ids[0]] for class_ids, _ in predictions]
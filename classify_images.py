@@ -3,10 +3,34 @@ Module for classifying pet images using a pre-trained CNN model.
 This module processes images and stores classification results.
 """
 
-from classifier import classifier
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 
+import profiling
+from cascade import cascade_name, dog_class_table, escalation_needed
+from classifier import (get_imagenet_classes, get_jpeg_draft, predict_batch_multi,
+                        preprocess_config, set_jpeg_draft)
+from get_pet_labels import pet_label_from_filename
+from image_archives import ArchiveReader
+from model_registry import get_execution_options, model_version, preload, set_execution_options
+from prediction_cache import PredictionCache
+from tensor_cache import TensorCache
 
-def classify_images(images_dir, results_dic, model):
+
+# Settings and open cache of a worker process, set by _init_worker
+_worker_state = {}
+
+# Most files sent to a worker process at a time; smaller folders are split
+# into about CHUNKS_PER_PROCESS chunks per process so every worker gets some
+MAX_CHUNK_SIZE = 256
+CHUNKS_PER_PROCESS = 4
+
+
+def classify_images(images_dir, results_dic, model, weights=None, batch_size=1,
+                    workers=0, prefetch=2, ordered=True, cache=None, tensor_cache=None):
     """
     Classifies the images in results_dic using a pre-trained CNN model.
     
@@ -17,38 +41,492 @@ def classify_images(images_dir, results_dic, model):
         results_dic (dict): Dictionary where keys are filenames and values are lists
                            containing [pet_label] initially
         model (str): Name of CNN model architecture to use
+        weights (str): Local weights file to load instead of the pretrained
+                       weights (default: None)
+        batch_size (int): Number of images per forward pass (default: 1)
+        workers (int): Number of threads decoding images ahead of the model,
+                       0 decodes inline (default: 0)
+        prefetch (int): Number of decoded batches queued ahead of the model
+                        (default: 2)
+        ordered (bool): Build batches in results_dic order so runs are
+                        deterministic (default: True)
+        cache (PredictionCache): On-disk prediction cache checked before any
+                                 image is decoded, or None to always run
+                                 inference (default: None)
+        tensor_cache (TensorCache): Memory-mapped cache of decoded images read
+                                    instead of decoding the files, or None
+                                    (default: None)
     
     Returns:
-        None (modifies results_dic in place)
+        dict: Top-1 ImageNet class id per classified filename, for
+              adjust_results4_isadog (results_dic is modified in place)
     
     Side effects:
         Modifies results_dic so each value becomes:
         [pet_label, classifier_label, match]
         where match is 1 if pet_label is in classifier_label, else 0
     """
-    # Iterate through each image in results_dic
-    for filename in results_dic:
-        # Skip hidden files
-        if filename.startswith("."):
-            continue
-        
-        # Build full image path
-        if images_dir.endswith("/"):
-            full_image_path = images_dir + filename
-        else:
-            full_image_path = images_dir + "/" + filename
-        
-        # Classify the image using the classifier function
-        classifier_label = classifier(full_image_path, model)
+    predictions = classify_images_multi(images_dir, {model: results_dic}, {model: weights},
+                                        batch_size, workers, prefetch, ordered, cache,
+                                        tensor_cache)
+    return {filename: class_ids[0] for filename, (class_ids, _) in predictions[model].items()}
+
+
+def _image_paths(images_dir, filenames):
+    """Joins the filenames to images_dir, or opens them from an ArchiveReader."""
+    if isinstance(images_dir, ArchiveReader):
+        return images_dir.open_images(filenames)
+    if images_dir.endswith("/"):
+        return [images_dir + filename for filename in filenames]
+    return [images_dir + "/" + filename for filename in filenames]
+
+
+def _predict_images(image_paths, model_names, weights, batch_size, workers, prefetch,
+                    ordered, cache, tensor_cache):
+    """
+    Predicts every image with every architecture, answering from the
+    prediction cache where possible and storing new predictions in it.
+    
+    Returns:
+        dict: (top-k class ids, scores) per image in image_paths order,
+              keyed by architecture
+    """
+    # Look up cached predictions before decoding anything
+    predictions = {model: [None] * len(image_paths) for model in model_names}
+    cache_keys = {model: [None] * len(image_paths) for model in model_names}
+    if cache is not None:
+        with profiling.stage('prediction_cache', len(image_paths)):
+            content_hashes = [cache.content_hash(image_path) for image_path in image_paths]
+            config = preprocess_config()
+            for model in model_names:
+                version = model_version(model, weights.get(model))
+                for i, content_hash in enumerate(content_hashes):
+                    cache_keys[model][i] = cache.make_key(content_hash, model, version, config)
+                    predictions[model][i] = cache.get(cache_keys[model][i])
+        # Write the new hashes now; other workers sharing the file must not
+        # wait for this batch's inference
+        cache.commit()
+    
+    # Classify the remaining images in batches; predictions come back in
+    # input order as (top-k class ids, scores)
+    missing = {model: [i for i, prediction in enumerate(predictions[model]) if prediction is None]
+               for model in model_names}
+    if any(missing.values()):
+        new_predictions = predict_batch_multi(image_paths, model_names, batch_size,
+                                              weights, workers=workers,
+                                              prefetch=prefetch, ordered=ordered,
+                                              needed=missing, tensor_cache=tensor_cache)
+        for model in model_names:
+            for i in missing[model]:
+                predictions[model][i] = new_predictions[model][i]
+                if cache is not None:
+                    cache.put(cache_keys[model][i], *predictions[model][i])
+    
+    if cache is not None:
+        cache.commit()
+    
+    return predictions
+
+
+def classify_images_multi(images_dir, results_dics, weights=None, batch_size=1,
+                          workers=0, prefetch=2, ordered=True, cache=None,
+                          tensor_cache=None):
+    """
+    Classifies the images with several CNN model architectures in one pass.
+    
+    Each image is decoded and preprocessed once and the shared tensor is fed
+    to every architecture. Every results_dic is updated the same way
+    classify_images updates its single results_dic.
+    
+    Args:
+        images_dir (str): Path to the folder of pet images
+        results_dics (dict): Dictionary keyed by architecture name whose values
+                             are results_dic dictionaries holding the same
+                             filenames with [pet_label] initially
+        weights (dict): Local weights file per architecture, None entries use
+                        the pretrained weights (default: None)
+        batch_size (int): Number of images per forward pass (default: 1)
+        workers (int): Number of threads decoding images ahead of the models,
+                       0 decodes inline (default: 0)
+        prefetch (int): Number of decoded batches queued ahead of the models
+                        (default: 2)
+        ordered (bool): Build batches in results_dic order so runs are
+                        deterministic (default: True)
+        cache (PredictionCache): On-disk prediction cache checked before any
+                                 image is decoded, or None to always run
+                                 inference (default: None)
+        tensor_cache (TensorCache): Memory-mapped cache of decoded images read
+                                    instead of decoding the files, or None
+                                    (default: None)
+    
+    Returns:
+        dict: Dictionary keyed by architecture of the (top-k class ids,
+              softmax scores) predicted per classified filename, best first
+              (each results_dic is modified in place)
+    """
+    weights = weights or {}
+    model_names = list(results_dics)
+    
+    # Collect the images to classify, skipping hidden files; every
+    # results_dic holds the same filenames
+    filenames = [filename for filename in results_dics[model_names[0]]
+                 if not filename.startswith(".")]
+    
+    # Build full image paths
+    image_paths = _image_paths(images_dir, filenames)
+    
+    # Predictions per architecture in input order as (top-k class ids, scores)
+    predictions = _predict_images(image_paths, model_names, weights, batch_size, workers,
+                                  prefetch, ordered, cache, tensor_cache)
+    
+    imagenet_classes_dict = get_imagenet_classes()
+    predictions_by_file = {model: {} for model in model_names}
+    for model, results_dic in results_dics.items():
+        for filename, prediction in zip(filenames, predictions[model]):
+            # Keep the top-k predictions for the dog lookup and the
+            # predictions file
+            predictions_by_file[model][filename] = prediction
+            
+            # Get pet label (already in results_dic[filename][0])
+            pet_label = results_dic[filename][0]
+            
+            # Update results_dic with classifier label and match
+            results_dic[filename].extend(label_results(pet_label, prediction[0][0],
+                                                       imagenet_classes_dict)[1:])
+    
+    return predictions_by_file
+
+
+def classify_images_cascade(images_dir, results_dic, cascade, weights=None, batch_size=1,
+                            workers=0, prefetch=2, ordered=True, cache=None,
+                            tensor_cache=None, counts=None):
+    """
+    Classifies the images with a confidence-gated cascade of architectures.
+    
+    Every image goes through the first (cheapest) architecture; only the
+    images it is unsure about, per cascade.escalation_needed, go on to the
+    next one, and so on. The last architecture to classify an image
+    decides its label. results_dic is updated the same way classify_images
+    updates it.
+    
+    Args:
+        images_dir (str): Path to the folder of pet images
+        results_dic (dict): Dictionary where keys are filenames and values
+                            are lists containing [pet_label] initially
+        cascade (Cascade): Architectures in order, threshold and dog margin
+        weights (dict): Local weights file per architecture, None entries use
+                        the pretrained weights (default: None)
+        batch_size (int): Number of images per forward pass (default: 1)
+        workers (int): Number of threads decoding images ahead of the models,
+                       0 decodes inline (default: 0)
+        prefetch (int): Number of decoded batches queued ahead of the models
+                        (default: 2)
+        ordered (bool): Build batches in results_dic order so runs are
+                        deterministic (default: True)
+        cache (PredictionCache): On-disk prediction cache, used per
+                                 architecture (default: None)
+        tensor_cache (TensorCache): Memory-mapped cache of decoded images read
+                                    instead of decoding the files, or None
+                                    (default: None)
+        counts (dict): If given, the number of images each architecture
+                       classified is added to it, keyed by architecture
+    
+    Returns:
+        dict: (top-k class ids, softmax scores) of the deciding architecture
+              per classified filename (results_dic is modified in place)
+    """
+    weights = weights or {}
+    filenames = [filename for filename in results_dic if not filename.startswith(".")]
+    image_paths = _image_paths(images_dir, filenames)
+    dog_table = dog_class_table(cascade.dogfile) if cascade.dog_margin > 0 else None
+    
+    # Each stage classifies the images the previous one escalated
+    predictions = [None] * len(image_paths)
+    remaining = list(range(len(image_paths)))
+    for stage, model in enumerate(cascade.models):
+        stage_predictions = _predict_images([image_paths[i] for i in remaining], [model],
+                                            weights, batch_size, workers, prefetch, ordered,
+                                            cache, tensor_cache)[model]
+        if counts is not None:
+            counts[model] = counts.get(model, 0) + len(remaining)
         
-        # Format classifier label
-        classifier_label = classifier_label.lower().strip()
+        last_stage = stage == len(cascade.models) - 1
+        escalated = []
+        for i, prediction in zip(remaining, stage_predictions):
+            predictions[i] = prediction
+            if not last_stage and escalation_needed(prediction, cascade.threshold, dog_table,
+                                                    cascade.dog_margin):
+                escalated.append(i)
+        remaining = escalated
+        if not remaining:
+            break
+    
+    imagenet_classes_dict = get_imagenet_classes()
+    predictions_by_file = {}
+    for filename, prediction in zip(filenames, predictions):
+        predictions_by_file[filename] = prediction
         
-        # Get pet label (already in results_dic[filename][0])
+        # Update results_dic with classifier label and match
         pet_label = results_dic[filename][0]
+        results_dic[filename].extend(label_results(pet_label, prediction[0][0],
+                                                   imagenet_classes_dict)[1:])
+    
+    return predictions_by_file
+
+
+def label_results(pet_label, class_id, imagenet_classes_dict=None):
+    """
+    Formats the classifier label of a top-1 prediction and checks it against
+    the pet label.
+    
+    Args:
+        pet_label (str): Pet label from the image filename
+        class_id (int): Top-1 ImageNet class id
+        imagenet_classes_dict (dict): Class names by id, or None to load them
+    
+    Returns:
+        list: [pet_label, classifier_label, match] where match is 1 if
+              pet_label is in classifier_label, else 0
+    """
+    if imagenet_classes_dict is None:
+        imagenet_classes_dict = get_imagenet_classes()
+    
+    # Format classifier label of the top prediction
+    classifier_label = imagenet_classes_dict[class_id].lower().strip()
+    
+    # Determine if there's a match
+    match = 1 if pet_label in classifier_label else 0
+    
+    return [pet_label, classifier_label, match]
+
+
+def classify_images_stream(images_dir, labeled_files, models, weights=None, batch_size=1,
+                           workers=0, prefetch=2, ordered=True, cache=None,
+                           chunk_size=1024, tensor_cache=None, cascade=None,
+                           cascade_counts=None):
+    """
+    Classifies images as they arrive from a lazy source such as
+    get_pet_labels.iter_pet_labels, so classification starts on the first
+    chunk of files instead of waiting for the whole folder to be listed.
+    
+    Args:
+        images_dir (str or ArchiveReader): Path to the folder of pet images,
+                                           or the reader of labeled_files
+                                           when they come from archives
+        labeled_files (iterable): (filename, pet_label) pairs
+        models (list): Names of the CNN model architectures to use
+        weights (dict): Local weights file per architecture, None entries use
+                        the pretrained weights (default: None)
+        batch_size (int): Number of images per forward pass (default: 1)
+        workers (int): Number of threads decoding images ahead of the models,
+                       0 decodes inline (default: 0)
+        prefetch (int): Number of decoded batches queued ahead of the models
+                        (default: 2)
+        ordered (bool): Build batches in file order so runs are deterministic
+                        (default: True)
+        cache (PredictionCache): On-disk prediction cache checked before any
+                                 image is decoded (default: None)
+        chunk_size (int): Number of files taken from labeled_files and
+                          classified together (default: 1024)
+        tensor_cache (TensorCache): Memory-mapped cache of decoded images read
+                                    instead of decoding the files, or None
+                                    (default: None)
+        cascade (Cascade): Classify with this cascade instead, reported under
+                           cascade_name(cascade), which must be the only
+                           entry of models (default: None)
+        cascade_counts (dict): Images classified per cascade architecture,
+                               updated in place (default: None)
+    
+    Yields:
+        tuple: (filename, results, predictions) where results maps each
+               architecture to [pet_label, classifier_label, match] and
+               predictions maps each architecture to the (top-k class ids,
+               softmax scores) of the image
+    """
+    labeled_files = iter(labeled_files)
+    
+    while True:
+        # Only chunk_size files are held in memory at a time
+        chunk = list(islice(labeled_files, chunk_size))
+        if not chunk:
+            return
         
-        # Determine if there's a match
-        match = 1 if pet_label in classifier_label else 0
+        results_dics = {model: {filename: [pet_label] for filename, pet_label in chunk}
+                        for model in models}
+        if cascade is not None:
+            name = cascade_name(cascade)
+            predictions = {name: classify_images_cascade(
+                images_dir, results_dics[name], cascade, weights, batch_size, workers,
+                prefetch, ordered, cache, tensor_cache, cascade_counts)}
+        else:
+            predictions = classify_images_multi(images_dir, results_dics, weights, batch_size,
+                                                workers, prefetch, ordered, cache, tensor_cache)
         
-        # Update results_dic with classifier label and match
-        results_dic[filename].extend([classifier_label, match])
+        for filename, _ in chunk:
+            yield (filename,
+                   {model: results_dics[model][filename] for model in models},
+                   {model: predictions[model].get(filename) for model in models})
+
+
+def _init_worker(images_dir, models, weights, torch_threads, options, execution_options,
+                 jpeg_draft, cache_settings, tensor_settings=None, profile=False):
+    """
+    Prepares a classify_images_parallel worker process: caps its torch
+    threads so workers do not oversubscribe the cores, loads every model
+    once with the parent's execution options and JPEG decoding, and opens its own connections
+    to the prediction cache and the tensor cache. With profile, the worker
+    records its own stage timings for the parent to merge.
+    """
+    import torch
+    
+    if profile:
+        profiling.enable()
+    torch.set_num_threads(torch_threads)
+    set_execution_options(execution_options)
+    set_jpeg_draft(jpeg_draft)
+    for model in models:
+        preload(model, (weights or {}).get(model))
+    
+    _worker_state.update(images_dir=images_dir, models=models, weights=weights,
+                         options=options, cache=None)
+    if cache_settings is not None:
+        _worker_state['cache'] = PredictionCache(*cache_settings)
+    if tensor_settings is not None:
+        _worker_state['options']['tensor_cache'] = TensorCache(*tensor_settings)
+
+
+def _classify_chunk(chunk):
+    """
+    Classifies one chunk of (filename, pet_label) pairs in a worker process.
+    
+    Returns:
+        tuple: (results, hits, misses, stages) where results lists the
+               classify_images_stream tuples for the chunk, hits/misses
+               are this chunk's prediction cache counts and stages are the
+               profiling timings since the last chunk (None when off)
+    """
+    cache = _worker_state['cache']
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    
+    results = list(classify_images_stream(_worker_state['images_dir'], chunk,
+                                          _worker_state['models'], _worker_state['weights'],
+                                          cache=cache, chunk_size=len(chunk),
+                                          **_worker_state['options']))
+    
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    profiler = profiling.get_profiler()
+    return results, hits, misses, profiler.drain() if profiler is not None else None
+
+
+def classify_images_parallel(images_dir, labeled_files, models, weights=None, processes=2,
+                             batch_size=1, workers=0, prefetch=2, ordered=True, cache=None,
+                             chunk_size=None, tensor_cache=None):
+    """
+    Classifies images across a pool of worker processes, yielding the same
+    results, in the same order, as classify_images_stream.
+    
+    Each worker loads its models once and runs with its share of the CPU
+    threads. Chunks of files are handed out as workers free up, with only a
+    few chunks in flight per worker so memory stays bounded.
+    
+    Args:
+        images_dir (str): Path to the folder of pet images
+        labeled_files (iterable): (filename, pet_label) pairs
+        models (list): Names of the CNN model architectures to use
+        weights (dict): Local weights file per architecture, None entries use
+                        the pretrained weights (default: None)
+        processes (int): Number of worker processes (default: 2)
+        batch_size (int): Number of images per forward pass (default: 1)
+        workers (int): Number of threads decoding images ahead of the models
+                       in each process, 0 decodes inline (default: 0)
+        prefetch (int): Number of decoded batches queued ahead of the models
+                        (default: 2)
+        ordered (bool): Build batches in file order so runs are deterministic
+                        (default: True)
+        cache (PredictionCache): On-disk prediction cache; each worker opens
+                                 its own connection to the same file and the
+                                 hit/miss counts are added to this object
+                                 (default: None)
+        chunk_size (int): Number of files sent to a worker at a time, or
+                          None to size chunks from the number of files
+                          and processes, up to MAX_CHUNK_SIZE (default: None)
+        tensor_cache (TensorCache): Memory-mapped cache of decoded images; each
+                                    worker opens the same files read-only
+                                    (default: None)
+    
+    Yields:
+        tuple: (filename, results, predictions) as from classify_images_stream
+    """
+    labeled_files = iter(labeled_files)
+    if chunk_size is None:
+        # Look ahead far enough to tell whether the files fill
+        # CHUNKS_PER_PROCESS full chunks per process
+        head = list(islice(labeled_files, MAX_CHUNK_SIZE * CHUNKS_PER_PROCESS * processes))
+        chunk_size = max(1, min(MAX_CHUNK_SIZE,
+                                -(-len(head) // (CHUNKS_PER_PROCESS * processes))))
+        labeled_files = chain(head, labeled_files)
+    torch_threads = max(1, (os.cpu_count() or 1) // processes)
+    options = {'batch_size': batch_size, 'workers': workers,
+               'prefetch': prefetch, 'ordered': ordered}
+    cache_settings = None
+    if cache is not None:
+        # Commit so workers see everything written so far
+        cache.commit()
+        cache_settings = (cache.path, cache.max_entries, cache.rebuild)
+    tensor_settings = None
+    if tensor_cache is not None:
+        tensor_settings = (tensor_cache.images_dir, tensor_cache.path)
+    
+    # spawn starts clean interpreters rather than forking torch's thread pools
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(images_dir, models, weights, torch_threads,
+                                       options, get_execution_options(), get_jpeg_draft(),
+                                       cache_settings, tensor_settings,
+                                       profiling.get_profiler() is not None)) as executor:
+        pending = deque()
+        
+        while True:
+            # Keep two chunks per worker queued so none sits idle
+            while len(pending) < 2 * processes:
+                chunk = list(islice(labeled_files, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_classify_chunk, chunk))
+            
+            if not pending:
+                return
+            
+            # Hand results back in submission order
+            results, hits, misses, stages = pending.popleft().result()
+            if cache is not None:
+                cache.hits += hits
+                cache.misses += misses
+            if stages is not None and profiling.get_profiler() is not None:
+                profiling.get_profiler().merge(stages)
+            yield from results
+
+
+def rescore_images(predictions, models):
+    """
+    Rebuilds the classify_images_stream results from saved predictions,
+    recomputing the pet labels and matches without running any model.
+    
+    Args:
+        predictions (iterable): (filename, {model: (class_ids, scores)})
+                                pairs, as prediction_file.load_predictions
+                                returns them
+        models (list): Names of the CNN model architectures to rescore
+    
+    Yields:
+        tuple: (filename, results, predictions) as from classify_images_stream
+    """
+    imagenet_classes_dict = get_imagenet_classes()
+    for filename, image_predictions in predictions:
+        pet_label = pet_label_from_filename(filename)
+        results = {model: label_results(pet_label, image_predictions[model][0][0],
+                                        imagenet_classes_dict)
+                   for model in models}
+        yield filename, results, {model: image_predictions[model] for model in models}
@@ -0,0 +1,200 @@
+"""
+Module for matching labels against the dog names in dognames.txt.
+This module compiles the dog names once into an Aho-Corasick automaton so
+checking whether a label contains any dog name takes time linear in the
+label instead of one substring test per dog name.
+"""
+
+import os
+from collections import deque
+
+
+# Indexes already built in this process keyed by (absolute path, mtime)
+_indexes = {}
+
+# Maximum number of label lookups remembered by each index
+_MEMO_SIZE = 65536
+
+
+class DogNameIndex:
+    """
+    Precompiled set of dog names answering exact and substring queries.
+
+    Attributes:
+        dog_names (frozenset): The dog names the index was built from
+        duplicates (list): Names that appeared more than once in the input
+    """
+
+    def __init__(self, dog_names):
+        """
+        Builds the automaton from the dog names.
+
+        Args:
+            dog_names (iterable): Dog names, one per entry
+        """
+        names = []
+        seen = set()
+        self.duplicates = []
+        for dog_name in dog_names:
+            if dog_name in seen:
+                self.duplicates.append(dog_name)
+                continue
+            seen.add(dog_name)
+            names.append(dog_name)
+
+        self.dog_names = frozenset(names)
+        self._delta, self._accept = self._compile(names)
+        self._memo = {}
+        self._class_tables = {}
+
+    @staticmethod
+    def _compile(names):
+        """
+        Compiles the names into a deterministic Aho-Corasick automaton.
+
+        Returns:
+            tuple: (delta, accept) where delta[state] maps a character to the
+                   next state (missing characters go back to the root) and
+                   accept[state] is True if a dog name ends at that state
+        """
+        # Trie of the names
+        goto = [{}]
+        accept = [False]
+        for name in names:
+            state = 0
+            for ch in name:
+                if ch not in goto[state]:
+                    goto.append({})
+                    accept.append(False)
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            accept[state] = True
+
+        # Breadth-first pass filling in failure transitions so each state's
+        # table is complete and scanning never has to backtrack
+        delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        fail = [0] * len(goto)
+        queue = deque()
+        for state in goto[0].values():
+            queue.append(state)
+
+        while queue:
+            state = queue.popleft()
+            delta[state] = dict(delta[fail[state]])
+            delta[state].update(goto[state])
+            accept[state] = accept[state] or accept[fail[state]]
+
+            for ch, next_state in goto[state].items():
+                fail[next_state] = delta[fail[state]].get(ch, 0)
+                queue.append(next_state)
+
+        return delta, accept
+
+    @classmethod
+    def from_file(cls, dogfile):
+        """
+        Returns the index for a dog names file, building it only the first
+        time the file (at its current modification time) is requested.
+
+        Args:
+            dogfile (str): Path to text file containing dog names (one per line)
+
+        Returns:
+            DogNameIndex: The shared index for that file
+        """
+        key = (os.path.abspath(dogfile), os.stat(dogfile).st_mtime_ns)
+        if key not in _indexes:
+            with open(dogfile, 'r') as f:
+                _indexes[key] = cls(line.rstrip() for line in f)
+        return _indexes[key]
+
+    def is_dog(self, pet_label):
+        """
+        Checks whether a label is exactly one of the dog names.
+
+        Args:
+            pet_label (str): Label to check
+
+        Returns:
+            int: 1 if the label is a dog name, 0 otherwise
+        """
+        return 1 if pet_label in self.dog_names else 0
+
+    def contains_dog_name(self, label):
+        """
+        Checks whether any dog name appears as a substring of a label.
+
+        Args:
+            label (str): Label to scan, such as a classifier label
+
+        Returns:
+            int: 1 if a dog name occurs in the label, 0 otherwise
+        """
+        # Classifier labels repeat heavily, so remember recent answers
+        found = self._memo.get(label)
+        if found is not None:
+            return found
+
+        found = 0
+        delta = self._delta
+        accept = self._accept
+        state = 0
+        if accept[0]:
+            found = 1
+        else:
+            for ch in label:
+                state = delta[state].get(ch, 0)
+                if accept[state]:
+                    found = 1
+                    break
+
+        if len(self._memo) >= _MEMO_SIZE:
+            self._memo.clear()
+        self._memo[label] = found
+        return found
+
+    def class_table(self, class_labels):
+        """
+        Returns a boolean lookup table over class ids telling which classes
+        are dogs, built once per class label mapping.
+
+        Args:
+            class_labels (dict): Class id to classifier label, such as the
+                                 ImageNet imagenet_classes_dict
+
+        Returns:
+            numpy.ndarray: Boolean array where entry i is True if the
+                           lowercased label of class i contains a dog name
+        """
+        import numpy as np
+
+        # Keyed by identity; the mapping is kept alive alongside its table
+        entry = self._class_tables.get(id(class_labels))
+        if entry is not None and entry[0] is class_labels:
+            return entry[1]
+
+        table = np.zeros(max(class_labels) + 1, dtype=bool)
+        for class_id, label in class_labels.items():
+            table[class_id] = self.contains_dog_name(label.lower().strip())
+
+        self._class_tables[id(class_labels)] = (class_labels, table)
+        return table
+
+    def classes_are_dogs(self, class_ids, class_labels):
+        """
+        Classifies a whole batch of predicted class ids as dog or not dog in
+        one array lookup.
+
+        Args:
+            class_ids (array-like): Predicted class ids
+            class_labels (dict): Class id to classifier label mapping the ids
+                                 refer to
+
+        Returns:
+            numpy.ndarray: uint8 array with 1 where the class is a dog
+        """
+        import numpy as np
+
+        table = self.class_table(class_labels)
+        return table[np.asarray(class_ids, dtype=np.intp)].astype(np.uint8)
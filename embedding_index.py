@@ -0,0 +1,282 @@
+"""
+Module for finding the most similar images among stored embeddings.
+This module answers top-k cosine similarity queries over the float16
+matrix written by embeddings.write_embeddings, with two indexes:
+
+    flat  exact brute force: the memory-mapped rows are scanned in chunks
+          (norms are cached by storing unit vectors, so a score is one
+          matrix product) and the best rows kept with argpartition
+    pq    product quantization: every row is compressed to one byte per
+          subspace (e.g. 16 bytes instead of 1 KB for resnet), candidates
+          are scored from per-query lookup tables, and the best few are
+          re-ranked exactly against the float16 rows
+
+The PQ codebooks and codes are saved next to the embeddings:
+
+    <index dir>/pq_centroids.npy   subspaces x centroids x sub-dim float32
+    <index dir>/pq_codes.npy       count x subspaces uint8 (memory-mapped)
+"""
+
+import os
+
+from embeddings import load_embeddings
+
+
+INDEX_KINDS = ('flat', 'pq')
+
+PQ_CENTROIDS_FILE = 'pq_centroids.npy'
+PQ_CODES_FILE = 'pq_codes.npy'
+
+# Rows scored per step, bounding the temporary float32 arrays
+_CHUNK_ROWS = 1 << 16
+
+# Vectors the PQ codebooks are trained on, sampled from the rows
+_PQ_TRAIN_ROWS = 50000
+
+
+def _top_k(scores, k):
+    """Returns the indices of the k highest scores, best first."""
+    import numpy as np
+
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class FlatIndex:
+    """
+    Exact top-k search by scanning every stored embedding.
+
+    Attributes:
+        filenames (list): Image filename per row
+        embeddings (numpy.memmap): count x dim float16 unit vectors
+    """
+
+    def __init__(self, filenames, embeddings):
+        self.filenames = filenames
+        self.embeddings = embeddings
+
+    def search(self, queries, k=5, rerank=None):
+        """
+        Finds the rows most similar to each query.
+
+        Args:
+            queries (numpy.ndarray): n x dim float32 unit vectors
+            k (int): Number of neighbours per query (default: 5)
+            rerank (int): Unused; every score is already exact
+
+        Returns:
+            list: Per query, a list of (filename, cosine similarity), best first
+        """
+        import numpy as np
+
+        queries = np.asarray(queries, dtype=np.float32)
+        best_rows = [np.empty(0, dtype=np.intp)] * len(queries)
+        best_scores = [np.empty(0, dtype=np.float32)] * len(queries)
+
+        # Keep the running best k of every query across chunks
+        for start in range(0, len(self.embeddings), _CHUNK_ROWS):
+            chunk = np.asarray(self.embeddings[start:start + _CHUNK_ROWS], dtype=np.float32)
+            chunk_scores = queries @ chunk.T
+            for q in range(len(queries)):
+                rows = np.concatenate([best_rows[q], start + np.arange(len(chunk))])
+                scores = np.concatenate([best_scores[q], chunk_scores[q]])
+                keep = _top_k(scores, k)
+                best_rows[q], best_scores[q] = rows[keep], scores[keep]
+
+        return [[(self.filenames[row], float(score)) for row, score in zip(rows, scores)]
+                for rows, scores in zip(best_rows, best_scores)]
+
+
+def _kmeans(vectors, k, iterations, rng):
+    """Lloyd's k-means; returns k x dim float32 centroids."""
+    import numpy as np
+
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(vectors, centroids)
+        for c in range(k):
+            members = vectors[assignment == c]
+            # An empty cluster restarts from a random vector
+            centroids[c] = members.mean(axis=0) if len(members) else vectors[rng.integers(len(vectors))]
+    return centroids
+
+
+def _nearest(vectors, centroids):
+    """Index of the nearest centroid (squared L2) of every vector."""
+    import numpy as np
+
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.intp)
+    for start in range(0, len(vectors), _CHUNK_ROWS):
+        chunk = vectors[start:start + _CHUNK_ROWS]
+        distances = centroid_norms[None, :] - 2 * chunk @ centroids.T
+        assignment[start:start + len(chunk)] = distances.argmin(axis=1)
+    return assignment
+
+
+class PQIndex:
+    """
+    Approximate top-k search over product-quantized embeddings, with exact
+    re-ranking of the best candidates.
+
+    Attributes:
+        filenames (list): Image filename per row
+        embeddings (numpy.memmap): count x dim float16 unit vectors
+        centroids (numpy.ndarray): subspaces x centroids x sub-dim float32
+        codes (numpy.ndarray): count x subspaces uint8 centroid ids
+    """
+
+    def __init__(self, filenames, embeddings, centroids, codes):
+        self.filenames = filenames
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.codes = codes
+
+    @classmethod
+    def train(cls, filenames, embeddings, subspaces=None, iterations=20, seed=0):
+        """
+        Learns the codebooks on a sample of the rows and encodes every row.
+
+        Args:
+            filenames (list): Image filename per row
+            embeddings (numpy.ndarray): count x dim float16 unit vectors
+            subspaces (int): Number of subspaces (bytes per row); must divide
+                             dim, or None for dim / 32 (default: None)
+            iterations (int): k-means iterations per subspace (default: 20)
+            seed (int): Seed of the training sample and initial centroids
+
+        Returns:
+            PQIndex: The trained index
+
+        Raises:
+            ValueError: If subspaces does not divide the embedding size
+        """
+        import numpy as np
+
+        count, dim = embeddings.shape
+        subspaces = subspaces or max(1, dim // 32)
+        if dim % subspaces:
+            raise ValueError("{} subspaces do not divide the embedding size {}".format(
+                subspaces, dim))
+        sub_dim = dim // subspaces
+        n_centroids = min(256, count)
+
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(count, min(count, _PQ_TRAIN_ROWS), replace=False))
+        train = np.asarray(embeddings[sample], dtype=np.float32)
+
+        centroids = np.stack([
+            _kmeans(np.ascontiguousarray(train[:, s * sub_dim:(s + 1) * sub_dim]),
+                    n_centroids, iterations, rng)
+            for s in range(subspaces)])
+
+        codes = np.empty((count, subspaces), dtype=np.uint8)
+        for start in range(0, count, _CHUNK_ROWS):
+            chunk = np.asarray(embeddings[start:start + _CHUNK_ROWS], dtype=np.float32)
+            for s in range(subspaces):
+                codes[start:start + len(chunk), s] = _nearest(
+                    chunk[:, s * sub_dim:(s + 1) * sub_dim], centroids[s])
+        return cls(filenames, embeddings, centroids, codes)
+
+    def save(self, index_dir):
+        """Writes the codebooks and codes next to the embeddings."""
+        import numpy as np
+
+        np.save(os.path.join(index_dir, PQ_CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(index_dir, PQ_CODES_FILE), self.codes)
+
+    def search(self, queries, k=5, rerank=10):
+        """
+        Finds the rows most similar to each query.
+
+        Args:
+            queries (numpy.ndarray): n x dim float32 unit vectors
+            k (int): Number of neighbours per query (default: 5)
+            rerank (int): Candidates per neighbour scored exactly, trading
+                          speed for recall (default: 10)
+
+        Returns:
+            list: Per query, a list of (filename, cosine similarity), best first
+        """
+        import numpy as np
+
+        queries = np.asarray(queries, dtype=np.float32)
+        subspaces, _, sub_dim = self.centroids.shape
+        subspace_ids = np.arange(subspaces)
+
+        results = []
+        for query in queries:
+            # Dot product of each query piece with every centroid, so a row's
+            # approximate score is a sum of table lookups
+            tables = np.einsum('scd,sd->sc', self.centroids, query.reshape(subspaces, sub_dim))
+            approximate = np.empty(len(self.codes), dtype=np.float32)
+            for start in range(0, len(self.codes), _CHUNK_ROWS):
+                codes = np.asarray(self.codes[start:start + _CHUNK_ROWS])
+                approximate[start:start + len(codes)] = tables[subspace_ids, codes].sum(axis=1)
+
+            # Exact scores for the best candidates only
+            candidates = np.sort(_top_k(approximate, k * max(1, rerank)))
+            exact = np.asarray(self.embeddings[candidates], dtype=np.float32) @ query
+            best = _top_k(exact, k)
+            results.append([(self.filenames[candidates[i]], float(exact[i])) for i in best])
+        return results
+
+
+def build_index(index_dir, kind='flat', subspaces=None):
+    """
+    Prepares an index over the embeddings in index_dir.
+
+    Args:
+        index_dir (str): Folder written by embeddings.write_embeddings
+        kind (str): One of INDEX_KINDS (default: 'flat')
+        subspaces (int): PQ subspaces, or None for the default
+
+    Returns:
+        FlatIndex or PQIndex: The index, saved to index_dir for pq
+    """
+    _, filenames, embeddings = load_embeddings(index_dir)
+    if kind == 'pq':
+        index = PQIndex.train(filenames, embeddings, subspaces)
+        index.save(index_dir)
+        return index
+
+    # Codes of an earlier pq build would no longer match the rows
+    for name in (PQ_CENTROIDS_FILE, PQ_CODES_FILE):
+        if os.path.exists(os.path.join(index_dir, name)):
+            os.remove(os.path.join(index_dir, name))
+    return FlatIndex(filenames, embeddings)
+
+
+def load_index(index_dir, kind=None):
+    """
+    Opens an index without reading the rows or codes into memory.
+
+    Args:
+        index_dir (str): Folder written by embeddings.write_embeddings
+        kind (str): 'flat', 'pq', or None for pq when its codes were built
+
+    Returns:
+        tuple: (meta, index) with the embeddings' meta.json contents
+
+    Raises:
+        ValueError: If kind is 'pq' and build_index was not run with pq
+    """
+    import numpy as np
+
+    meta, filenames, embeddings = load_embeddings(index_dir)
+    codes_path = os.path.join(index_dir, PQ_CODES_FILE)
+    if kind is None:
+        kind = 'pq' if os.path.exists(codes_path) else 'flat'
+    if kind == 'flat':
+        return meta, FlatIndex(filenames, embeddings)
+
+    if not os.path.exists(codes_path):
+        raise ValueError("{} has no PQ codes; build it with --index pq".format(index_dir))
+    codes = np.load(codes_path, mmap_mode='r')
+    if len(codes) != len(filenames):
+        raise ValueError("{} PQ codes are out of date; build the index again".format(index_dir))
+    centroids = np.load(os.path.join(index_dir, PQ_CENTROIDS_FILE))
+    return meta, PQIndex(filenames, embeddings, centroids, codes)
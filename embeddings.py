@@ -0,0 +1,149 @@
+"""
+Module for extracting image embeddings from the CNN models.
+This module captures the penultimate-layer features of resnet18 (512 values,
+after global pooling), alexnet and vgg16 (4096 values, the last hidden
+fully-connected layer) in batches, L2-normalizes them so a dot product is
+the cosine similarity, and stores them in a float16 memory-mapped matrix:
+
+    <index dir>/embeddings.f16   N x dim float16 rows
+    <index dir>/filenames.txt    one filename per row
+    <index dir>/meta.json        arch, dim, count and how they were computed
+
+Rows are appended batch by batch, so folders far larger than memory can be
+embedded.
+"""
+
+import json
+import os
+
+from classifier import get_image_preprocessor, preprocess_config
+from execution_options import DEFAULT_OPTIONS
+from image_pipeline import iter_batches
+from model_registry import get_model, weights_version
+
+
+# Module whose input is the embedding, per architecture
+EMBEDDING_LAYERS = {
+    'resnet': 'fc',
+    'alexnet': 'classifier.6',
+    'vgg': 'classifier.6',
+}
+
+EMBEDDINGS_FILE = 'embeddings.f16'
+FILENAMES_FILE = 'filenames.txt'
+META_FILE = 'meta.json'
+
+
+def iter_embeddings(img_paths, model_name, weights=None, batch_size=32, workers=4,
+                    prefetch=2, device='cpu'):
+    """
+    Yields L2-normalized embeddings of images, batch by batch.
+
+    The model is the shared fp32 eager instance: the execution options that
+    trace or compile a model would hide the layer the features are read from.
+
+    Args:
+        img_paths (list): Paths to the image files
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Local state_dict file, or None for the pretrained
+                       weights (default: None)
+        batch_size (int): Number of images per forward pass (default: 32)
+        workers (int): Threads decoding images ahead of the model (default: 4)
+        prefetch (int): Decoded batches queued ahead of the model (default: 2)
+        device (str): Torch device to run the model on (default: 'cpu')
+
+    Yields:
+        tuple: (indices, embeddings) where indices lists positions in
+               img_paths and embeddings is a len(indices) x dim float32
+               numpy array
+    """
+    import torch
+
+    model = get_model(model_name, weights, device, options=DEFAULT_OPTIONS)
+    layer = model.get_submodule(EMBEDDING_LAYERS[model_name])
+
+    # The layer's input is the embedding; the logits are discarded
+    captured = []
+    handle = layer.register_forward_pre_hook(lambda module, inputs: captured.append(inputs[0]))
+    try:
+        preprocessor = get_image_preprocessor()
+        for indices, batch in iter_batches(img_paths, preprocessor, preprocessor.output_shape,
+                                           batch_size, workers, prefetch):
+            captured.clear()
+            with torch.inference_mode():
+                model(batch.to(device))
+                features = torch.nn.functional.normalize(captured[0].flatten(1).float(), dim=1)
+            yield indices, features.cpu().numpy()
+    finally:
+        handle.remove()
+
+
+def write_embeddings(index_dir, images_dir, filenames, model_name, weights=None,
+                     batch_size=32, workers=4, prefetch=2, device='cpu'):
+    """
+    Embeds images and writes the float16 matrix, filenames and metadata.
+
+    Args:
+        index_dir (str): Folder to write to, created if needed; existing
+                         embeddings in it are replaced
+        images_dir (str): Folder the filenames are relative to
+        filenames (list): Image filenames to embed, in row order
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Local state_dict file, or None for the pretrained
+                       weights (default: None)
+        batch_size (int): Number of images per forward pass (default: 32)
+        workers (int): Threads decoding images ahead of the model (default: 4)
+        prefetch (int): Decoded batches queued ahead of the model (default: 2)
+        device (str): Torch device to run the model on (default: 'cpu')
+
+    Returns:
+        dict: The metadata written to meta.json
+    """
+    import numpy as np
+
+    os.makedirs(index_dir, exist_ok=True)
+    img_paths = [os.path.join(images_dir, filename) for filename in filenames]
+
+    # Batches come back in order, so rows are appended as they are computed
+    dim = 0
+    with open(os.path.join(index_dir, EMBEDDINGS_FILE), 'wb') as f:
+        for _, embeddings in iter_embeddings(img_paths, model_name, weights, batch_size,
+                                             workers, prefetch, device):
+            dim = embeddings.shape[1]
+            f.write(embeddings.astype(np.float16).tobytes())
+
+    with open(os.path.join(index_dir, FILENAMES_FILE), 'w') as f:
+        f.writelines(filename + '\n' for filename in filenames)
+
+    meta = {'arch': model_name, 'weights': weights_version(model_name, weights),
+            'preprocess': preprocess_config(), 'layer': EMBEDDING_LAYERS[model_name],
+            'dim': dim, 'count': len(filenames), 'images_dir': images_dir}
+    with open(os.path.join(index_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def load_embeddings(index_dir):
+    """
+    Opens embeddings written by write_embeddings without reading them in.
+
+    Args:
+        index_dir (str): Folder holding the embeddings
+
+    Returns:
+        tuple: (meta, filenames, embeddings) where embeddings is a read-only
+               count x dim float16 numpy memmap
+    """
+    import numpy as np
+
+    with open(os.path.join(index_dir, META_FILE)) as f:
+        meta = json.load(f)
+    with open(os.path.join(index_dir, FILENAMES_FILE)) as f:
+        filenames = f.read().splitlines()
+
+    shape = (meta['count'], meta['dim'])
+    if meta['count'] == 0:
+        return meta, filenames, np.empty(shape, dtype=np.float16)
+    embeddings = np.memmap(os.path.join(index_dir, EMBEDDINGS_FILE), dtype=np.float16,
+                           mode='r', shape=shape)
+    return meta, filenames, embeddings
@@ -0,0 +1,111 @@
+"""
+Module for choosing how the CNN models execute on the CPU.
+This module describes the numeric precision and graph optimizations a model
+is built with (dynamic int8 quantization of the linear layers, channels-last
+memory format, TorchScript tracing, torch.compile) and applies them when the
+model registry loads a network.
+"""
+
+from collections import namedtuple
+
+
+# --precision values: fp32 runs the models as trained, int8 quantizes the
+# weights of the Linear layers (the bulk of alexnet and vgg16) on load
+PRECISIONS = ('fp32', 'int8')
+
+# --optimize values, applied in this order
+OPTIMIZATIONS = ('channels_last', 'jit', 'compile')
+
+# How a model is executed: precision is one of PRECISIONS and optimize a
+# tuple of OPTIMIZATIONS
+ExecutionOptions = namedtuple('ExecutionOptions', ['precision', 'optimize'])
+
+DEFAULT_OPTIONS = ExecutionOptions('fp32', ())
+
+
+def parse_execution_options(precision='fp32', optimize='none'):
+    """
+    Builds ExecutionOptions from the --precision and --optimize values.
+
+    Args:
+        precision (str): One of PRECISIONS
+        optimize (str): Comma-separated OPTIMIZATIONS, or 'none'
+
+    Returns:
+        ExecutionOptions: The options, with optimizations in OPTIMIZATIONS order
+
+    Raises:
+        ValueError: If a value is not recognized, or both jit and compile
+                    are requested
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Precision '{}' not recognized. Acceptable values: {}".format(
+            precision, ", ".join(PRECISIONS)))
+
+    names = set()
+    if optimize and optimize != 'none':
+        names = {name.strip() for name in optimize.split(',') if name.strip()}
+    unknown = names.difference(OPTIMIZATIONS)
+    if unknown:
+        raise ValueError("Optimization '{}' not recognized. Acceptable values: none, {}".format(
+            sorted(unknown)[0], ", ".join(OPTIMIZATIONS)))
+    if {'jit', 'compile'} <= names:
+        raise ValueError("Use either jit or compile, not both")
+
+    return ExecutionOptions(precision, tuple(name for name in OPTIMIZATIONS if name in names))
+
+
+def options_tag(options):
+    """
+    Describes execution options in one string, for cache keys and reports.
+
+    Args:
+        options (ExecutionOptions): The options
+
+    Returns:
+        str: For example 'fp32' or 'int8+channels_last+jit'
+    """
+    return '+'.join((options.precision,) + tuple(options.optimize))
+
+
+def apply_execution_options(model, options, device='cpu'):
+    """
+    Converts an evaluation-mode model to run with the given options.
+
+    Args:
+        model (torch.nn.Module): Model in evaluation mode with its weights loaded
+        options (ExecutionOptions): Precision and optimizations to apply
+        device (str): Torch device the model lives on
+
+    Returns:
+        torch.nn.Module: The converted model (possibly a new object)
+
+    Raises:
+        ValueError: If int8 is requested on a device other than the CPU
+    """
+    import torch
+
+    from classifier import CROP_SIZE
+
+    if options.precision == 'int8':
+        # Dynamic quantization only has CPU kernels
+        if torch.device(device).type != 'cpu':
+            raise ValueError("int8 precision is only available on the CPU")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    # Convolutions pick the memory format up from their weights, so inputs
+    # need no conversion
+    memory_format = torch.contiguous_format
+    if 'channels_last' in options.optimize:
+        memory_format = torch.channels_last
+        model = model.to(memory_format=memory_format)
+
+    if 'jit' in options.optimize:
+        example = torch.zeros(1, 3, CROP_SIZE, CROP_SIZE, device=device)
+        example = example.contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            model = torch.jit.freeze(torch.jit.trace(model, example))
+    elif 'compile' in options.optimize:
+        model = torch.compile(model)
+
+    return model
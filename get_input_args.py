@@ -5,19 +5,132 @@ classification program.
 """
 
 import argparse
+import os
+
+from cascade import cascade_name, parse_cascade
+from dedup import DEFAULT_MAX_DISTANCE
+from embedding_index import INDEX_KINDS
+from image_archives import (ARCHIVE_FORMATS, DEFAULT_SHARD_SIZE_MB, archive_paths,
+                            is_archive_source)
+from inference_client import check_server_models, check_server_url
+from inference_server import DEFAULT_HOST, DEFAULT_PORT, is_loopback
+from execution_options import PRECISIONS, parse_execution_options
+from model_registry import ARCHITECTURES, parse_model_names, parse_weights
+from prediction_cache import DEFAULT_CACHE_FILE, DEFAULT_MAX_ENTRIES
+from tensor_cache import DEFAULT_TENSOR_CACHE_FILE
+from watch_folder import DEFAULT_MANIFEST_FILE
+
+
+def parse_shard(value):
+    """
+    Parses a --shard value of the form i/N.
+    
+    Args:
+        value (str): Shard index and count, e.g. '0/4' for the first of four
+    
+    Returns:
+        tuple: (shard_index, shard_count) as integers
+    
+    Raises:
+        argparse.ArgumentTypeError: If the value is malformed or out of range
+    """
+    try:
+        shard_index, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got '{}'".format(value)) from None
+    
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError("shard index must be in 0..N-1, got '{}'".format(value))
+    
+    return shard_index, shard_count
+
+
+def parse_loopback_host(value):
+    """
+    Parses a --host value, allowing only addresses on this machine.
+    
+    Args:
+        value (str): Host name or IP address to bind
+    
+    Returns:
+        str: The host, unchanged
+    
+    Raises:
+        argparse.ArgumentTypeError: If the host is not a loopback address
+    """
+    if not is_loopback(value):
+        raise argparse.ArgumentTypeError("the server only listens on localhost, got '{}'".format(value))
+    return value
 
 
 def get_input_args():
     """
     Parses and returns command-line arguments.
     
-    Creates an ArgumentParser object that accepts three command-line arguments:
-    - --dir: Path to the folder of pet images (default: 'pet_images/')
-    - --arch: CNN model architecture to use (default: 'resnet')
+    Creates an ArgumentParser object that accepts these command-line arguments:
+    - --dir: Path to the folder of pet images, or a tar/zip archive or glob
+      of archive shards (default: 'pet_images/')
+    - --recursive: Also classify images in subfolders of --dir (default: off)
+    - --arch: CNN model architecture to use, a comma-separated list such as
+      'resnet,alexnet,vgg', or 'all' (default: 'resnet')
     - --dogfile: Text file containing valid dog names (default: 'dognames.txt')
+    - --weights: Local model weights file for offline use, or arch=path
+      pairs when running several architectures (default: None)
+    - --batch-size: Number of images per forward pass (default: 32)
+    - --workers: Number of classification processes (default: 1)
+    - --decode-workers: Threads decoding images ahead of the model (default: 4)
+    - --prefetch: Decoded batches queued ahead of the model (default: 2)
+    - --unordered: Run batches in decode completion order (default: off)
+    - --no-cache: Skip the on-disk prediction cache (default: off)
+    - --rebuild-cache: Reclassify every image and overwrite its cache entry
+    - --cache-file: Prediction cache file (default: '.prediction_cache.sqlite')
+    - --cache-size: Predictions kept in the cache (default: 100000)
+    - --tensor-cache: Keep decoded images in a memory-mapped file and reuse
+      them on later runs (default: off)
+    - --tensor-cache-file: Tensor cache data file (default: '.tensor_cache-'
+      and a hash of --dir, in the working directory)
+    - --dedup: Classify one image per group of duplicate or near-duplicate
+      photos and share its prediction with the group (default: off)
+    - --dedup-distance: Most bits in which the perceptual hashes of
+      duplicates may differ (default: 4)
+    - --shard: Classify only shard i of N of the folder, as 'i/N' (default: None)
+    - --stats-out: Write mergeable per-architecture counts to a JSON file
+    - --save-predictions: Write the top-k class ids and scores of every
+      image to a binary file (default: None)
+    - --rescore: Recompute labels, matches, dog checks and statistics from
+      a --save-predictions file without loading any model (default: None)
+    - --server: Classify through a running 'check_images.py serve' at this
+      localhost URL instead of loading the models (default: None)
+    - --cascade: Run architectures as a cascade, cheapest first, such as
+      'alexnet,vgg', instead of --arch (default: None)
+    - --cascade-threshold: Top-1 confidence below which an image goes on
+      to the next architecture of the cascade (default: 0.5)
+    - --cascade-dog-margin: Also escalate when the dog / not-dog split of
+      the top-k confidence is within this fraction, 0 disables (default: 0.2)
+    - --watch: Keep running and classify only images added to or changed in
+      --dir since the last refresh (default: off)
+    - --watch-interval: Seconds between refreshes in --watch mode (default: 2)
+    - --manifest: File recording the results and running statistics of
+      --watch mode (default: '.watch_manifest.sqlite')
+    - --profile: Time every stage and image and write the report as JSON to
+      this file, with a summary printed after the results (default: None)
+    - --cprofile: Write cProfile stats of the run to this file (default: None)
+    - --torch-trace: Write a torch profiler Chrome trace of the run to this
+      file (default: None)
+    - --draft: Decode JPEGs at a reduced size, faster but not identical to
+      a full decode (default: off)
+    - --precision: fp32, or int8 for dynamically quantized linear layers
+      (default: 'fp32')
+    - --optimize: 'none' or a comma-separated list of channels_last, jit,
+      compile (default: 'none')
     
     Returns:
-        argparse.Namespace: An object containing the parsed arguments
+        argparse.Namespace: An object containing the parsed arguments, plus
+        models (list of architectures expanded from --arch, or the cascade's
+        name), weights_by_model (weights file per architecture from
+        --weights), execution_options (ExecutionOptions from --precision and
+        --optimize), cascade_options (Cascade from --cascade, or None) and
+        archives (archive files named by --dir, or None for a folder)
     """
     parser = argparse.ArgumentParser(
         description='Image Classification for a City Dog Show'
@@ -27,14 +140,398 @@ def get_input_args():
         '--dir',
         type=str,
         default='pet_images/',
-        help='path to the folder of pet images'
+        help="path to the folder of pet images, or a tar/zip archive or a quoted glob of "
+             "archive shards such as 'shards/pets-*.tar'"
+    )
+    
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='also classify images in subfolders of --dir'
     )
     
     parser.add_argument(
         '--arch',
         type=str,
         default='resnet',
-        help='CNN model architecture to use: resnet, alexnet, or vgg'
+        help="CNN model architecture to use: resnet, alexnet, vgg, a comma-separated list, or 'all'"
+    )
+    
+    parser.add_argument(
+        '--dogfile',
+        type=str,
+        default='dognames.txt',
+        help='text file that contains valid dog names'
+    )
+    
+    parser.add_argument(
+        '--weights',
+        type=str,
+        default=None,
+        help='local state_dict file to load instead of downloading the pretrained weights '
+             '(use arch=path,arch=path with several architectures)'
+    )
+    
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=32,
+        help='number of images classified per forward pass'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes classifying images in parallel, each with its own copy of the models'
+    )
+    
+    parser.add_argument(
+        '--decode-workers',
+        type=int,
+        default=4,
+        help='number of threads decoding images ahead of the model in each process (0 decodes inline)'
+    )
+    
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=2,
+        help='number of decoded batches queued ahead of the model'
+    )
+    
+    parser.add_argument(
+        '--unordered',
+        action='store_true',
+        help='run each batch as soon as it is decoded instead of in the deterministic file order'
+    )
+    
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='do not read or write the on-disk prediction cache'
+    )
+    
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        help='ignore cached predictions, reclassify every image and overwrite its entry'
+    )
+    
+    parser.add_argument(
+        '--cache-file',
+        type=str,
+        default=DEFAULT_CACHE_FILE,
+        help='path to the on-disk prediction cache'
+    )
+    
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help='maximum number of predictions kept in the cache before the least recently used are evicted'
+    )
+    
+    parser.add_argument(
+        '--tensor-cache',
+        action='store_true',
+        help='decode each image once into a memory-mapped file and read it from there on later runs'
+    )
+    
+    parser.add_argument(
+        '--tensor-cache-file',
+        type=str,
+        default=None,
+        help="path to the tensor cache data file (default: '{}-' and a hash of --dir, "
+             "in the working directory)".format(DEFAULT_TENSOR_CACHE_FILE)
+    )
+    
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help='hash every image from a small decode and classify only one image per group of '
+             'duplicates (re-uploads, resized copies), copying its prediction to the others'
+    )
+    
+    parser.add_argument(
+        '--dedup-distance',
+        type=int,
+        default=DEFAULT_MAX_DISTANCE,
+        help='most of the 64 perceptual hash bits that may differ between duplicates; '
+             '0 only groups identical hashes'
+    )
+    
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        default=None,
+        help="classify only shard i of N of the folder, given as 'i/N' with i counted from 0"
+    )
+    
+    parser.add_argument(
+        '--stats-out',
+        type=str,
+        default=None,
+        help="write the run's per-architecture counts to this JSON file for 'check_images.py merge'"
+    )
+    
+    parser.add_argument(
+        '--save-predictions',
+        type=str,
+        default=None,
+        help='write the top-k class ids and scores of every image to this binary file for --rescore'
+    )
+    
+    parser.add_argument(
+        '--rescore',
+        type=str,
+        default=None,
+        help='recompute the results from a --save-predictions file instead of classifying '
+             '(no model is loaded; --dir, --arch and the classification options are ignored)'
+    )
+    
+    parser.add_argument(
+        '--server',
+        type=str,
+        default=None,
+        help="classify through a running 'check_images.py serve' at this URL, "
+             "e.g. http://127.0.0.1:{} (up to --batch-size requests in flight)".format(DEFAULT_PORT)
+    )
+    
+    parser.add_argument(
+        '--cascade',
+        type=str,
+        default=None,
+        help="classify with a cascade of architectures, cheapest first, e.g. 'alexnet,vgg': "
+             "each image only goes on to the next one when the previous one is unsure "
+             "(replaces --arch)"
+    )
+    
+    parser.add_argument(
+        '--cascade-threshold',
+        type=float,
+        default=0.5,
+        help='escalate an image when its top-1 softmax score is below this value'
+    )
+    
+    parser.add_argument(
+        '--cascade-dog-margin',
+        type=float,
+        default=0.2,
+        help='also escalate when the top-k scores on dog and non-dog classes differ by less '
+             'than this fraction of their sum; 0 disables the check'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='keep the models loaded and classify only the images added to or changed in '
+             '--dir since the last refresh, updating the statistics, until interrupted'
+    )
+    
+    parser.add_argument(
+        '--watch-interval',
+        type=float,
+        default=2.0,
+        help='seconds between two scans of --dir in --watch mode'
+    )
+    
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        default=DEFAULT_MANIFEST_FILE,
+        help='SQLite file recording the classified files, their results and the running '
+             'statistics in --watch mode'
+    )
+    
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default=None,
+        help='time every stage and image (p50/p95/p99, images/s, peak RSS), print a summary '
+             'and write the full report as JSON to this file'
+    )
+    
+    parser.add_argument(
+        '--cprofile',
+        type=str,
+        default=None,
+        help='write cProfile stats of the run to this file (read with pstats or snakeviz)'
+    )
+    
+    parser.add_argument(
+        '--torch-trace',
+        type=str,
+        default=None,
+        help='write a torch profiler trace of the run to this file (open in chrome://tracing)'
+    )
+    
+    parser.add_argument(
+        '--draft',
+        action='store_true',
+        help='decode JPEGs at a reduced size (PIL draft mode): faster, but the model inputs '
+             'are no longer identical to a full decode and some predictions may change'
+    )
+    
+    parser.add_argument(
+        '--precision',
+        type=str,
+        default='fp32',
+        choices=PRECISIONS,
+        help='numeric precision: fp32, or int8 to quantize the linear layers (CPU only)'
+    )
+    
+    parser.add_argument(
+        '--optimize',
+        type=str,
+        default='none',
+        help="graph optimizations: 'none' or a comma-separated list of channels_last, "
+             "jit (TorchScript tracing), compile (torch.compile)"
+    )
+    
+    args = parser.parse_args()
+    
+    # Expand --arch, --weights, --precision and --optimize into settings
+    try:
+        args.models = parse_model_names(args.arch)
+        args.weights_by_model = parse_weights(args.weights, args.models)
+        args.execution_options = parse_execution_options(args.precision, args.optimize)
+        if args.server is not None:
+            args.server = check_server_url(args.server)
+            check_server_models(args.server, args.models)
+        
+        # A cascade is reported as one architecture, e.g. 'alexnet>vgg'
+        args.cascade_options = None
+        if args.cascade is not None:
+            if args.server is not None or args.workers > 1:
+                raise ValueError("--cascade runs in this process; it cannot be combined "
+                                 "with --server or --workers")
+            args.cascade_options = parse_cascade(args.cascade, args.cascade_threshold,
+                                                 args.cascade_dog_margin, args.dogfile)
+            args.weights_by_model = parse_weights(args.weights, args.cascade_options.models)
+            args.models = [cascade_name(args.cascade_options)]
+        
+        # --dir may name tar/zip archives, read in this process as a stream
+        args.archives = None
+        if is_archive_source(args.dir):
+            args.archives = archive_paths(args.dir)
+            conflicts = [flag for flag, used in (
+                ('--server', args.server is not None), ('--workers', args.workers > 1),
+                ('--shard', args.shard is not None), ('--tensor-cache', args.tensor_cache),
+                ('--dedup', args.dedup), ('--watch', args.watch)) if used]
+            if conflicts:
+                raise ValueError("--dir archives are streamed in this process; they cannot be "
+                                 "combined with {}".format(", ".join(conflicts)))
+        
+        # Watch mode classifies in this process, a few files at a time
+        if args.watch:
+            conflicts = [flag for flag, used in (
+                ('--server', args.server is not None), ('--workers', args.workers > 1),
+                ('--shard', args.shard is not None), ('--rescore', args.rescore is not None),
+                ('--save-predictions', args.save_predictions is not None),
+                ('--tensor-cache', args.tensor_cache), ('--profile', args.profile is not None),
+                ('--cprofile', args.cprofile is not None),
+                ('--torch-trace', args.torch_trace is not None), ('--dedup', args.dedup)) if used]
+            if conflicts:
+                raise ValueError("--watch cannot be combined with {}".format(", ".join(conflicts)))
+            if args.watch_interval <= 0:
+                raise ValueError("--watch-interval must be positive")
+        if args.dedup and args.rescore is not None:
+            raise ValueError("--rescore reads saved predictions; it cannot be combined with --dedup")
+        if not 0 <= args.dedup_distance <= 64:
+            raise ValueError("--dedup-distance must be between 0 and 64")
+    except ValueError as e:
+        parser.error(str(e))
+    
+    return args
+
+
+def get_merge_args(argv=None):
+    """
+    Parses the arguments of the 'check_images.py merge' subcommand.
+    
+    Accepts these command-line arguments:
+    - stats_files: JSON files written by check_images.py --stats-out
+    - --stats-out: Write the merged counts to a JSON file (default: None)
+    
+    Args:
+        argv (list): Arguments after 'merge', or None to use sys.argv
+    
+    Returns:
+        argparse.Namespace: An object containing the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='check_images.py merge',
+        description='Combine the statistics of sharded runs into one summary'
+    )
+    
+    parser.add_argument(
+        'stats_files',
+        nargs='+',
+        help='JSON files written by check_images.py --stats-out'
+    )
+    
+    parser.add_argument(
+        '--stats-out',
+        type=str,
+        default=None,
+        help='also write the merged counts to this JSON file'
+    )
+    
+    return parser.parse_args(argv)
+
+
+def get_serve_args(argv=None):
+    """
+    Parses the arguments of the 'check_images.py serve' subcommand.
+    
+    Accepts these command-line arguments:
+    - --host: Loopback address to listen on (default: '127.0.0.1')
+    - --port: TCP port to listen on (default: 8765)
+    - --arch: Architectures to keep loaded, as for the main command
+      (default: 'all')
+    - --dogfile: Text file containing valid dog names (default: 'dognames.txt')
+    - --weights: Local model weights, as for the main command (default: None)
+    - --max-batch: Most requests grouped into one forward pass (default: 32)
+    - --max-wait-ms: Latency window a batch may wait to fill (default: 10)
+    - --decode-workers: Threads decoding request images (default: 4)
+    - --root: Folder whose images clients may send by path, repeatable;
+      without it only uploaded images are classified (default: None)
+    - --draft, --precision, --optimize: JPEG decoding and execution options,
+      as for the main command
+    
+    Args:
+        argv (list): Arguments after 'serve', or None to use sys.argv
+    
+    Returns:
+        argparse.Namespace: An object containing the parsed arguments, plus
+        models, weights_by_model and execution_options as returned by
+        get_input_args
+    """
+    parser = argparse.ArgumentParser(
+        prog='check_images.py serve',
+        description='Keep the models loaded and classify images sent over HTTP on localhost'
+    )
+    
+    parser.add_argument(
+        '--host',
+        type=parse_loopback_host,
+        default=DEFAULT_HOST,
+        help='loopback address to listen on'
+    )
+    
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=DEFAULT_PORT,
+        help='TCP port to listen on (0 picks a free port)'
+    )
+    
+    parser.add_argument(
+        '--arch',
+        type=str,
+        default='all',
+        help="CNN model architectures to keep loaded: resnet, alexnet, vgg, a comma-separated list, or 'all'"
     )
     
     parser.add_argument(
@@ -44,4 +541,314 @@ def get_input_args():
         help='text file that contains valid dog names'
     )
     
-    return parser.parse_args()
+    parser.add_argument(
+        '--weights',
+        type=str,
+        default=None,
+        help='local state_dict file to load instead of downloading the pretrained weights '
+             '(use arch=path,arch=path with several architectures)'
+    )
+    
+    parser.add_argument(
+        '--max-batch',
+        type=int,
+        default=32,
+        help='most requests grouped into one forward pass'
+    )
+    
+    parser.add_argument(
+        '--max-wait-ms',
+        type=float,
+        default=10.0,
+        help='milliseconds the first request of a batch waits for others to join it'
+    )
+    
+    parser.add_argument(
+        '--decode-workers',
+        type=int,
+        default=4,
+        help='number of threads decoding request images'
+    )
+    
+    parser.add_argument(
+        '--root',
+        type=str,
+        action='append',
+        default=None,
+        help='folder whose images clients may send by path (repeat for several); '
+             'without it only uploaded images are classified'
+    )
+    
+    parser.add_argument(
+        '--draft',
+        action='store_true',
+        help='decode JPEGs at a reduced size (PIL draft mode): faster, but the model inputs '
+             'are no longer identical to a full decode and some predictions may change'
+    )
+    
+    parser.add_argument(
+        '--precision',
+        type=str,
+        default='fp32',
+        choices=PRECISIONS,
+        help='numeric precision: fp32, or int8 to quantize the linear layers (CPU only)'
+    )
+    
+    parser.add_argument(
+        '--optimize',
+        type=str,
+        default='none',
+        help="graph optimizations: 'none' or a comma-separated list of channels_last, "
+             "jit (TorchScript tracing), compile (torch.compile)"
+    )
+    
+    args = parser.parse_args(argv)
+    
+    try:
+        args.models = parse_model_names(args.arch)
+        args.weights_by_model = parse_weights(args.weights, args.models)
+        args.execution_options = parse_execution_options(args.precision, args.optimize)
+        for root in args.root or []:
+            if not os.path.isdir(root):
+                raise ValueError("--root '{}' is not a folder".format(root))
+    except ValueError as e:
+        parser.error(str(e))
+    
+    return args
+
+
+def get_build_index_args(argv=None):
+    """
+    Parses the arguments of the 'check_images.py build-index' subcommand.
+    
+    Accepts these command-line arguments:
+    - --dir: Folder of images to embed (default: 'pet_images/')
+    - --recursive: Also embed images in subfolders of --dir (default: off)
+    - --out: Folder to write the embeddings and index to (required)
+    - --arch: CNN model architecture computing the embeddings (default: 'resnet')
+    - --weights: Local model weights file (default: None)
+    - --index: flat (exact brute force) or pq (product quantization)
+      (default: 'flat')
+    - --pq-subspaces: Bytes per image in the pq index (default: embedding
+      size / 32)
+    - --batch-size: Number of images per forward pass (default: 32)
+    - --decode-workers: Threads decoding images ahead of the model (default: 4)
+    
+    Args:
+        argv (list): Arguments after 'build-index', or None to use sys.argv
+    
+    Returns:
+        argparse.Namespace: An object containing the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='check_images.py build-index',
+        description='Embed a folder of images and build a similarity index over them'
+    )
+    
+    parser.add_argument(
+        '--dir',
+        type=str,
+        default='pet_images/',
+        help='path to the folder of images to embed'
+    )
+    
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='also embed images in subfolders of --dir'
+    )
+    
+    parser.add_argument(
+        '--out',
+        type=str,
+        required=True,
+        help='folder to write the embeddings and index to'
+    )
+    
+    parser.add_argument(
+        '--arch',
+        type=str,
+        default='resnet',
+        choices=list(ARCHITECTURES),
+        help='CNN model architecture whose penultimate layer is the embedding'
+    )
+    
+    parser.add_argument(
+        '--weights',
+        type=str,
+        default=None,
+        help='local state_dict file to load instead of downloading the pretrained weights'
+    )
+    
+    parser.add_argument(
+        '--index',
+        type=str,
+        default='flat',
+        choices=INDEX_KINDS,
+        help='flat scans every embedding exactly; pq compresses them to a few bytes '
+             'each and re-ranks the best candidates exactly'
+    )
+    
+    parser.add_argument(
+        '--pq-subspaces',
+        type=int,
+        default=None,
+        help='bytes per image in the pq index; must divide the embedding size '
+             '(default: embedding size / 32)'
+    )
+    
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=32,
+        help='number of images per forward pass'
+    )
+    
+    parser.add_argument(
+        '--decode-workers',
+        type=int,
+        default=4,
+        help='number of threads decoding images ahead of the model'
+    )
+    
+    return parser.parse_args(argv)
+
+
+def get_query_index_args(argv=None):
+    """
+    Parses the arguments of the 'check_images.py query-index' subcommand.
+    
+    Accepts these command-line arguments:
+    - images: Image files to find similar images for
+    - --index-dir: Folder written by build-index (required)
+    - --index: flat or pq, or auto for pq when it was built (default: 'auto')
+    - --topk: Number of similar images listed per query (default: 5)
+    - --rerank: Candidates per result scored exactly by pq (default: 10)
+    - --weights: Local model weights file the index was built with
+      (default: None)
+    
+    Args:
+        argv (list): Arguments after 'query-index', or None to use sys.argv
+    
+    Returns:
+        argparse.Namespace: An object containing the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='check_images.py query-index',
+        description='List the indexed images most similar to the given ones'
+    )
+    
+    parser.add_argument(
+        'images',
+        nargs='+',
+        help='image files to find similar images for'
+    )
+    
+    parser.add_argument(
+        '--index-dir',
+        type=str,
+        required=True,
+        help="folder written by 'check_images.py build-index'"
+    )
+    
+    parser.add_argument(
+        '--index',
+        type=str,
+        default='auto',
+        choices=('auto',) + INDEX_KINDS,
+        help='index to search: flat, pq, or auto for pq when it was built'
+    )
+    
+    parser.add_argument(
+        '--topk',
+        type=int,
+        default=5,
+        help='number of similar images listed per query'
+    )
+    
+    parser.add_argument(
+        '--rerank',
+        type=int,
+        default=10,
+        help='candidates per listed image that pq scores exactly'
+    )
+    
+    parser.add_argument(
+        '--weights',
+        type=str,
+        default=None,
+        help='local state_dict file the index was built with'
+    )
+    
+    return parser.parse_args(argv)
+
+
+def get_pack_args(argv=None):
+    """
+    Parses the arguments of the 'check_images.py pack' subcommand.
+    
+    Accepts these command-line arguments:
+    - --dir: Folder of images to pack (default: 'pet_images/')
+    - --recursive: Also pack images in subfolders of --dir (default: off)
+    - --out: Folder to write the shards to (required)
+    - --prefix: Shard name prefix (default: 'images')
+    - --format: tar or zip (default: 'tar')
+    - --shard-size-mb: Largest shard size in megabytes (default: 256)
+    
+    Args:
+        argv (list): Arguments after 'pack', or None to use sys.argv
+    
+    Returns:
+        argparse.Namespace: An object containing the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='check_images.py pack',
+        description='Pack a folder of images into tar or zip shards that --dir can read'
+    )
+    
+    parser.add_argument(
+        '--dir',
+        type=str,
+        default='pet_images/',
+        help='path to the folder of images to pack'
+    )
+    
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='also pack images in subfolders of --dir, keeping their relative paths'
+    )
+    
+    parser.add_argument(
+        '--out',
+        type=str,
+        required=True,
+        help='folder to write the shards to'
+    )
+    
+    parser.add_argument(
+        '--prefix',
+        type=str,
+        default='images',
+        help="shard name prefix, e.g. 'images' writes images-00000.tar, images-00001.tar, ..."
+    )
+    
+    parser.add_argument(
+        '--format',
+        type=str,
+        default='tar',
+        choices=ARCHIVE_FORMATS,
+        help='archive format of the shards (images are stored uncompressed)'
+    )
+    
+    parser.add_argument(
+        '--shard-size-mb',
+        type=float,
+        default=DEFAULT_SHARD_SIZE_MB,
+        help='largest shard size in megabytes'
+    )
+    
+    args = parser.parse_args(argv)
+    if args.shard_size_mb <= 0:
+        parser.error("--shard-size-mb must be positive")
+    return args
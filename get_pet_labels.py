@@ -3,10 +3,108 @@ Module for creating pet image labels from filenames.
 This module processes image filenames to extract and format pet labels.
 """
 
-from os import listdir
+import os
+import zlib
 
 
-def get_pet_labels(image_dir):
+# File extensions treated as images when scanning folders
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+
+def pet_label_from_filename(filename):
+    """
+    Formats the pet label encoded in an image filename.
+    
+    Args:
+        filename (str): Image filename, optionally with leading folders
+    
+    Returns:
+        str: Lowercase label with words separated by spaces, numbers and the
+             file extension removed
+             Example: "Boston_terrier_02259.jpg" -> "boston terrier"
+    """
+    # Remove folders and file extension
+    filename_without_ext = os.path.basename(filename).split(".")[0]
+    
+    # Split filename by underscores
+    words = filename_without_ext.split("_")
+    
+    # Filter out numbers and join alphabetic words
+    pet_label = ""
+    for word in words:
+        if word.isalpha():
+            pet_label += word.lower() + " "
+    
+    # Strip trailing space
+    return pet_label.strip()
+
+
+def iter_pet_labels(image_dir, recursive=False, extensions=IMAGE_EXTENSIONS):
+    """
+    Lazily yields the pet label of every image in a folder.
+    
+    Uses os.scandir so entries are produced as the directory is read, and
+    memory stays bounded by the folder depth rather than the number of files.
+    Skips hidden files and folders (starting with ".").
+    
+    Args:
+        image_dir (str): Path to the folder containing pet images
+        recursive (bool): Also walk subfolders, without following symlinked
+                          ones (default: False)
+        extensions (tuple): Lowercase file extensions to keep, or None to
+                            keep every file (default: IMAGE_EXTENSIONS)
+    
+    Yields:
+        tuple: (filename, pet_label) where filename is relative to image_dir
+               Example: ("Boston_terrier_02259.jpg", "boston terrier")
+    """
+    # Folders still to scan, as paths relative to image_dir
+    pending = [""]
+    
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(image_dir, rel_dir)) as entries:
+            for entry in entries:
+                # Skip hidden files
+                if entry.name.startswith("."):
+                    continue
+    
+                filename = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+    
+                if entry.is_dir():
+                    # Symlinked folders are not followed, so a link to a
+                    # parent folder cannot make the scan loop forever
+                    if recursive and not entry.is_symlink():
+                        pending.append(filename)
+                    continue
+    
+                if extensions is not None and not entry.name.lower().endswith(extensions):
+                    continue
+    
+                yield filename, pet_label_from_filename(entry.name)
+
+
+def shard_filter(labeled_files, shard_index, shard_count):
+    """
+    Keeps only the files belonging to one shard of a folder.
+    
+    Files are assigned by a stable hash of their filename, so every process
+    agrees on the split without listing the folder in the same order.
+    
+    Args:
+        labeled_files (iterable): (filename, pet_label) pairs
+        shard_index (int): Shard to keep, from 0 to shard_count - 1
+        shard_count (int): Total number of shards
+    
+    Yields:
+        tuple: The (filename, pet_label) pairs in the shard
+    """
+    for filename, pet_label in labeled_files:
+        if zlib.crc32(filename.encode('utf-8')) % shard_count == shard_index:
+            yield filename, pet_label
+
+
+def get_pet_labels(image_dir, recursive=False, extensions=None):
     """
     Creates labels from filenames in the pet_images folder.
     
@@ -16,6 +114,10 @@ def get_pet_labels(image_dir):
     
     Args:
         image_dir (str): Path to the folder containing pet images
+        recursive (bool): Also label images in subfolders, keyed by their
+                          path relative to image_dir (default: False)
+        extensions (tuple): Lowercase file extensions to keep, or None to
+                            keep every file (default: None)
     
     Returns:
         dict: Dictionary with filename as key and list containing the
@@ -24,28 +126,7 @@ def get_pet_labels(image_dir):
     """
     pet_image_labels = {}
     
-    # Get list of filenames in the directory
-    image_filenames = listdir(image_dir)
-    
-    for filename in image_filenames:
-        # Skip hidden files
-        if filename.startswith("."):
-            continue
-        
-        # Remove file extension
-        filename_without_ext = filename.split(".")[0]
-        
-        # Split filename by underscores
-        words = filename_without_ext.split("_")
-        
-        # Filter out numbers and join alphabetic words
-        pet_label = ""
-        for word in words:
-            if word.isalpha():
-                pet_label += word.lower() + " "
-        
-        # Strip trailing space and store in dictionary
-        pet_label = pet_label.strip()
+    for filename, pet_label in iter_pet_labels(image_dir, recursive, extensions):
         pet_image_labels[filename] = [pet_label]
     
     return pet_image_labels
@@ -0,0 +1,204 @@
+"""
+Module for reading pet images straight from tar and zip archives.
+This module lets --dir name an archive (.tar, .tar.gz, .tgz, .zip) or a glob
+of archive shards instead of a folder of loose files. Each archive is read
+once, front to back, through a large buffer; members are labelled from
+their names exactly as get_pet_labels labels files, and their bytes are
+kept in memory until the classifier decodes them, so nothing is extracted
+to disk. pack_archives writes an existing folder into such shards.
+"""
+
+import glob
+import io
+import os
+import posixpath
+import tarfile
+import zipfile
+
+from get_pet_labels import IMAGE_EXTENSIONS, pet_label_from_filename
+
+
+ARCHIVE_FORMATS = ('tar', 'zip')
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+DEFAULT_SHARD_SIZE_MB = 256
+
+# Bytes read from an archive file at a time
+_READ_BUFFER_SIZE = 8 << 20
+
+
+def is_archive_source(source):
+    """
+    Tells whether a --dir value names archives rather than a folder.
+
+    Args:
+        source (str): The --dir value
+
+    Returns:
+        bool: True for an archive path or a glob pattern
+    """
+    if os.path.isdir(source):
+        return False
+    return glob.has_magic(source) or source.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_paths(source):
+    """
+    Expands a --dir value naming archives into the archive files to read.
+
+    Args:
+        source (str): Archive path or glob pattern such as 'shards/pets-*.tar'
+
+    Returns:
+        list: Archive paths, sorted so every run reads them in the same order
+
+    Raises:
+        ValueError: If no tar or zip archive matches
+    """
+    paths = sorted(glob.glob(source)) if glob.has_magic(source) else [source]
+    paths = [path for path in paths
+             if path.lower().endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path)]
+    if not paths:
+        raise ValueError("No tar or zip archive matches '{}'".format(source))
+    return paths
+
+
+def iter_archive_members(path, keep=None):
+    """
+    Reads the regular files of an archive in the order they are stored.
+
+    Args:
+        path (str): Path to a tar (optionally gzip-compressed) or zip file
+        keep (callable): Takes a member name and returns whether to read
+                         it; skipped members are never decompressed
+                         (default: None, read every file)
+
+    Yields:
+        tuple: (member name, member bytes)
+    """
+    with open(path, 'rb', buffering=_READ_BUFFER_SIZE) as f:
+        if path.lower().endswith('.zip'):
+            with zipfile.ZipFile(f) as archive:
+                # Central directory order may differ from the order on disk
+                for info in sorted(archive.infolist(), key=lambda info: info.header_offset):
+                    if not info.is_dir() and (keep is None or keep(info.filename)):
+                        yield info.filename, archive.read(info)
+        else:
+            # Stream mode never seeks back, so compressed tars read sequentially too
+            with tarfile.open(fileobj=f, mode='r|*') as archive:
+                for member in archive:
+                    if member.isfile() and (keep is None or keep(member.name)):
+                        yield member.name, archive.extractfile(member).read()
+
+
+class ArchiveReader:
+    """
+    Images of one or more archives, streamed as they are listed.
+
+    labeled_files() yields the images like get_pet_labels.iter_pet_labels
+    and holds each one's bytes until open_images() hands them to the
+    classifier, so memory stays bounded by the files listed ahead of
+    classification. Member names must be unique across the archives, as
+    pack_archives writes them.
+
+    Attributes:
+        paths (list): Archive files, read in this order
+        recursive (bool): Also keep members inside folders of an archive
+    """
+
+    def __init__(self, paths, recursive=False):
+        self.paths = paths
+        self.recursive = recursive
+        self._pending = {}
+
+    def _keep(self, name):
+        """Applies the filters of iter_pet_labels to a member name."""
+        parts = posixpath.normpath(name).split('/')
+        if any(part.startswith('.') for part in parts):
+            return False
+        if len(parts) > 1 and not self.recursive:
+            return False
+        return name.lower().endswith(IMAGE_EXTENSIONS)
+
+    def labeled_files(self):
+        """
+        Reads the archives one after the other.
+
+        Yields:
+            tuple: (filename, pet_label) where filename is the member name
+                   Example: ("Boston_terrier_02259.jpg", "boston terrier")
+        """
+        for path in self.paths:
+            for name, data in iter_archive_members(path, self._keep):
+                filename = posixpath.normpath(name)
+                self._pending[filename] = data
+                yield filename, pet_label_from_filename(filename)
+
+    def open_images(self, filenames):
+        """
+        Hands over listed images as in-memory files and releases the copy
+        held by the reader.
+
+        Args:
+            filenames (list): Filenames yielded by labeled_files()
+
+        Returns:
+            list: io.BytesIO of every image, in filenames order
+        """
+        return [io.BytesIO(self._pending.pop(filename)) for filename in filenames]
+
+
+def pack_archives(images_dir, filenames, out_dir, prefix='images',
+                  shard_size_mb=DEFAULT_SHARD_SIZE_MB, archive_format='tar'):
+    """
+    Packs image files into numbered archive shards.
+
+    Images are stored uncompressed (they already are compressed) in the
+    order given, and a new shard is started once one would grow past
+    shard_size_mb.
+
+    Args:
+        images_dir (str): Folder the filenames are relative to
+        filenames (list): Image filenames to pack, kept as member names
+        out_dir (str): Folder to write the shards to, created if needed
+        prefix (str): Shard name prefix, e.g. 'images' writes
+                      images-00000.tar, images-00001.tar, ... (default: 'images')
+        shard_size_mb (float): Largest shard size in megabytes, unless a
+                               single image is larger (default: 256)
+        archive_format (str): One of ARCHIVE_FORMATS (default: 'tar')
+
+    Returns:
+        list: Paths of the shards written
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shard_size = shard_size_mb * (1 << 20)
+
+    shard_paths = []
+    archive = None
+    written = 0
+    try:
+        for filename in filenames:
+            path = os.path.join(images_dir, filename)
+            size = os.path.getsize(path)
+            if archive is None or (written and written + size > shard_size):
+                if archive is not None:
+                    archive.close()
+                shard_paths.append(os.path.join(out_dir, "{}-{:05d}.{}".format(
+                    prefix, len(shard_paths), archive_format)))
+                if archive_format == 'zip':
+                    archive = zipfile.ZipFile(shard_paths[-1], 'w', zipfile.ZIP_STORED)
+                else:
+                    archive = tarfile.open(shard_paths[-1], 'w')
+                written = 0
+
+            # Member names use '/' whatever the platform
+            member_name = filename.replace(os.sep, '/')
+            if archive_format == 'zip':
+                archive.write(path, member_name)
+            else:
+                archive.add(path, member_name, recursive=False)
+            written += size
+    finally:
+        if archive is not None:
+            archive.close()
+    return shard_paths
@@ -0,0 +1,146 @@
+"""
+Module for decoding and preprocessing images in the background.
+This module runs a pool of worker threads that decode JPEGs and write the
+model preprocessing straight into rows of a small pool of reusable batch
+tensors, so the model can work on one batch while the next ones are being
+prepared and no batch is allocated after the first few.
+"""
+
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Marks the end of the stream in the output queue
+_DONE = object()
+
+
+def _producer(img_paths, load_fn, buffers, batch_size, workers, ordered,
+              out_queue, free_queue, stop_event):
+    """
+    Decodes images on a thread pool into free batch buffers and puts each
+    finished batch on out_queue as (indices, buffer index), where indices
+    are positions in img_paths. A buffer is only reused once the consumer
+    hands it back through free_queue. Any exception is forwarded to the
+    consumer through out_queue.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Batches being decoded as (indices, buffer index, futures)
+            pending = []
+            next_start = 0
+
+            while not stop_event.is_set() and (next_start < len(img_paths) or pending):
+                # Start a batch in every buffer the consumer has released
+                while next_start < len(img_paths):
+                    try:
+                        buffer_index = free_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    indices = list(range(next_start, min(next_start + batch_size, len(img_paths))))
+                    futures = [executor.submit(load_fn, img_paths[i], buffers[buffer_index][row])
+                               for row, i in enumerate(indices)]
+                    pending.append((indices, buffer_index, futures))
+                    next_start += batch_size
+
+                if not pending:
+                    # Every buffer is queued or held by the consumer
+                    try:
+                        free_queue.put(free_queue.get(timeout=0.1))
+                    except queue.Empty:
+                        pass
+                    continue
+
+                # Emit the oldest batch once decoded, or in unordered mode
+                # whichever batch finishes first
+                candidates = pending[:1] if ordered else pending
+                finished = next((batch for batch in candidates
+                                 if all(future.done() for future in batch[2])), None)
+                if finished is None:
+                    wait([future for batch in candidates for future in batch[2] if not future.done()],
+                         timeout=0.1, return_when=FIRST_COMPLETED)
+                    continue
+
+                pending.remove(finished)
+                indices, buffer_index, futures = finished
+                for future in futures:
+                    future.result()
+                out_queue.put((indices, buffer_index))
+    except Exception as e:
+        out_queue.put(e)
+        return
+
+    out_queue.put(_DONE)
+
+
+def iter_batches(img_paths, load_fn, item_shape, batch_size=32, workers=4, prefetch=2,
+                 ordered=True):
+    """
+    Yields batches of preprocessed images while later batches are decoded.
+
+    The batch tensors come from a pool of prefetch + 2 buffers that are
+    reused: a yielded batch is only valid until the next one is requested,
+    so copy it to keep it longer.
+
+    Args:
+        img_paths (list): Paths to the image files
+        load_fn (callable): Function taking a path and a tensor of item_shape
+                            and writing the preprocessed image into it
+        item_shape (tuple): Shape of one preprocessed image, e.g. (3, 224, 224)
+        batch_size (int): Number of images per batch
+        workers (int): Number of decode threads; 0 decodes on the calling
+                       thread with no prefetching
+        prefetch (int): Number of batches decoded ahead of the consumer
+        ordered (bool): True yields batches in img_paths order (deterministic);
+                        False yields each batch as soon as it is decoded
+
+    Yields:
+        tuple: (indices, batch) where indices lists the positions in img_paths
+               of the images in the NxCxHxW tensor batch
+    """
+    import torch
+
+    batch_size = max(1, min(batch_size, len(img_paths)))
+
+    # Synchronous path, same behavior as decoding inline, with one buffer
+    if workers <= 0:
+        buffer = torch.empty((batch_size,) + tuple(item_shape))
+        for start in range(0, len(img_paths), batch_size):
+            indices = list(range(start, min(start + batch_size, len(img_paths))))
+            for row, i in enumerate(indices):
+                load_fn(img_paths[i], buffer[row])
+            yield indices, buffer[:len(indices)]
+        return
+
+    buffers = [torch.empty((batch_size,) + tuple(item_shape)) for _ in range(max(1, prefetch) + 2)]
+    out_queue = queue.Queue()
+    free_queue = queue.Queue()
+    for buffer_index in range(len(buffers)):
+        free_queue.put(buffer_index)
+
+    stop_event = threading.Event()
+    producer = threading.Thread(
+        target=_producer,
+        args=(img_paths, load_fn, buffers, batch_size, workers, ordered,
+              out_queue, free_queue, stop_event),
+        daemon=True
+    )
+    producer.start()
+
+    try:
+        while True:
+            item = out_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            indices, buffer_index = item
+            yield indices, buffers[buffer_index][:len(indices)]
+
+            # The consumer is done with this batch; let the producer refill it
+            free_queue.put(buffer_index)
+    finally:
+        # Stops the producer if the consumer exits early
+        stop_event.set()
+        producer.join()
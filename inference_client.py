@@ -0,0 +1,170 @@
+"""
+Module for classifying images through a running inference server.
+This module sends local image paths (or, outside the server's root folders,
+the image bytes) to the server started with 'check_images.py serve' and
+turns its answers into the same results the in-process
+classify_images_stream yields, so no model is loaded here.
+"""
+
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+import profiling
+from inference_server import is_inside, is_loopback
+
+
+def check_server_url(server_url):
+    """
+    Checks that a server URL points at this machine.
+
+    Args:
+        server_url (str): Base URL such as 'http://127.0.0.1:8765'
+
+    Returns:
+        str: The URL without a trailing slash
+
+    Raises:
+        ValueError: If the URL is not http:// on a loopback host
+    """
+    url = urlsplit(server_url)
+    if url.scheme != 'http' or not url.hostname or not is_loopback(url.hostname):
+        raise ValueError("the inference server must be reached on localhost over http, "
+                         "got '{}'".format(server_url))
+    return server_url.rstrip('/')
+
+
+def get_server_info(server_url, timeout=10.0):
+    """
+    Reads the server's /health answer.
+
+    Args:
+        server_url (str): Base URL of the server
+        timeout (float): Seconds to wait for the answer (default: 10)
+
+    Returns:
+        dict: The models served, the root folders it reads and batching stats
+
+    Raises:
+        ValueError: If the server cannot be reached
+    """
+    try:
+        with urlopen(server_url + '/health', timeout=timeout) as response:
+            return json.loads(response.read())
+    except (URLError, OSError, ValueError) as e:
+        raise ValueError("cannot reach the inference server at {}: {}".format(
+            server_url, getattr(e, 'reason', e))) from None
+
+
+def check_server_models(server_url, models):
+    """
+    Checks that the server keeps every requested architecture loaded.
+
+    Args:
+        server_url (str): Base URL of the server
+        models (list): Names of the CNN model architectures to use
+
+    Raises:
+        ValueError: If the server cannot be reached or does not serve one
+                    of the models
+    """
+    served = get_server_info(server_url).get('models', [])
+    missing = [model for model in models if model not in served]
+    if missing:
+        raise ValueError("the inference server at {} does not serve {}; it serves {} "
+                         "(restart it with --arch)".format(
+                             server_url, ', '.join(missing), ', '.join(served)))
+
+
+def classify_remote(server_url, img_path, arch, timeout=60.0, upload=False):
+    """
+    Asks the server to classify one local image file.
+
+    Args:
+        server_url (str): Base URL of the server
+        img_path (str): Path to the image; sent as an absolute path since the
+                        server may run from another folder
+        arch (str): CNN model architecture to use
+        timeout (float): Seconds to wait for the answer (default: 60)
+        upload (bool): Send the image bytes instead of the path, for files
+                       outside the server's root folders (default: False)
+
+    Returns:
+        dict: The server's result with classifier_label, class_id and match
+
+    Raises:
+        RuntimeError: If the server rejects the request
+    """
+    filename = os.path.basename(img_path)
+    if upload:
+        with open(img_path, 'rb') as f:
+            body = f.read()
+        request = Request(server_url + '/classify?' + urlencode({'filename': filename,
+                                                                 'arch': arch}),
+                          data=body, method='POST',
+                          headers={'Content-Type': 'application/octet-stream'})
+    else:
+        body = json.dumps({'path': os.path.abspath(img_path),
+                           'filename': filename,
+                           'arch': arch}).encode('utf-8')
+        request = Request(server_url + '/classify', data=body, method='POST',
+                          headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except HTTPError as e:
+        message = json.loads(e.read() or b'{}').get('error', e.reason)
+        raise RuntimeError("inference server error for {}: {}".format(img_path, message)) from None
+
+
+def classify_images_remote(server_url, images_dir, labeled_files, models, concurrency=32):
+    """
+    Classifies images through the server, keeping up to concurrency requests
+    in flight so the server can batch them together.
+
+    Args:
+        server_url (str): Base URL of the server
+        images_dir (str): Path to the folder of pet images
+        labeled_files (iterable): (filename, pet_label) pairs
+        models (list): Names of the CNN model architectures to use
+        concurrency (int): Requests sent at the same time (default: 32)
+
+    Yields:
+        tuple: (filename, results, predictions) in the form
+               classify_images_stream yields, in labeled_files order
+    """
+    server_url = check_server_url(server_url)
+
+    # Paths are only read by the server inside its root folders
+    upload = not is_inside(images_dir, get_server_info(server_url).get('roots', []))
+
+    def classify_file(item):
+        filename, pet_label = item
+        img_path = os.path.join(images_dir, filename)
+        results, predictions = {}, {}
+        with profiling.stage(profiling.IMAGE_LATENCY):
+            for model in models:
+                with profiling.stage('remote_classify:' + model):
+                    answer = classify_remote(server_url, img_path, model, upload=upload)
+                # The pet label comes from the local scan so relative folders
+                # are kept exactly as classify_images_stream would keep them
+                classifier_label = answer['classifier_label']
+                results[model] = [pet_label, classifier_label,
+                                  1 if pet_label in classifier_label else 0]
+                predictions[model] = (answer['class_ids'], answer['scores'])
+        return filename, results, predictions
+
+    concurrency = max(1, concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Submit as files are found, at most concurrency ahead, and yield in order
+        pending = deque()
+        for item in labeled_files:
+            pending.append(executor.submit(classify_file, item))
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
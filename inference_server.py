@@ -0,0 +1,375 @@
+"""
+Module for serving classifications from a long-running local process.
+This module keeps the CNN models, ImageNet labels and dog name index loaded
+between requests and answers them over HTTP on the loopback interface.
+Requests arriving close together are grouped into one forward pass per
+architecture, waiting at most a configurable latency window for a batch to
+fill.
+
+Endpoints:
+    GET  /health    -> {"status": "ok", "models": [...], "roots": [...],
+                    "batching": {...}} with MicroBatcher.stats() per
+                    architecture
+    POST /classify  with a JSON body {"path": "/abs/path/Beagle_01.jpg",
+                    "arch": "resnet"} to classify a local file inside one of
+                    the server's root folders, or with the raw image bytes
+                    as the body and ?filename=Beagle_01.jpg&arch=resnet to
+                    classify an upload
+
+Both forms answer with the classifier label and the dog/breed match:
+    {"filename": ..., "arch": ..., "pet_label": ..., "classifier_label": ...,
+     "class_id": ..., "class_ids": [...], "scores": [...], "match": 0/1,
+     "pet_is_dog": 0/1, "classifier_is_dog": 0/1, "batch_size": ...,
+     "queue_ms": ..., "compute_ms": ...}
+"""
+
+import asyncio
+import io
+import ipaddress
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from classifier import get_imagenet_classes, predict_tensors, preprocess_image
+from dog_name_index import DogNameIndex
+from get_pet_labels import pet_label_from_filename
+from micro_batcher import MicroBatcher
+from model_registry import preload
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Largest request body accepted, so a bad client cannot exhaust memory
+MAX_BODY_BYTES = 32 * 1024 * 1024
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """A request the server cannot answer, with the HTTP status to send."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def is_loopback(host):
+    """
+    Tells whether a host name or address only accepts local connections.
+
+    Args:
+        host (str): Host name or IP address
+
+    Returns:
+        bool: True for 'localhost' and loopback addresses such as 127.0.0.1
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def is_inside(path, roots):
+    """
+    Tells whether a path lies inside one of some folders, once symlinks and
+    '..' components are resolved.
+
+    Args:
+        path (str): Path to check
+        roots (list): Resolved folder paths (os.path.realpath)
+
+    Returns:
+        bool: True if path is one of roots or below one of them
+    """
+    path = os.path.realpath(path)
+    for root in roots:
+        try:
+            if os.path.commonpath([path, root]) == root:
+                return True
+        except ValueError:
+            # Paths on different drives (Windows) share no folder
+            continue
+    return False
+
+
+class InferenceServer:
+    """
+    Local classification service with per-architecture micro-batching.
+
+    Attributes:
+        models (list): Architectures the server answers for; the first one is
+                       used when a request does not name one
+        max_batch (int): Most images grouped into one forward pass
+        max_wait (float): Longest time in seconds the first request of a
+                          batch waits for others to join it
+        roots (list): Resolved folders whose files may be classified by
+                      path; empty when only uploads are accepted
+    """
+
+    def __init__(self, models, weights=None, dogfile='dognames.txt', max_batch=32,
+                 max_wait_ms=10.0, device='cpu', decode_workers=4, roots=None):
+        """
+        Creates the server; nothing is loaded until start() is called.
+
+        Args:
+            models (list): Names of the CNN model architectures to keep loaded
+            weights (dict): Local weights file per architecture, None entries
+                            use the pretrained weights (default: None)
+            dogfile (str): Text file containing valid dog names
+            max_batch (int): Most images per forward pass (default: 32)
+            max_wait_ms (float): Latency window in milliseconds a batch may
+                                 wait to fill (default: 10)
+            device (str): Torch device to run the models on (default: 'cpu')
+            decode_workers (int): Threads decoding uploaded or local images
+                                  (default: 4)
+            roots (list): Folders whose images may be classified by path;
+                          None or empty only accepts uploads (default: None)
+        """
+        self.models = list(models)
+        self.weights = weights or {}
+        self.dogfile = dogfile
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.device = device
+        self.roots = [os.path.realpath(root) for root in roots or []]
+
+        # Decoding runs on its own pool; each architecture's batcher groups
+        # requests, but every forward pass runs on the single model thread
+        # so architectures do not compete for torch's intra-op threads
+        self._decode_executor = ThreadPoolExecutor(max_workers=max(1, decode_workers))
+        self._model_executor = ThreadPoolExecutor(max_workers=1)
+        self._batchers = {}
+        self._dog_index = None
+        self._server = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """
+        Loads the models and starts listening on a loopback address.
+
+        Args:
+            host (str): Loopback host to bind (default: '127.0.0.1')
+            port (int): TCP port, 0 picks a free one (default: 8765)
+
+        Returns:
+            int: The port the server is listening on
+
+        Raises:
+            ValueError: If host is not a loopback address
+        """
+        if not is_loopback(host):
+            raise ValueError("the inference server only listens on localhost, not '{}'".format(host))
+
+        # Warm every model and lookup table before the first request
+        await asyncio.get_running_loop().run_in_executor(self._model_executor, self._load)
+
+        for model in self.models:
+            self._batchers[model] = MicroBatcher(self._batch_fn(model), self.max_batch,
+                                                 self.max_wait * 1000)
+
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    def _load(self):
+        for model in self.models:
+            preload(model, self.weights.get(model), self.device)
+        get_imagenet_classes()
+        self._dog_index = DogNameIndex.from_file(self.dogfile)
+
+    def _batch_fn(self, arch):
+        """Returns the function classifying a list of image tensors with arch."""
+        def classify_tensors(tensors):
+            import torch
+
+            return predict_tensors(torch.stack(tensors), arch, self.weights.get(arch), self.device)
+
+        def run_on_model_thread(tensors):
+            return self._model_executor.submit(classify_tensors, tensors).result()
+        return run_on_model_thread
+
+    async def serve_forever(self):
+        """Answers requests until the task is cancelled."""
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        """Stops listening, finishes queued batches and releases the threads."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for batcher in self._batchers.values():
+            await asyncio.get_running_loop().run_in_executor(None, batcher.close)
+        self._decode_executor.shutdown(wait=False)
+        self._model_executor.shutdown(wait=False)
+
+    def stats(self):
+        """Returns MicroBatcher.stats() for each architecture served."""
+        return {model: batcher.stats() for model, batcher in self._batchers.items()}
+
+    async def classify(self, image, filename, arch=None):
+        """
+        Classifies one image, sharing a forward pass with concurrent requests.
+
+        Args:
+            image (str or bytes): Local path to the image, or its encoded bytes
+            filename (str): Image filename the pet label is derived from
+            arch (str): Architecture to use, or None for the first one served
+
+        Returns:
+            dict: The classification result described in the module docstring
+
+        Raises:
+            RequestError: If the architecture is not served or the image
+                          cannot be read
+        """
+        arch = arch or self.models[0]
+        if arch not in self._batchers:
+            raise RequestError(400, "architecture '{}' is not served; available: {}".format(
+                arch, ', '.join(self.models)))
+
+        # Decode off the event loop, then queue the tensor for the next batch
+        loop = asyncio.get_running_loop()
+        source = io.BytesIO(image) if isinstance(image, bytes) else image
+        try:
+            tensor = await loop.run_in_executor(self._decode_executor, preprocess_image, source)
+        except Exception as e:
+            raise RequestError(400, "cannot read image {}: {}".format(filename, e)) from None
+
+        try:
+            result = await self._batchers[arch].submit_async(tensor)
+        except Exception as e:
+            raise RequestError(500, "inference failed: {}".format(e)) from None
+        class_ids, scores = result.value
+
+        # Same label formatting and checks as classify_images and
+        # adjust_results4_isadog
+        pet_label = pet_label_from_filename(filename)
+        classifier_label = get_imagenet_classes()[class_ids[0]].lower().strip()
+        return {'filename': filename,
+                'arch': arch,
+                'pet_label': pet_label,
+                'classifier_label': classifier_label,
+                'class_id': class_ids[0],
+                'class_ids': class_ids,
+                'scores': scores,
+                'match': 1 if pet_label in classifier_label else 0,
+                'pet_is_dog': self._dog_index.is_dog(pet_label),
+                'classifier_is_dog': self._dog_index.contains_dog_name(classifier_label),
+                'batch_size': result.batch_size,
+                'queue_ms': result.queue_time * 1000,
+                'compute_ms': result.compute_time * 1000}
+
+    async def _handle_connection(self, reader, writer):
+        """Reads one HTTP request, answers it and closes the connection."""
+        try:
+            status, payload = await self._handle_request(reader)
+        except RequestError as e:
+            status, payload = e.status, {'error': str(e)}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        body = json.dumps(payload).encode('utf-8')
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+                         status, _REASONS.get(status, ''), len(body)).encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def _handle_request(self, reader):
+        """Parses an HTTP request and routes it, returning (status, payload)."""
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise RequestError(400, "malformed request line")
+        method, target, _ = request_line
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(400, "invalid Content-Length") from None
+        if length > MAX_BODY_BYTES:
+            raise RequestError(413, "request body is larger than {} bytes".format(MAX_BODY_BYTES))
+        body = await reader.readexactly(length) if length else b''
+
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        if url.path == '/health':
+            if method != 'GET':
+                raise RequestError(405, "use GET /health")
+            return 200, {'status': 'ok', 'models': self.models, 'roots': self.roots,
+                         'batching': self.stats()}
+
+        if url.path != '/classify':
+            raise RequestError(404, "unknown endpoint {}".format(url.path))
+        if method != 'POST':
+            raise RequestError(405, "use POST /classify")
+
+        # A JSON body names a local file; anything else is the image itself
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                request = json.loads(body)
+                path = request['path']
+            except (ValueError, KeyError, TypeError):
+                raise RequestError(400, 'expected a JSON body like {"path": "...", "arch": "resnet"}') from None
+            # Any local process may connect, so only the configured folders are readable
+            if not self.roots:
+                raise RequestError(403, "this server only accepts uploads; start it with --root "
+                                        "to classify local paths")
+            if not isinstance(path, str) or not is_inside(path, self.roots):
+                raise RequestError(403, "{} is outside the folders this server reads: {}".format(
+                    path, ', '.join(self.roots)))
+            if not os.path.isfile(path):
+                raise RequestError(400, "no such file: {}".format(path))
+            return 200, await self.classify(path, request.get('filename') or os.path.basename(path),
+                                            request.get('arch') or query.get('arch'))
+
+        if not body:
+            raise RequestError(400, "empty upload")
+        if 'filename' not in query:
+            raise RequestError(400, "uploads need a ?filename= to derive the pet label from")
+        return 200, await self.classify(body, query['filename'], query.get('arch'))
+
+
+async def run_server(server, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Starts the server, reports where it listens and serves until cancelled.
+
+    Args:
+        server (InferenceServer): The server to run
+        host (str): Loopback host to bind (default: '127.0.0.1')
+        port (int): TCP port, 0 picks a free one (default: 8765)
+
+    Returns:
+        None
+    """
+    port = await server.start(host, port)
+    print("Serving {} on http://{}:{} (batches of up to {}, {:g} ms window)".format(
+        ', '.join(server.models), host, port, server.max_batch, server.max_wait * 1000),
+        flush=True)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+        for model, stats in server.stats().items():
+            print("{}: {} requests in {} batches (mean {:.1f}), mean queue {:.1f} ms, "
+                  "mean compute {:.1f} ms".format(model, stats['requests'], stats['batches'],
+                                                  stats['mean_batch_size'], stats['mean_queue_ms'],
+                                                  stats['mean_compute_ms']))
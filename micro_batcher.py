@@ -0,0 +1,260 @@
+"""
+Module for batching concurrent single-image requests together.
+This module queues requests coming from many threads or coroutines and hands
+them to a batch function in groups, flushing a group as soon as it is full or
+its oldest request has waited max_wait_ms. Callers get a future per request
+and the time it spent queued and in compute, without batching by hand.
+"""
+
+import asyncio
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from time import perf_counter
+
+from classifier import get_imagenet_classes, predict_tensors, preprocess_image
+
+
+# Result of one request: the batch function's output for it, the seconds it
+# waited before its batch started, the seconds the batch took, and the
+# number of requests in that batch
+BatchedResult = namedtuple('BatchedResult', ['value', 'queue_time', 'compute_time', 'batch_size'])
+
+_Request = namedtuple('_Request', ['item', 'future', 'enqueued'])
+
+
+class MicroBatcher:
+    """
+    Groups items submitted concurrently into calls of a batch function.
+
+    The batch function runs on a background thread, one batch at a time. It
+    takes a list of items and must return one result per item, in order.
+
+    Attributes:
+        max_batch (int): Most items passed to one call of the batch function
+        max_wait (float): Longest time in seconds the oldest queued item waits
+                          for the batch to fill
+        requests (int): Number of items processed so far
+        batches (int): Number of batch function calls so far
+        total_queue_time (float): Seconds processed items spent queued
+        total_compute_time (float): Seconds processed items spent in the batch
+                                    function, each counting its whole batch
+    """
+
+    def __init__(self, batch_fn, max_batch=32, max_wait_ms=10.0):
+        """
+        Creates the batcher and starts its background thread.
+
+        Args:
+            batch_fn (callable): Function taking a list of items and returning
+                                 a list of results in the same order
+            max_batch (int): Most items per batch (default: 32)
+            max_wait_ms (float): Deadline in milliseconds after which a
+                                 partial batch is flushed (default: 10)
+        """
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.requests = 0
+        self.batches = 0
+        self.total_queue_time = 0.0
+        self.total_compute_time = 0.0
+
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """
+        Queues one item; safe to call from any thread.
+
+        Args:
+            item: Input for the batch function
+
+        Returns:
+            concurrent.futures.Future: Resolves to a BatchedResult, or to the
+                                       exception the batch function raised
+
+        Raises:
+            RuntimeError: If the batcher has been closed
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("cannot submit to a closed MicroBatcher")
+            self._pending.append(_Request(item, future, perf_counter()))
+            self._condition.notify()
+        return future
+
+    async def submit_async(self, item):
+        """
+        Queues one item from a coroutine and waits for its result.
+
+        Args:
+            item: Input for the batch function
+
+        Returns:
+            BatchedResult: The item's result and timings
+        """
+        return await asyncio.wrap_future(self.submit(item))
+
+    def _next_batch(self):
+        """
+        Waits until a batch is full or its deadline passes and takes it off
+        the queue. Returns an empty list once closed with nothing pending.
+        """
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+
+            # The deadline counts from when the oldest request was queued
+            if self._pending:
+                deadline = self._pending[0].enqueued + self.max_wait
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remaining = deadline - perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+            count = min(self.max_batch, len(self._pending))
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        """Runs batches on the background thread until closed and drained."""
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+
+            # Requests cancelled while queued are dropped from the batch
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            start = perf_counter()
+            try:
+                results = self.batch_fn([request.item for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            compute_time = perf_counter() - start
+
+            # A short or long result list would leave callers waiting forever
+            results = list(results)
+            if len(results) != len(batch):
+                error = RuntimeError("batch function returned {} results for {} items".format(
+                    len(results), len(batch)))
+                for request in batch:
+                    request.future.set_exception(error)
+                continue
+
+            self.requests += len(batch)
+            self.batches += 1
+            for request, value in zip(batch, results):
+                queue_time = start - request.enqueued
+                self.total_queue_time += queue_time
+                self.total_compute_time += compute_time
+                request.future.set_result(BatchedResult(value, queue_time, compute_time, len(batch)))
+
+    def stats(self):
+        """
+        Summarizes the requests processed so far.
+
+        Returns:
+            dict: requests, batches, mean_batch_size, and the mean queue and
+                  compute time per request in milliseconds
+        """
+        requests = max(1, self.requests)
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': self.requests / max(1, self.batches),
+                'mean_queue_ms': self.total_queue_time / requests * 1000,
+                'mean_compute_ms': self.total_compute_time / requests * 1000}
+
+    def close(self):
+        """Flushes the queued requests and stops the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BatchedClassifier:
+    """
+    Drop-in batched counterpart of classifier.classifier for services that
+    classify one image per call from many threads or coroutines.
+
+    Each image is decoded on the calling thread (or the event loop's default
+    executor for classify_async), then queued so concurrent calls share a
+    forward pass.
+    """
+
+    def __init__(self, model_name, weights=None, device='cpu', max_batch=32, max_wait_ms=10.0):
+        """
+        Args:
+            model_name (str): CNN model architecture: resnet, alexnet or vgg
+            weights (str): Local state_dict file to load instead of the
+                           pretrained weights (default: None)
+            device (str): Torch device to run the model on (default: 'cpu')
+            max_batch (int): Most images per forward pass (default: 32)
+            max_wait_ms (float): Deadline in milliseconds after which a
+                                 partial batch runs (default: 10)
+        """
+        self.model_name = model_name
+        self.weights = weights
+        self.device = device
+        self.batcher = MicroBatcher(self._classify_batch, max_batch, max_wait_ms)
+
+    def _classify_batch(self, tensors):
+        import torch
+
+        predictions = predict_tensors(torch.stack(tensors), self.model_name,
+                                      self.weights, self.device, topk=1)
+        imagenet_classes_dict = get_imagenet_classes()
+        return [imagenet_classes_dict[class_ids[0]] for class_ids, _ in predictions]
+
+    def classify(self, img_path):
+        """
+        Classifies one image, batched with concurrent calls.
+
+        Args:
+            img_path (str): Path to the image file
+
+        Returns:
+            concurrent.futures.Future: Resolves to a BatchedResult whose value
+                                       is the classifier label, as returned
+                                       by classifier.classifier
+        """
+        return self.batcher.submit(preprocess_image(img_path))
+
+    async def classify_async(self, img_path):
+        """
+        Coroutine version of classify, decoding off the event loop.
+
+        Args:
+            img_path (str): Path to the image file
+
+        Returns:
+            BatchedResult: The classifier label and timings
+        """
+        tensor = await asyncio.get_running_loop().run_in_executor(None, preprocess_image, img_path)
+        return await self.batcher.submit_async(tensor)
+
+    def close(self):
+        """Finishes the queued images and stops the batching thread."""
+        self.batcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
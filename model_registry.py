@@ -0,0 +1,333 @@
+"""
+Module for keeping pretrained CNN models loaded for the life of the process.
+This module builds each requested network once and hands the same warm,
+evaluation-mode instance back to every caller.
+"""
+
+import os
+import threading
+
+import profiling
+from execution_options import DEFAULT_OPTIONS, apply_execution_options, options_tag
+
+
+# Maps the --arch names used on the command line to the names of the
+# torchvision builder and of the weights enum holding its pretrained
+# ImageNet weights. Names rather than objects so torchvision is only
+# imported once a model is actually needed
+ARCHITECTURES = {
+    'resnet': ('resnet18', 'ResNet18_Weights'),
+    'alexnet': ('alexnet', 'AlexNet_Weights'),
+    'vgg': ('vgg16', 'VGG16_Weights'),
+}
+
+# Weights source used when no local weights file is given
+PRETRAINED = 'pretrained'
+
+# Process-wide registry of loaded models keyed by
+# (arch, weights source, device, execution options)
+_models = {}
+_lock = threading.Lock()
+
+# One lock per key being built, so building a model only blocks the threads
+# waiting for that same model
+_build_locks = {}
+
+# Execution options used when a caller does not pass any
+_default_options = DEFAULT_OPTIONS
+
+
+def parse_model_names(arch):
+    """
+    Expands an --arch value into a list of architectures.
+
+    Args:
+        arch (str): A single architecture, a comma-separated list such as
+                    'resnet,alexnet,vgg', or 'all'
+
+    Returns:
+        list: Architecture names in the order given, without duplicates
+
+    Raises:
+        ValueError: If any name is not a supported architecture
+    """
+    if arch.strip().lower() == 'all':
+        return list(ARCHITECTURES)
+
+    model_names = []
+    for model_name in arch.split(','):
+        model_name = model_name.strip()
+        if model_name not in ARCHITECTURES:
+            raise ValueError("Model name '{}' not recognized. Acceptable values: {}".format(
+                model_name, ", ".join(ARCHITECTURES)))
+        if model_name not in model_names:
+            model_names.append(model_name)
+    return model_names
+
+
+def parse_weights(weights, model_names):
+    """
+    Maps each architecture to its local weights file from a --weights value.
+
+    Args:
+        weights (str): None, a single path (only valid for one architecture),
+                       or comma-separated arch=path pairs
+        model_names (list): Architectures being run
+
+    Returns:
+        dict: Architecture name to weights path, or None for pretrained weights
+
+    Raises:
+        ValueError: If a single path is given for several architectures, a
+                    pair is not of the form arch=path, or names an
+                    unknown architecture
+    """
+    weights_by_model = dict.fromkeys(model_names)
+    if not weights:
+        return weights_by_model
+
+    if '=' not in weights:
+        if len(model_names) > 1:
+            raise ValueError("Give --weights as arch=path pairs when running several architectures")
+        weights_by_model[model_names[0]] = weights
+        return weights_by_model
+
+    for pair in weights.split(','):
+        model_name, separator, path = (part.strip() for part in pair.partition('='))
+        if not separator or not model_name or not path:
+            raise ValueError("--weights entry '{}' is not of the form arch=path".format(pair))
+        if model_name not in ARCHITECTURES:
+            raise ValueError("Model name '{}' in --weights not recognized. Acceptable values: "
+                             "{}".format(model_name, ", ".join(ARCHITECTURES)))
+        # Pairs for architectures that are not being run are allowed
+        if model_name in weights_by_model:
+            weights_by_model[model_name] = path
+    return weights_by_model
+
+
+def set_execution_options(options):
+    """
+    Sets the execution options models are built with when a caller does not
+    pass any, such as the --precision and --optimize of a run.
+
+    Args:
+        options (ExecutionOptions): Options for models loaded from now on
+
+    Returns:
+        None
+    """
+    global _default_options
+    _default_options = options
+
+
+def get_execution_options():
+    """Returns the execution options models are built with by default."""
+    return _default_options
+
+
+def _registry_key(model_name, weights=None, device='cpu', options=None):
+    """
+    Builds the registry key for a model.
+
+    Args:
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Path to a local weights file, or None for the
+                       torchvision pretrained weights
+        device (str): Torch device the model lives on
+        options (ExecutionOptions): Execution options, or None for the default
+
+    Returns:
+        tuple: (model_name, weights source, device, options)
+    """
+    source = PRETRAINED if weights is None else os.path.abspath(weights)
+    return (model_name, source, str(device), options or _default_options)
+
+
+def _torchvision_entry(model_name):
+    """
+    Resolves an architecture to its torchvision builder and weights enum.
+
+    Args:
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+
+    Returns:
+        tuple: (builder function, weights enum)
+    """
+    import torchvision.models as models
+
+    builder_name, weights_name = ARCHITECTURES[model_name]
+    return getattr(models, builder_name), getattr(models, weights_name)
+
+
+def _build_model(model_name, weights, device, options):
+    """
+    Constructs a model, loads its weights and applies the execution options.
+
+    Args:
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Path to a local state_dict file, or None to use the
+                       torchvision pretrained weights (downloaded on first use)
+        device (str): Torch device to move the model to
+        options (ExecutionOptions): Precision and optimizations to apply
+
+    Returns:
+        torch.nn.Module: The model in evaluation mode
+    """
+    import torch
+
+    builder, weights_enum = _torchvision_entry(model_name)
+
+    if weights is None:
+        model = builder(weights=weights_enum.DEFAULT)
+    else:
+        # Build the bare network and fill it from the local file so no
+        # network access is needed
+        model = builder(weights=None)
+        state_dict = torch.load(weights, map_location=device, weights_only=True)
+        model.load_state_dict(state_dict)
+
+    model.to(device)
+    model.eval()
+    return apply_execution_options(model, options, device)
+
+
+def get_model(model_name, weights=None, device='cpu', options=None):
+    """
+    Returns the loaded model for an architecture, building it on first use.
+
+    Args:
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Path to a local state_dict file, or None to use the
+                       torchvision pretrained weights
+        device (str): Torch device the model should live on
+        options (ExecutionOptions): Precision and optimizations, or None for
+                                    the ones set by set_execution_options
+
+    Returns:
+        torch.nn.Module: The shared model instance in evaluation mode
+
+    Raises:
+        ValueError: If model_name is not a supported architecture
+    """
+    if model_name not in ARCHITECTURES:
+        raise ValueError("Model name '{}' not recognized. Acceptable values: {}".format(
+            model_name, ", ".join(ARCHITECTURES)))
+
+    key = _registry_key(model_name, weights, device, options)
+
+    # Loaded models are returned without waiting for any build
+    with _lock:
+        model = _models.get(key)
+        if model is not None:
+            return model
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    # Only one thread builds a given model; the others wait and reuse it
+    with build_lock:
+        with _lock:
+            model = _models.get(key)
+        if model is None:
+            with profiling.stage('model_load:' + model_name):
+                model = _build_model(model_name, weights, device, key[3])
+            with _lock:
+                _models[key] = model
+                _build_locks.pop(key, None)
+        return model
+
+
+def preload(model_names, weights=None, device='cpu', options=None):
+    """
+    Loads one or more models ahead of the first classification.
+
+    Args:
+        model_names (str or list): Architecture name or list of names
+        weights (str): Path to a local state_dict file, or None to use the
+                       torchvision pretrained weights
+        device (str): Torch device the models should live on
+        options (ExecutionOptions): Execution options, or None for the default
+
+    Returns:
+        None
+    """
+    if isinstance(model_names, str):
+        model_names = [model_names]
+
+    for model_name in model_names:
+        get_model(model_name, weights, device, options)
+
+
+def evict(model_name=None, weights=None, device='cpu', options=None):
+    """
+    Drops models from the registry so their memory can be reclaimed.
+
+    Args:
+        model_name (str): Architecture to evict, or None to evict every model
+        weights (str): Weights source of the model to evict
+        device (str): Device of the model to evict
+        options (ExecutionOptions): Execution options of the model to evict
+
+    Returns:
+        bool: True if at least one model was evicted
+    """
+    with _lock:
+        if model_name is None:
+            evicted = bool(_models)
+            _models.clear()
+            return evicted
+
+        return _models.pop(_registry_key(model_name, weights, device, options), None) is not None
+
+
+def weights_version(model_name, weights=None):
+    """
+    Describes the weights a model would be loaded with, for use in cache keys.
+
+    Args:
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Path to a local state_dict file, or None for the
+                       torchvision pretrained weights
+
+    Returns:
+        str: The pretrained weights enum and installed torchvision version,
+             or the local file's absolute path, size and modification time
+    """
+    # Read from package metadata so a fully cached run never imports torchvision
+    if weights is None:
+        from importlib.metadata import version
+        return "{}.DEFAULT|torchvision-{}".format(ARCHITECTURES[model_name][1], version('torchvision'))
+
+    stat = os.stat(weights)
+    return "{}|{}|{}".format(os.path.abspath(weights), stat.st_size, stat.st_mtime_ns)
+
+
+def model_version(model_name, weights=None, options=None):
+    """
+    Describes the weights and execution options behind a model's
+    predictions, for use in cache keys.
+
+    Args:
+        model_name (str): CNN model architecture (resnet, alexnet or vgg)
+        weights (str): Path to a local state_dict file, or None for the
+                       torchvision pretrained weights
+        options (ExecutionOptions): Execution options, or None for the default
+
+    Returns:
+        str: weights_version, followed by the execution options unless they
+             are the fp32 eager defaults (so existing cache entries stay valid)
+    """
+    options = options or _default_options
+    version = weights_version(model_name, weights)
+    if options != DEFAULT_OPTIONS:
+        version += "|" + options_tag(options)
+    return version
+
+
+def loaded_models():
+    """
+    Lists the models currently held in the registry.
+
+    Returns:
+        list: (model_name, weights source, device, options) tuples
+    """
+    with _lock:
+        return list(_models)
@@ -0,0 +1,234 @@
+"""
+Module for caching classifier predictions on disk between runs.
+This module stores the top-k class ids and scores for each image in a
+SQLite file, keyed by the image content hash, model architecture, weights
+version and preprocessing, so unchanged images are never reclassified.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+DEFAULT_CACHE_FILE = '.prediction_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 100000
+
+# Bytes read per chunk when hashing image files
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """
+    Computes the SHA-256 of a file's contents.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Size-bounded, least-recently-used store of predictions on disk.
+
+    New hashes, new predictions and hit times are kept in memory until
+    commit(), which writes them in one short transaction; the file is in
+    WAL mode, so worker processes and other runs sharing it keep reading
+    while one of them commits, and are only locked out for that write.
+
+    Attributes:
+        hits (int): Lookups answered from the cache since it was opened
+        misses (int): Lookups that had to fall back to inference
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_entries=DEFAULT_MAX_ENTRIES,
+                 rebuild=False):
+        """
+        Opens (creating if needed) the cache file.
+
+        Args:
+            path (str): Path to the SQLite cache file
+            max_entries (int): Number of predictions (and of stored file
+                               hashes) kept before the least recently used
+                               ones are evicted
+            rebuild (bool): True ignores stored predictions so every image is
+                            reclassified and its entry overwritten
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.rebuild = rebuild
+        self.hits = 0
+        self.misses = 0
+
+        # Worker processes may share the file, so wait for their (short)
+        # write transactions; autocommit mode lets commit() open its own
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " key TEXT PRIMARY KEY, class_ids TEXT, scores TEXT, last_used REAL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        # Remembers content hashes so unchanged files are not re-read
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+
+        # Writes waiting for the next commit()
+        self._new_hashes = {}
+        self._new_predictions = {}
+        self._last_used = {}
+
+    @staticmethod
+    def make_key(content_hash, model_name, weights_version, preprocess_config):
+        """
+        Builds the cache key for one image and model configuration.
+
+        Args:
+            content_hash (str): Hash of the image file contents
+            model_name (str): CNN model architecture
+            weights_version (str): Identifies the model weights
+            preprocess_config (str): Identifies the image preprocessing
+
+        Returns:
+            str: The cache key
+        """
+        return "|".join([content_hash, model_name, weights_version, preprocess_config])
+
+    def content_hash(self, path):
+        """
+        Returns the content hash of a file, reusing the stored hash while
+        the file's size and modification time are unchanged.
+
+        Args:
+            path (str or io.BytesIO): Path to the image file, or the image
+                                      bytes read from an archive
+
+        Returns:
+            str: Hex digest of the file contents
+        """
+        if not isinstance(path, str):
+            return hashlib.sha256(path.getbuffer()).hexdigest()
+
+        abs_path = os.path.abspath(path)
+        stat = os.stat(abs_path)
+
+        row = self._conn.execute(
+            "SELECT hash FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (abs_path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+
+        digest = file_hash(abs_path)
+        self._new_hashes[abs_path] = (abs_path, stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def get(self, key):
+        """
+        Looks up a stored prediction and counts the hit or miss.
+
+        Args:
+            key (str): Cache key from make_key()
+
+        Returns:
+            tuple: (class_ids, scores) lists, or None if not cached
+        """
+        row = None
+        if not self.rebuild:
+            row = self._conn.execute(
+                "SELECT class_ids, scores FROM predictions WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._last_used[key] = time.time()
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, key, class_ids, scores):
+        """
+        Stores a prediction on the next commit(), which also evicts the
+        entries above max_entries.
+
+        Args:
+            key (str): Cache key from make_key()
+            class_ids (list): Top-k class ids, best first
+            scores (list): Softmax scores matching class_ids
+
+        Returns:
+            None
+        """
+        self._new_predictions[key] = (key, json.dumps(class_ids), json.dumps(scores), time.time())
+
+    def _evict(self):
+        """
+        Deletes the least recently used predictions above max_entries, the
+        stored hashes no prediction uses any more, and the oldest stored
+        hashes above max_entries (e.g. left by renamed files).
+        """
+        count = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM predictions WHERE key IN ("
+                " SELECT key FROM predictions ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,))
+            # Keys start with the content hash and '|', so a key range scan
+            # finds the predictions of a hash ('}' sorts right after '|')
+            self._conn.execute(
+                "DELETE FROM file_hashes WHERE NOT EXISTS ("
+                " SELECT 1 FROM predictions"
+                " WHERE key > file_hashes.hash || '|' AND key < file_hashes.hash || '}')")
+
+        # Replaced rows get a new rowid, so the lowest rowids were hashed longest ago
+        count = self._conn.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM file_hashes WHERE rowid IN ("
+                " SELECT rowid FROM file_hashes ORDER BY rowid LIMIT ?)",
+                (count - self.max_entries,))
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def commit(self):
+        """
+        Writes the pending hashes, predictions and hit times to disk and
+        evicts entries above max_entries, in one transaction.
+        """
+        if not (self._new_hashes or self._new_predictions or self._last_used):
+            return
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                                   self._new_hashes.values())
+            self._conn.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                                   self._new_predictions.values())
+            self._conn.executemany("UPDATE predictions SET last_used = ? WHERE key = ?",
+                                   [(last_used, key) for key, last_used in self._last_used.items()])
+            # Only new rows can push a table over max_entries
+            if self._new_hashes or self._new_predictions:
+                self._evict()
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+        self._new_hashes.clear()
+        self._new_predictions.clear()
+        self._last_used.clear()
+
+    def close(self):
+        """Writes pending changes and closes the cache file."""
+        self.commit()
+        self._conn.close()
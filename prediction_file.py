@@ -0,0 +1,162 @@
+"""
+Module for saving the top-k predictions of a run in a compact binary file.
+This module writes the filenames and, per architecture, the top-k ImageNet
+class ids (uint16) and softmax scores (float32) of every classified image, so
+the labels, matches, dog checks and statistics can be recomputed later
+(check_images.py --rescore) without loading any model.
+
+File layout, little-endian:
+
+    magic       8 bytes, b'PETPRED1'
+    header      uint32 length, then JSON {"models", "topk", "count"}
+    filenames   uint32 length, then the UTF-8 filenames separated by '\\0'
+    per model   count x topk uint16 class ids, then count x topk float32 scores
+"""
+
+import json
+import os
+import struct
+import sys
+from array import array
+
+
+MAGIC = b'PETPRED1'
+
+
+def _to_bytes(values):
+    """Returns the little-endian bytes of an array."""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    """Reads a little-endian array."""
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class PredictionWriter:
+    """
+    Collects the predictions of a run in compact columns and writes them
+    out on close().
+
+    Attributes:
+        path (str): File written on close()
+        models (list): Architectures whose predictions are stored
+        topk (int): Predictions kept per image and architecture
+    """
+
+    def __init__(self, path, models, topk=5):
+        """
+        Args:
+            path (str): File to write; replaced only once it is complete
+            models (list): Names of the CNN model architectures
+            topk (int): Predictions kept per image and architecture
+                        (default: 5)
+        """
+        self.path = path
+        self.models = list(models)
+        self.topk = topk
+        self._filenames = []
+        self._class_ids = {model: array('H') for model in self.models}
+        self._scores = {model: array('f') for model in self.models}
+
+    def add(self, filename, predictions):
+        """
+        Adds the predictions of one image.
+
+        Args:
+            filename (str): Image filename, relative to the image folder
+            predictions (dict): (top-k class ids, scores) per architecture,
+                                as classify_images_stream yields them
+        """
+        for model in self.models:
+            class_ids, scores = predictions[model]
+            if len(class_ids) < self.topk:
+                raise ValueError("{} has {} predictions for {}, expected {}".format(
+                    filename, len(class_ids), model, self.topk))
+            self._class_ids[model].extend(class_ids[:self.topk])
+            self._scores[model].extend(scores[:self.topk])
+        self._filenames.append(filename)
+
+    def close(self):
+        """Writes the file."""
+        header = json.dumps({'models': self.models, 'topk': self.topk,
+                             'count': len(self._filenames)}).encode('utf-8')
+        filenames = '\0'.join(self._filenames).encode('utf-8')
+
+        # Write next to the target and swap it in, so a failed run never
+        # leaves a truncated file behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(struct.pack('<I', len(filenames)))
+            f.write(filenames)
+            for model in self.models:
+                f.write(_to_bytes(self._class_ids[model]))
+                f.write(_to_bytes(self._scores[model]))
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def load_predictions(path):
+    """
+    Reads a file written by PredictionWriter.
+
+    Args:
+        path (str): Path to the predictions file
+
+    Returns:
+        tuple: (models, predictions) where models lists the architectures and
+               predictions lists (filename, {model: (class_ids, scores)})
+               pairs in the order the images were classified
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a predictions file".format(path))
+
+    offset = len(MAGIC)
+    (size,) = struct.unpack_from('<I', data, offset)
+    header = json.loads(data[offset + 4:offset + 4 + size].decode('utf-8'))
+    offset += 4 + size
+    (size,) = struct.unpack_from('<I', data, offset)
+    filenames = data[offset + 4:offset + 4 + size].decode('utf-8')
+    offset += 4 + size
+
+    models, topk, count = header['models'], header['topk'], header['count']
+    filenames = filenames.split('\0') if count else []
+
+    # Each model's columns, sliced per image below
+    columns = {}
+    for model in models:
+        class_ids = _from_bytes('H', data[offset:offset + 2 * count * topk])
+        offset += 2 * count * topk
+        scores = _from_bytes('f', data[offset:offset + 4 * count * topk])
+        offset += 4 * count * topk
+        columns[model] = (class_ids, scores)
+
+    if len(filenames) != count or offset != len(data):
+        raise ValueError("{} is truncated or corrupt".format(path))
+
+    predictions = []
+    for i, filename in enumerate(filenames):
+        start, end = i * topk, (i + 1) * topk
+        predictions.append((filename, {model: (class_ids[start:end].tolist(),
+                                                scores[start:end].tolist())
+                                       for model, (class_ids, scores) in columns.items()}))
+    return models, predictions
@@ -0,0 +1,177 @@
+"""
+Module for turning image files into normalized model inputs.
+This module builds the resize/crop/normalize pipeline once per configuration
+and reuses it for every image. Optionally JPEGs are decoded directly at a
+reduced size with PIL's draft mode when the full resolution is not needed,
+and the normalized pixels are written into a caller-provided tensor (such
+as a row of a reusable batch buffer) instead of a new one per image.
+"""
+
+import threading
+
+
+# Preprocessors built so far, keyed by their configuration
+_preprocessors = {}
+_lock = threading.Lock()
+
+
+class Preprocessor:
+    """
+    Resize, center-crop and normalize pipeline matching torchvision's
+    Resize(resize_size), CenterCrop(crop_size), ToTensor(), Normalize(mean, std).
+
+    Attributes:
+        resize_size (int): Length the shorter image side is resized to
+        crop_size (int): Side of the square center crop
+        draft (bool): Let the JPEG decoder downscale while decoding
+        output_shape (tuple): Shape of one preprocessed image, (3, crop, crop)
+    """
+
+    def __init__(self, resize_size, crop_size, mean, std, draft=False):
+        """
+        Args:
+            resize_size (int): Length the shorter image side is resized to
+            crop_size (int): Side of the square center crop
+            mean (list): Per-channel mean subtracted after scaling to 0..1
+            std (list): Per-channel standard deviation divided by
+            draft (bool): Decode JPEGs at a reduced size where it stays at
+                          least resize_size on the shorter side; faster,
+                          but not pixel-identical to torchvision
+                          (default: False)
+        """
+        import torch
+
+        self.resize_size = resize_size
+        self.crop_size = crop_size
+        self.draft = draft
+        self.output_shape = (3, crop_size, crop_size)
+
+        # (pixel / 255 - mean) / std folded into pixel * scale - offset
+        std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+        self._scale = 1.0 / (255.0 * std)
+        self._offset = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1) / std
+
+    def load_image(self, img_path):
+        """
+        Decodes, resizes and center-crops one image.
+
+        Args:
+            img_path (str or file): Path to the image, or a binary file object
+
+        Returns:
+            PIL.Image.Image: The crop_size x crop_size RGB image
+        """
+        from PIL import Image
+
+        # An in-memory image may be decoded again, e.g. by each cascade stage
+        if hasattr(img_path, 'seek'):
+            img_path.seek(0)
+        img = Image.open(img_path)
+
+        # Target size of the shorter-side resize, as torchvision computes it
+        width, height = img.size
+        if width <= height:
+            size = (self.resize_size, int(self.resize_size * height / width))
+        else:
+            size = (int(self.resize_size * width / height), self.resize_size)
+
+        # For JPEGs, decode at 1/2, 1/4 or 1/8 scale while still at least
+        # as large as the target; a no-op for other formats
+        if self.draft:
+            img.draft('RGB', size)
+
+        img = img.convert('RGB').resize(size, Image.BILINEAR)
+
+        left = int(round((size[0] - self.crop_size) / 2.0))
+        top = int(round((size[1] - self.crop_size) / 2.0))
+        return img.crop((left, top, left + self.crop_size, top + self.crop_size))
+
+    def load_pixels(self, img_path, out):
+        """
+        Decodes, resizes and center-crops one image into a uint8 tensor,
+        before normalization (for example into a row of a TensorCache).
+
+        Args:
+            img_path (str or file): Path to the image, or a binary file object
+            out (torch.Tensor): 3 x crop_size x crop_size uint8 tensor
+
+        Returns:
+            torch.Tensor: out, holding the pixels channel first
+        """
+        import numpy as np
+        import torch
+
+        # np.array copies PIL's read-only bytes so torch can wrap them
+        pixels = torch.from_numpy(np.array(self.load_image(img_path)))
+        return out.copy_(pixels.permute(2, 0, 1))
+
+    def normalize(self, pixels, out):
+        """
+        Converts uint8 pixels (one image or a batch) to normalized floats.
+
+        Args:
+            pixels (torch.Tensor): 3xHxW or Nx3xHxW uint8 pixels
+            out (torch.Tensor): Float tensor of the same shape to write into
+
+        Returns:
+            torch.Tensor: out, holding the normalized pixels
+        """
+        out.copy_(pixels)
+        return out.mul_(self._scale).sub_(self._offset)
+
+    def __call__(self, img_path, out=None):
+        """
+        Preprocesses one image into a tensor.
+
+        Args:
+            img_path (str or file): Path to the image, or a binary file object
+            out (torch.Tensor): 3 x crop_size x crop_size float tensor to write
+                                into, such as a row of new_batch(), or None to
+                                allocate one
+
+        Returns:
+            torch.Tensor: out, holding the normalized image
+        """
+        import numpy as np
+        import torch
+
+        if out is None:
+            out = torch.empty(self.output_shape)
+
+        # HxWx3 uint8 pixels (np.array copies PIL's read-only bytes so torch
+        # can wrap them), converted and normalized in place in out
+        pixels = torch.from_numpy(np.array(self.load_image(img_path)))
+        return self.normalize(pixels.permute(2, 0, 1), out)
+
+    @property
+    def pixels_config(self):
+        """Identifies the uint8 pixels load_pixels produces, for caches."""
+        return "rgb|resize={}|crop={}{}".format(self.resize_size, self.crop_size,
+                                               "|draft" if self.draft else "")
+
+    def new_batch(self, batch_size):
+        """Allocates an uninitialized batch_size x 3 x crop x crop buffer."""
+        import torch
+
+        return torch.empty((batch_size,) + self.output_shape)
+
+
+def get_preprocessor(resize_size, crop_size, mean, std, draft=False):
+    """
+    Returns the shared Preprocessor for a configuration, building it once.
+
+    Args:
+        resize_size (int): Length the shorter image side is resized to
+        crop_size (int): Side of the square center crop
+        mean (list): Per-channel normalization mean
+        std (list): Per-channel normalization standard deviation
+        draft (bool): Decode JPEGs at a reduced size (default: False)
+
+    Returns:
+        Preprocessor: The preprocessor for this configuration
+    """
+    key = (resize_size, crop_size, tuple(mean), tuple(std), draft)
+    with _lock:
+        if key not in _preprocessors:
+            _preprocessors[key] = Preprocessor(resize_size, crop_size, mean, std, draft)
+        return _preprocessors[key]
@@ -96,3 +96,32 @@ def print_results(results_dic, results_stats_dic, model,
             if sum(results_dic[key][3:]) == 2 and results_dic[key][2] == 0:
                 print("Real: {:>26}   Classifier: {:>30}".format(results_dic[key][0], 
                                                                    results_dic[key][1]))
+
+
+def print_comparison(results_stats_dics):
+    """
+    Prints the results statistics of several CNN model architectures side by
+    side so they can be compared in one table.
+    Parameters:
+      results_stats_dics - Dictionary with key as the CNN model architecture
+                     (string) and value as the results_stats_dic returned by
+                     calculates_results_stats for that architecture
+    Returns:
+           None - simply printing results.
+    """
+    models = list(results_stats_dics)
+    
+    print("\n\n*** Side-by-Side Comparison of CNN Model Architectures ***")
+    print("{:20}".format('') + "".join("{:>10}".format(model.upper()) for model in models))
+    
+    # Counts are the same for every architecture but are shown for reference
+    for key, name in [('n_images', 'N Images'), ('n_dogs_img', 'N Dog Images'),
+                      ('n_notdogs_img', 'N Not-Dog Images')]:
+        print("{:20}".format(name) + "".join("{:10d}".format(results_stats_dics[model][key])
+                                            for model in models))
+    
+    # Percentages, in the order print_results lists them
+    for key in results_stats_dics[models[0]]:
+        if key.startswith('pct'):
+            print("{:20}".format(key) + "".join("{:9.1f}%".format(results_stats_dics[model][key])
+                                                for model in models))
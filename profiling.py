@@ -0,0 +1,437 @@
+"""
+Module for timing the stages of a run and summarizing image latencies.
+This module keeps one process-wide Profiler that the pipeline reports to
+(model loading, decoding, forward passes, result stages, ...) while it is
+enabled, and that costs a single check per stage while it is not. The
+report has per-stage totals, per-item p50/p95/p99 latencies and histograms,
+the end-to-end latency of every image, images/sec and peak memory.
+"""
+
+import math
+import os
+import sys
+import threading
+from array import array
+from time import perf_counter
+
+
+# Stage recording the time from the start of an image's decode until every
+# architecture has classified it
+IMAGE_LATENCY = 'image_latency'
+
+# Upper bounds (ms) of the latency histogram buckets, doubling from 0.01 ms;
+# the last bucket holds everything slower
+HISTOGRAM_BOUNDS_MS = tuple(0.01 * 2 ** i for i in range(24))
+
+# Profiler the pipeline reports to, or None while profiling is off
+_active = None
+
+# Decode start time of the images in flight, keyed by path
+_image_starts = {}
+
+
+class Profiler:
+    """
+    Thread-safe collection of stage timings.
+
+    Stages timed once per item (e.g. decoding one image) keep every call's
+    time, for percentiles and a histogram. Stages timed per batch or per run
+    only report their mean time per item: their calls say nothing about the
+    time any single item took.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self.start_time = perf_counter()
+
+    def add(self, name, seconds, items=1):
+        """
+        Records one call of a stage.
+
+        Args:
+            name (str): Stage name, e.g. 'decode' or 'forward:resnet'
+            seconds (float): Time the call took
+            items (int): Number of images the call handled (default: 1)
+        """
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = _new_stage()
+            stage['calls'] += 1
+            stage['total_s'] += seconds
+            stage['items'] += items
+            if items == 1:
+                stage['samples'].append(seconds)
+            else:
+                stage['batched'] = True
+
+    def drain(self):
+        """Returns the stages recorded so far and starts again empty, for merge()."""
+        with self._lock:
+            stages, self._stages = self._stages, {}
+        return stages
+
+    def merge(self, stages):
+        """Adds stages drained from another Profiler (such as a worker process's)."""
+        with self._lock:
+            for name, other in stages.items():
+                stage = self._stages.setdefault(name, _new_stage())
+                stage['calls'] += other['calls']
+                stage['total_s'] += other['total_s']
+                stage['items'] += other['items']
+                stage['samples'].extend(other['samples'])
+                stage['batched'] = stage['batched'] or other['batched']
+
+    def report(self, n_images=0, worker_processes=False):
+        """
+        Summarizes the run so far.
+
+        Args:
+            n_images (int): Number of images the run classified
+            worker_processes (bool): True when the run used worker
+                                     processes, to report their peak memory
+                                     (default: False)
+
+        Returns:
+            dict: wall_s, images, images_per_s, peak_rss_mb (None where it
+                  cannot be measured) and, with worker_processes,
+                  peak_child_rss_mb, plus per-stage calls, total_s, items and
+                  mean_ms per item, and for stages timed once per item
+                  p50/p95/p99/max in ms with a histogram
+        """
+        wall_s = perf_counter() - self.start_time
+        with self._lock:
+            stages = {name: _summarize(stage) for name, stage in self._stages.items()}
+
+        report = {
+            'wall_s': wall_s,
+            'images': n_images,
+            'images_per_s': n_images / wall_s if wall_s > 0 else 0.0,
+            'peak_rss_mb': peak_rss_mb(),
+            'histogram_bounds_ms': list(HISTOGRAM_BOUNDS_MS),
+            'stages': stages,
+        }
+        if worker_processes:
+            report['peak_child_rss_mb'] = peak_rss_mb(children=True)
+        return report
+
+
+def _new_stage():
+    return {'calls': 0, 'total_s': 0.0, 'items': 0, 'samples': array('d'), 'batched': False}
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident memory of this process, or of its largest finished child
+    process (such as a worker), in MB (2 ** 20 bytes).
+
+    Uses the resource module where it exists (Unix), else psutil when it is
+    installed, which only reports this process.
+
+    Args:
+        children (bool): Report the child processes instead (default: False)
+
+    Returns:
+        float: The peak in MB, or None where it cannot be measured
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        return usage.ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+    if children:
+        return None
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    # Windows keeps the peak working set; other platforms only the current size
+    return getattr(memory, 'peak_wset', memory.rss) / (1 << 20)
+
+
+def current_rss_mb():
+    """
+    Current resident memory of this process in MB (2 ** 20 bytes).
+
+    Returns:
+        float: The resident size, or None where it cannot be measured
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1 << 20)
+
+    # Linux without psutil
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except OSError:
+        return None
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of sorted values."""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _summarize(stage):
+    summary = {'calls': stage['calls'], 'total_s': stage['total_s'], 'items': stage['items']}
+    if stage['items'] > 0:
+        summary['mean_ms'] = stage['total_s'] / stage['items'] * 1000
+
+    # Percentiles only mean something when every item was timed on its own
+    samples = sorted(stage['samples'])
+    if stage['batched'] or not samples:
+        return summary
+
+    histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    bucket = 0
+    for sample in samples:
+        while bucket < len(HISTOGRAM_BOUNDS_MS) and sample * 1000 > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+
+    summary.update({
+        'p50_ms': _percentile(samples, 0.50) * 1000,
+        'p95_ms': _percentile(samples, 0.95) * 1000,
+        'p99_ms': _percentile(samples, 0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+        'histogram': histogram,
+    })
+    return summary
+
+
+class _Stage:
+    """Context manager adding its elapsed time to the active profiler."""
+
+    __slots__ = ('name', 'items', 'start')
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        profiler = _active
+        if profiler is not None:
+            profiler.add(self.name, perf_counter() - self.start, self.items)
+
+
+class _NoStage:
+    """Stand-in for _Stage while profiling is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return None
+
+
+_NO_STAGE = _NoStage()
+
+
+def enable(profiler=None):
+    """
+    Starts reporting to a profiler.
+
+    Args:
+        profiler (Profiler): Profiler to report to, or None for a new one
+
+    Returns:
+        Profiler: The active profiler
+    """
+    global _active
+    _active = profiler or Profiler()
+    return _active
+
+
+def disable():
+    """Stops profiling; stage() and the other hooks become no-ops again."""
+    global _active
+    _active = None
+    _image_starts.clear()
+
+
+def get_profiler():
+    """Returns the active Profiler, or None while profiling is off."""
+    return _active
+
+
+def stage(name, items=1):
+    """
+    Times a block as one call of a stage, when profiling is on:
+
+        with profiling.stage('forward:resnet', len(batch)):
+            ...
+
+    Args:
+        name (str): Stage name
+        items (int): Number of images the block handles (default: 1)
+    """
+    if _active is None:
+        return _NO_STAGE
+    return _Stage(name, items)
+
+
+def timed_loader(load_fn, name='decode'):
+    """
+    Wraps an image_pipeline load function so every call is timed as a stage
+    and starts the image's end-to-end latency; returns load_fn unchanged
+    while profiling is off.
+    """
+    if _active is None:
+        return load_fn
+
+    def load(img_path, out):
+        start = perf_counter()
+        _image_starts[img_path] = start
+        result = load_fn(img_path, out)
+        profiler = _active
+        if profiler is not None:
+            profiler.add(name, perf_counter() - start)
+        return result
+
+    return load
+
+
+def timed_iter(name, batches):
+    """
+    Times how long the consumer waits for each (indices, batch) of an
+    iter_batches-style iterator, as a stage over the batch's images;
+    returns batches unchanged while profiling is off.
+    """
+    if _active is None:
+        return batches
+    return _timed_iter(name, iter(batches))
+
+
+def _timed_iter(name, batches):
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                item = next(batches)
+            except StopIteration:
+                return
+            profiler = _active
+            if profiler is not None:
+                profiler.add(name, perf_counter() - start, len(item[0]))
+            yield item
+    finally:
+        # Stops the wrapped pipeline if the consumer exits early
+        close = getattr(batches, 'close', None)
+        if close is not None:
+            close()
+
+
+def images_done(img_paths, default_start):
+    """
+    Records the end-to-end latency of images that finished classifying.
+
+    Args:
+        img_paths (list): Paths of the finished images
+        default_start (float): perf_counter() start for images that were not
+                               decoded through timed_loader (e.g. read from
+                               the tensor cache)
+    """
+    profiler = _active
+    if profiler is None:
+        return
+    now = perf_counter()
+    for img_path in img_paths:
+        profiler.add(IMAGE_LATENCY, now - _image_starts.pop(img_path, default_start))
+
+
+def format_report(report):
+    """
+    Formats a report() as the table printed after the results.
+
+    Returns:
+        str: One line per stage, slowest total first, then the throughput
+             and memory lines; the percentile columns are left blank ('-')
+             for stages timed per batch or per run
+    """
+    lines = ["\n*** Profile: {:.3f} s wall, {} images, {:.1f} images/s ***".format(
+        report['wall_s'], report['images'], report['images_per_s'])]
+    lines.append("{:28} {:>7} {:>10} {:>7} {:>10} {:>10} {:>10} {:>10}".format(
+        'Stage', 'calls', 'total s', '% wall', 'ms/item', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['total_s']):
+        # Image latencies overlap, so their total is not a share of the run
+        if 'mean_ms' not in stage or name == IMAGE_LATENCY:
+            continue
+        if 'p50_ms' in stage:
+            percentiles = ["{:10.3f}".format(stage[key]) for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+        else:
+            percentiles = ["{:>10}".format('-')] * 3
+        lines.append("{:28} {:7d} {:10.3f} {:6.1f}% {:10.3f} {}".format(
+            name, stage['calls'], stage['total_s'],
+            stage['total_s'] / report['wall_s'] * 100 if report['wall_s'] else 0.0,
+            stage['mean_ms'], " ".join(percentiles)))
+    latency = report['stages'].get(IMAGE_LATENCY)
+    if latency and 'p50_ms' in latency:
+        lines.append("Image latency: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+            latency['p50_ms'], latency['p95_ms'], latency['p99_ms'], latency['max_ms']))
+    if report['peak_rss_mb'] is None:
+        lines.append("Peak RSS: unavailable (install psutil)")
+    else:
+        lines.append("Peak RSS: {:.1f} MB".format(report['peak_rss_mb']))
+    if report.get('peak_child_rss_mb') is not None:
+        lines.append("Largest worker process peak RSS: {:.1f} MB".format(
+            report['peak_child_rss_mb']))
+    return "\n".join(lines)
+
+
+class TraceRecorder:
+    """
+    Optional cProfile and torch profiler traces around part of a run.
+
+    Attributes:
+        cprofile_path (str): File for cProfile stats (pstats format), or None
+        torch_trace_path (str): File for a Chrome trace from the torch
+                                profiler, or None
+    """
+
+    def __init__(self, cprofile_path=None, torch_trace_path=None):
+        self.cprofile_path = cprofile_path
+        self.torch_trace_path = torch_trace_path
+        self._cprofile = None
+        self._torch_profiler = None
+
+    def start(self):
+        """Starts the requested profilers."""
+        if self.torch_trace_path:
+            from torch.profiler import ProfilerActivity, profile
+
+            self._torch_profiler = profile(activities=[ProfilerActivity.CPU],
+                                           record_shapes=True)
+            self._torch_profiler.start()
+        if self.cprofile_path:
+            import cProfile
+
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        """Stops the profilers and writes their files."""
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler.export_chrome_trace(self.torch_trace_path)
+            self._torch_profiler = None
@@ -0,0 +1,166 @@
+"""
+Module for holding classification results in compact columns.
+This module stores one row per image with labels interned to integer ids and
+the match/is-a-dog flags in uint8 columns, while still behaving like the
+results_dic dictionary of lists the rest of the program expects.
+"""
+
+from array import array
+from collections.abc import MutableMapping, MutableSequence
+
+
+# Names of the values in a results_dic list, in index order
+FIELDS = ('pet_label', 'classifier_label', 'match', 'pet_is_dog', 'classifier_is_dog')
+
+# Fields stored as interned label ids; the rest are 0/1 flags
+_LABEL_FIELDS = 2
+
+
+class ResultRow(MutableSequence):
+    """
+    List-like view of one image's results inside a ResultsStore.
+
+    Reading, assigning, append() and extend() go straight to the store's
+    columns, so code written for results_dic lists works unchanged.
+    """
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __len__(self):
+        return self._store._n_fields[self._row]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._store._get_field(self._row, i) for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("result index out of range")
+        return self._store._get_field(self._row, index)
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("result index out of range")
+        self._store._set_field(self._row, index, value)
+
+    def __delitem__(self, index):
+        raise TypeError("results cannot be removed from a row")
+
+    def insert(self, index, value):
+        # Rows only grow at the end, one field at a time
+        if index < len(self) or len(self) >= len(FIELDS):
+            raise TypeError("results can only be appended to a row, up to {} fields".format(len(FIELDS)))
+        self._store._set_field(self._row, len(self), value)
+        self._store._n_fields[self._row] += 1
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ResultsStore(MutableMapping):
+    """
+    Columnar, dict-compatible replacement for results_dic.
+
+    Keys are image filenames and values are ResultRow views holding
+    [pet_label, classifier_label, match, pet_is_dog, classifier_is_dog].
+    """
+
+    def __init__(self, results_dic=None):
+        """
+        Creates an empty store, optionally filled from a results_dic.
+
+        Args:
+            results_dic (dict): Dictionary of result lists to copy in
+        """
+        self._rows = {}
+        self._filenames = []
+        self._labels = []
+        self._label_ids = {}
+        self._n_fields = array('B')
+        self._columns = [array('I'), array('I'), array('B'), array('B'), array('B')]
+
+        if results_dic:
+            for filename, values in results_dic.items():
+                self[filename] = values
+
+    def _intern(self, label):
+        """Returns the integer id of a label, assigning one on first use."""
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            label_id = len(self._labels)
+            self._labels.append(label)
+            self._label_ids[label] = label_id
+        return label_id
+
+    def _get_field(self, row, index):
+        value = self._columns[index][row]
+        return self._labels[value] if index < _LABEL_FIELDS else value
+
+    def _set_field(self, row, index, value):
+        self._columns[index][row] = self._intern(value) if index < _LABEL_FIELDS else int(value)
+
+    def __getitem__(self, filename):
+        return ResultRow(self, self._rows[filename])
+
+    def __setitem__(self, filename, values):
+        values = list(values)
+        if len(values) > len(FIELDS):
+            raise ValueError("a result has at most {} fields".format(len(FIELDS)))
+
+        row = self._rows.get(filename)
+        if row is None:
+            # New row: grow every column by one
+            row = len(self._filenames)
+            self._rows[filename] = row
+            self._filenames.append(filename)
+            self._n_fields.append(0)
+            for column in self._columns:
+                column.append(0)
+
+        self._n_fields[row] = len(values)
+        for index, value in enumerate(values):
+            self._set_field(row, index, value)
+
+    def __delitem__(self, filename):
+        # The row's slots stay allocated but are excluded from every reduction
+        row = self._rows.pop(filename)
+        self._n_fields[row] = 0
+        self._filenames[row] = None
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, filename):
+        return filename in self._rows
+
+    def flag_columns(self):
+        """
+        Returns the flag columns of every image as NumPy arrays. The arrays
+        are copies, so the store can keep growing while they are in use.
+
+        Returns:
+            tuple: (match, pet_is_dog, classifier_is_dog) uint8 arrays in row
+                   order, one entry per image
+        """
+        import numpy as np
+
+        columns = [np.frombuffer(self._columns[index], dtype=np.uint8).copy()
+                   for index in range(_LABEL_FIELDS, len(FIELDS))]
+
+        # Drop removed rows only when there are any
+        if len(self._rows) != len(self._filenames):
+            live = np.fromiter((filename is not None for filename in self._filenames),
+                               dtype=bool, count=len(self._filenames))
+            columns = [column[live] for column in columns]
+
+        return tuple(columns)
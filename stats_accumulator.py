@@ -0,0 +1,194 @@
+"""
+Module for accumulating results statistics that can be merged across runs.
+This module keeps only the raw counts behind results_stats_dic, so a large
+folder can be split into shards classified separately and the shard counts
+combined afterwards; the percentages are derived at the end.
+"""
+
+import json
+
+from calculates_results_stats import calculates_results_stats, derive_results_stats
+
+
+# Raw counts kept by the accumulator, in results_stats_dic order
+COUNT_KEYS = ('n_images', 'n_dogs_img', 'n_match', 'n_correct_dogs',
+              'n_correct_notdogs', 'n_correct_breed')
+
+# Version of the JSON layout written by save_stats
+_FORMAT_VERSION = 1
+
+
+class StatsAccumulator:
+    """
+    Mergeable counts for the statistics calculates_results_stats reports.
+
+    Attributes:
+        counts (dict): The raw counts keyed by the names in COUNT_KEYS
+    """
+
+    def __init__(self, counts=None):
+        """
+        Creates an accumulator, empty or starting from existing counts.
+
+        Args:
+            counts (dict): Counts keyed by the names in COUNT_KEYS; any extra
+                           keys (such as pct_* values) are ignored
+        """
+        self.counts = dict.fromkeys(COUNT_KEYS, 0)
+        if counts:
+            for key in COUNT_KEYS:
+                self.counts[key] = int(counts.get(key, 0))
+
+    @classmethod
+    def from_results(cls, results_dic):
+        """
+        Builds an accumulator holding the counts of a whole results_dic.
+
+        Args:
+            results_dic (dict): Results dictionary or ResultsStore with all
+                                five values per image
+
+        Returns:
+            StatsAccumulator: The accumulator
+        """
+        return cls(calculates_results_stats(results_dic))
+
+    def update(self, record):
+        """
+        Adds one image's results.
+
+        Args:
+            record (list): [pet_label, classifier_label, match, pet_is_dog,
+                           classifier_is_dog] as stored in results_dic
+
+        Returns:
+            None
+        """
+        self._count(record, 1)
+
+    def remove(self, record):
+        """
+        Takes back one image's results added earlier, such as those of a
+        file that was replaced or deleted.
+
+        Args:
+            record (list): The same five values given to update()
+
+        Returns:
+            None
+        """
+        self._count(record, -1)
+
+    def _count(self, record, step):
+        match, pet_is_dog, classifier_is_dog = record[2], record[3], record[4]
+
+        self.counts['n_images'] += step
+        if match == 1:
+            self.counts['n_match'] += step
+
+        if pet_is_dog == 1:
+            self.counts['n_dogs_img'] += step
+            if match == 1:
+                self.counts['n_correct_breed'] += step
+            if classifier_is_dog == 1:
+                self.counts['n_correct_dogs'] += step
+        elif classifier_is_dog == 0:
+            self.counts['n_correct_notdogs'] += step
+
+    def merge(self, other):
+        """
+        Adds the counts of another accumulator, such as another shard's.
+
+        Args:
+            other (StatsAccumulator): Accumulator to fold into this one
+
+        Returns:
+            StatsAccumulator: This accumulator, to allow chaining
+        """
+        for key in COUNT_KEYS:
+            self.counts[key] += other.counts[key]
+        return self
+
+    def results_stats_dic(self):
+        """
+        Derives the full statistics dictionary from the counts.
+
+        Returns:
+            dict: Same keys and values calculates_results_stats returns for
+                  the images accumulated so far
+        """
+        results_stats_dic = {'n_images': self.counts['n_images'],
+                             'n_dogs_img': self.counts['n_dogs_img'],
+                             'n_notdogs_img': 0}
+        for key in COUNT_KEYS[2:]:
+            results_stats_dic[key] = self.counts[key]
+        return derive_results_stats(results_stats_dic)
+
+    def to_dict(self):
+        """Returns the counts as a plain dictionary for serialization."""
+        return dict(self.counts)
+
+    @classmethod
+    def from_dict(cls, counts):
+        """Rebuilds an accumulator from to_dict() output."""
+        return cls(counts)
+
+
+def save_stats(path, accumulators):
+    """
+    Writes the accumulators of one run (one per architecture) to a JSON file.
+
+    Args:
+        path (str): Output file path
+        accumulators (dict): StatsAccumulator keyed by architecture name
+
+    Returns:
+        None
+    """
+    data = {'version': _FORMAT_VERSION,
+            'models': {model: accumulator.to_dict()
+                       for model, accumulator in accumulators.items()}}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def load_stats(path):
+    """
+    Reads accumulators written by save_stats.
+
+    Args:
+        path (str): File written by save_stats
+
+    Returns:
+        dict: StatsAccumulator keyed by architecture name
+
+    Raises:
+        ValueError: If the file was written in an unknown format
+    """
+    with open(path) as f:
+        data = json.load(f)
+
+    if data.get('version') != _FORMAT_VERSION:
+        raise ValueError("{} is not a results stats file (version {})".format(
+            path, data.get('version')))
+
+    return {model: StatsAccumulator.from_dict(counts)
+            for model, counts in data['models'].items()}
+
+
+def merge_stats_files(paths):
+    """
+    Merges the per-architecture accumulators from several shard files.
+
+    Args:
+        paths (list): Files written by save_stats
+
+    Returns:
+        dict: Merged StatsAccumulator keyed by architecture name, in the
+              order architectures first appear
+    """
+    merged = {}
+    for path in paths:
+        for model, accumulator in load_stats(path).items():
+            merged.setdefault(model, StatsAccumulator()).merge(accumulator)
+    return merged
@@ -0,0 +1,289 @@
+"""
+Module for caching decoded images in a memory-mapped file between runs.
+This module decodes, resizes and crops every image of a folder once into a
+single file of uint8 3x224x224 rows, with a SQLite index mapping each
+filename (checked against its size and modification time) to its row. Later
+runs slice batches straight out of the memory map and only normalize them,
+instead of decoding the JPEGs again; added or changed files are decoded
+incrementally.
+"""
+
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Written to the working directory like the prediction cache, so image
+# folders are left untouched and may be read-only
+DEFAULT_TENSOR_CACHE_FILE = '.tensor_cache'
+
+# Largest number of parameters in one SQLite statement
+_SQL_CHUNK = 500
+
+
+def default_tensor_cache_file(images_dir):
+    """
+    Names the default cache file of a folder in the working directory.
+
+    Rows are indexed by filenames relative to the folder, so each folder
+    gets its own file instead of evicting another folder's rows.
+
+    Args:
+        images_dir (str): Path to the folder of images
+
+    Returns:
+        str: DEFAULT_TENSOR_CACHE_FILE followed by a short hash of the
+             folder's resolved path, e.g. '.tensor_cache-3f2a9c01d4e5'
+    """
+    folder_hash = hashlib.sha256(os.path.realpath(images_dir).encode('utf-8')).hexdigest()
+    return "{}-{}".format(DEFAULT_TENSOR_CACHE_FILE, folder_hash[:12])
+
+
+class TensorCache:
+    """
+    Memory-mapped store of preprocessed (pre-normalization) image pixels.
+
+    Attributes:
+        images_dir (str): Folder the indexed filenames are relative to
+        path (str): Path to the data file; the index is path + '.index.sqlite'
+        decoded (int): Images decoded into the cache by update() since opened
+        reused (int): Images update() found already cached and unchanged
+    """
+
+    def __init__(self, images_dir, path=None, preprocessor=None):
+        """
+        Opens (creating if needed) the cache of a folder.
+
+        Args:
+            images_dir (str): Path to the folder of images
+            path (str): Data file, or None for default_tensor_cache_file()
+                        in the working directory (default: None)
+            preprocessor (Preprocessor): Pipeline producing the cached pixels,
+                                         or None for the classifier's
+        """
+        if preprocessor is None:
+            from classifier import get_image_preprocessor
+            preprocessor = get_image_preprocessor()
+
+        self.images_dir = images_dir
+        self.path = path or default_tensor_cache_file(images_dir)
+        self.preprocessor = preprocessor
+        self.row_shape = preprocessor.output_shape
+        self.row_bytes = self.row_shape[0] * self.row_shape[1] * self.row_shape[2]
+        self.decoded = 0
+        self.reused = 0
+
+        # Autocommit mode so update() can take the write lock up front with
+        # BEGIN IMMEDIATE; shard processes sharing the cache then take turns
+        self._conn = sqlite3.connect(self.path + '.index.sqlite', timeout=60,
+                                     isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " filename TEXT PRIMARY KEY, row INTEGER, size INTEGER, mtime_ns INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+
+        # Pixels cached with other resize or crop settings are unusable
+        self._conn.execute("BEGIN IMMEDIATE")
+        config = self._conn.execute("SELECT value FROM meta WHERE key = 'pixels'").fetchone()
+        if config is None or config[0] != preprocessor.pixels_config:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.execute("DELETE FROM free_rows")
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('pixels', ?)",
+                               (preprocessor.pixels_config,))
+            with open(self.path, 'wb'):
+                pass
+        self._conn.execute("COMMIT")
+
+    def _key(self, img_path):
+        return os.path.relpath(img_path, self.images_dir)
+
+    def _n_rows(self):
+        try:
+            return os.path.getsize(self.path) // self.row_bytes
+        except OSError:
+            return 0
+
+    def _open_data(self, mode):
+        """Maps the data file as an N x 3 x H x W uint8 array."""
+        import numpy as np
+
+        n_rows = self._n_rows()
+        if n_rows == 0:
+            return np.empty((0,) + self.row_shape, dtype=np.uint8)
+        return np.memmap(self.path, dtype=np.uint8, mode=mode, shape=(n_rows,) + self.row_shape)
+
+    def _entries(self, keys):
+        """Returns {filename: (row, size, mtime_ns)} for the given filenames."""
+        entries = {}
+        for start in range(0, len(keys), _SQL_CHUNK):
+            chunk = keys[start:start + _SQL_CHUNK]
+            query = "SELECT filename, row, size, mtime_ns FROM entries WHERE filename IN ({})".format(
+                ",".join("?" * len(chunk)))
+            for filename, row, size, mtime_ns in self._conn.execute(query, chunk):
+                entries[filename] = (row, size, mtime_ns)
+        return entries
+
+    def update(self, img_paths, prune=False, workers=4):
+        """
+        Decodes the images that are not cached yet, or changed since they were.
+
+        Args:
+            img_paths (list): Paths to the images in images_dir
+            prune (bool): Also forget cached files not in img_paths and reuse
+                          their rows; only for a complete listing of the
+                          folder (default: False)
+            workers (int): Threads decoding images (default: 4)
+
+        Returns:
+            int: Number of images decoded
+        """
+        import torch
+
+        keys = [self._key(img_path) for img_path in img_paths]
+        stats = [os.stat(img_path) for img_path in img_paths]
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            entries = self._entries(keys)
+
+            # New rows are handed out in img_paths order, so a folder cached
+            # in one go is sliced in contiguous batches later
+            free_rows = [row for (row,) in self._conn.execute("SELECT row FROM free_rows ORDER BY row")]
+            if prune:
+                listed = set(keys)
+                for filename, row in self._conn.execute("SELECT filename, row FROM entries").fetchall():
+                    if filename not in listed:
+                        self._conn.execute("DELETE FROM entries WHERE filename = ?", (filename,))
+                        free_rows.append(row)
+                free_rows.sort()
+
+            # Rows past the end of the data file (if it was removed) are stale
+            file_rows = n_rows = self._n_rows()
+            decoded = 0
+            stale = []
+            for img_path, key, stat in zip(img_paths, keys, stats):
+                entry = entries.get(key)
+                if (entry is not None and entry[0] < file_rows
+                        and entry[1:] == (stat.st_size, stat.st_mtime_ns)):
+                    self.reused += 1
+                    continue
+                if entry is not None:
+                    row = entry[0]
+                    n_rows = max(n_rows, row + 1)
+                elif free_rows:
+                    row = free_rows.pop(0)
+                else:
+                    row = n_rows
+                    n_rows += 1
+                stale.append((img_path, key, stat, row))
+
+            if stale:
+                with open(self.path, 'ab') as f:
+                    f.truncate(n_rows * self.row_bytes)
+                data = self._open_data('r+')
+
+                def decode(item):
+                    img_path, _, _, row = item
+                    self.preprocessor.load_pixels(img_path, torch.from_numpy(data[row]))
+
+                # Unreadable images are left out of the index and fail later
+                # with the usual error when they are classified
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                    failed = [future.exception() is not None
+                              for future in [executor.submit(decode, item) for item in stale]]
+                data.flush()
+                del data
+
+                for (_, key, stat, row), error in zip(stale, failed):
+                    if error:
+                        self._conn.execute("DELETE FROM entries WHERE filename = ?", (key,))
+                        free_rows.append(row)
+                        continue
+                    self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                       (key, row, stat.st_size, stat.st_mtime_ns))
+                    decoded += 1
+
+            self._conn.execute("DELETE FROM free_rows")
+            self._conn.executemany("INSERT INTO free_rows VALUES (?)", [(row,) for row in free_rows])
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        self.decoded += decoded
+        return decoded
+
+    def rows(self, img_paths):
+        """
+        Looks up the cached row of each image.
+
+        Args:
+            img_paths (list): Paths to the images in images_dir
+
+        Returns:
+            list: Row per image, or None where the image is not cached or has
+                  changed since it was
+        """
+        entries = self._entries([self._key(img_path) for img_path in img_paths])
+        n_rows = self._n_rows()
+        rows = []
+        for img_path in img_paths:
+            entry = entries.get(self._key(img_path))
+            if entry is not None:
+                stat = os.stat(img_path)
+                if entry[1:] != (stat.st_size, stat.st_mtime_ns) or entry[0] >= n_rows:
+                    entry = None
+            rows.append(None if entry is None else entry[0])
+        return rows
+
+    def iter_batches(self, img_paths, batch_size=32):
+        """
+        Yields normalized batches like image_pipeline.iter_batches, reading
+        cached pixels from the memory map and decoding only images that are
+        not cached.
+
+        Runs of consecutive rows are sliced from the map without copying and
+        normalized in one operation. The batch tensor is reused, so a
+        yielded batch is only valid until the next one is requested.
+
+        Args:
+            img_paths (list): Paths to the images in images_dir
+            batch_size (int): Number of images per batch
+
+        Yields:
+            tuple: (indices, batch) where indices lists the positions in
+                   img_paths of the images in the NxCxHxW tensor batch
+        """
+        import torch
+
+        rows = self.rows(img_paths)
+        # Copy-on-write mapping: writable for torch, never written back
+        data = self._open_data('c')
+        batch_size = max(1, min(batch_size, len(img_paths)))
+        buffer = self.preprocessor.new_batch(batch_size)
+
+        for start in range(0, len(img_paths), batch_size):
+            indices = list(range(start, min(start + batch_size, len(img_paths))))
+            batch_rows = rows[start:start + len(indices)]
+            out = buffer[:len(indices)]
+
+            first = batch_rows[0]
+            if first is not None and batch_rows == list(range(first, first + len(indices))):
+                self.preprocessor.normalize(torch.from_numpy(data[first:first + len(indices)]), out)
+            else:
+                for row_index, row in enumerate(batch_rows):
+                    if row is None:
+                        self.preprocessor(img_paths[start + row_index], out[row_index])
+                    else:
+                        self.preprocessor.normalize(torch.from_numpy(data[row]), out[row_index])
+
+            yield indices, out
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        """Closes the index."""
+        self._conn.close()
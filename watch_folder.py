@@ -0,0 +1,334 @@
+"""
+Module for keeping the results of an intake folder up to date.
+This module remembers, in a SQLite manifest, the size, modification time and
+results of every classified file together with the running statistics
+counts. Each refresh scans the folder, classifies only the files that were
+added or modified since the last one, and adjusts the counts by the
+difference, so a refresh costs a directory listing plus the work on the
+changed files instead of a full run.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+from adjust_results4_isadog import adjust_results4_isadog
+from classifier import preprocess_config
+from get_pet_labels import iter_pet_labels
+from model_registry import model_version
+from stats_accumulator import StatsAccumulator
+
+
+DEFAULT_MANIFEST_FILE = '.watch_manifest.sqlite'
+
+# Files modified more recently than this may still be being written, so
+# they wait for the next refresh
+_SETTLE_NS = 1_000_000_000
+
+
+def watch_settings(models, weights, options, dogfile, cascade=None):
+    """
+    Describes what the results in a manifest depend on; a manifest made
+    with other settings is cleared and every file classified again.
+
+    Args:
+        models (list): Architectures (or the cascade's name) being reported
+        weights (dict): Local weights file per architecture, or None entries
+        options (ExecutionOptions): Precision and optimizations of the models
+        dogfile (str): Text file of dog names
+        cascade (Cascade): The cascade classifying the images, or None
+
+    Returns:
+        str: The settings, as JSON
+    """
+    architectures = cascade.models if cascade is not None else models
+    dog_stat = os.stat(dogfile)
+    return json.dumps({
+        'models': list(models),
+        'versions': [model_version(model, weights.get(model), options)
+                     for model in architectures],
+        'preprocess': preprocess_config(),
+        'cascade': [cascade.threshold, cascade.dog_margin] if cascade is not None else None,
+        'dogfile': [os.path.abspath(dogfile), dog_stat.st_size, dog_stat.st_mtime_ns],
+    }, sort_keys=True)
+
+
+class Manifest:
+    """
+    Classified files and running statistics of a watched folder, on disk.
+
+    Attributes:
+        models (list): Architectures the results are kept for
+        stats (dict): StatsAccumulator of every classified file, keyed by
+                      architecture
+        reset (bool): True when an existing manifest was cleared because it
+                      was made with other settings
+    """
+
+    def __init__(self, path, models, settings):
+        """
+        Opens (creating if needed) the manifest file.
+
+        Args:
+            path (str): Path to the SQLite manifest file
+            models (list): Architectures the results are kept for
+            settings (str): Output of watch_settings for this run
+        """
+        self.models = list(models)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " filename TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, results TEXT)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        stored = dict(self._conn.execute("SELECT key, value FROM meta"))
+        self.reset = 'settings' in stored and stored['settings'] != settings
+        if stored.get('settings') != settings:
+            self._conn.execute("DELETE FROM files")
+            stored = {'settings': settings, 'stats': '{}'}
+            self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", stored.items())
+        self._conn.commit()
+
+        counts = json.loads(stored['stats'])
+        self.stats = {model: StatsAccumulator(counts.get(model)) for model in self.models}
+
+    def file_stats(self):
+        """
+        Returns:
+            dict: (size, mtime_ns) of every classified file, keyed by filename
+        """
+        return {filename: (size, mtime_ns) for filename, size, mtime_ns
+                in self._conn.execute("SELECT filename, size, mtime_ns FROM files")}
+
+    def results(self, filenames):
+        """
+        Reads the stored results of some files.
+
+        Args:
+            filenames (list): Filenames to look up
+
+        Returns:
+            dict: {filename: {model: [pet_label, classifier_label, match,
+                  pet_is_dog, classifier_is_dog]}} for the files found
+        """
+        found = {}
+        for filename in filenames:
+            row = self._conn.execute(
+                "SELECT results FROM files WHERE filename = ?", (filename,)).fetchone()
+            if row is not None:
+                found[filename] = json.loads(row[0])
+        return found
+
+    def apply(self, updated, deleted):
+        """
+        Records new results and forgets deleted files, moving the statistics
+        counts by the difference, in one transaction.
+
+        Args:
+            updated (dict): {filename: (size, mtime_ns, {model: results})}
+                            for added and modified files
+            deleted (list): Filenames no longer in the folder
+        """
+        # The previous results of replaced and deleted files are taken back
+        for results in self.results(list(updated) + list(deleted)).values():
+            for model in self.models:
+                self.stats[model].remove(results[model])
+        for _, _, results in updated.values():
+            for model in self.models:
+                self.stats[model].update(results[model])
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [(filename, size, mtime_ns, json.dumps(results))
+                 for filename, (size, mtime_ns, results) in updated.items()])
+            self._conn.executemany("DELETE FROM files WHERE filename = ?",
+                                   [(filename,) for filename in deleted])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('stats', ?)",
+                (json.dumps({model: accumulator.to_dict()
+                             for model, accumulator in self.stats.items()}),))
+
+    def close(self):
+        """Closes the manifest file."""
+        self._conn.close()
+
+
+def scan_folder(images_dir, recursive=False):
+    """
+    Lists the images of a folder with their size and modification time.
+
+    Args:
+        images_dir (str): Folder of pet images
+        recursive (bool): Also scan subfolders (default: False)
+
+    Returns:
+        dict: {filename: (pet_label, size, mtime_ns)}
+    """
+    files = {}
+    for filename, pet_label in iter_pet_labels(images_dir, recursive):
+        try:
+            stat = os.stat(os.path.join(images_dir, filename))
+        except FileNotFoundError:
+            # Deleted while the folder was being listed
+            continue
+        files[filename] = (pet_label, stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class FolderWatcher:
+    """
+    Classifies the images added to or changed in a folder since the last
+    refresh and keeps a Manifest of the results.
+
+    Attributes:
+        manifest (Manifest): Where the results and counts are kept
+        failed (dict): (size, mtime_ns) of files that could not be read,
+                       retried only once they change
+    """
+
+    def __init__(self, images_dir, manifest, classify, dogfile, recursive=False):
+        """
+        Args:
+            images_dir (str): Folder of pet images
+            manifest (Manifest): Results of the files classified earlier
+            classify (callable): Takes a list of (filename, pet_label) pairs
+                                 and yields (filename, results, predictions)
+                                 like classify_images.classify_images_stream
+            dogfile (str): Text file of dog names
+            recursive (bool): Also watch subfolders (default: False)
+        """
+        self.images_dir = images_dir
+        self.manifest = manifest
+        self.classify = classify
+        self.dogfile = dogfile
+        self.recursive = recursive
+        self.failed = {}
+        self._known = manifest.file_stats()
+
+    def refresh(self):
+        """
+        Scans the folder once and brings the manifest up to date.
+
+        Returns:
+            dict: Numbers of 'added', 'modified', 'deleted', 'failed' and
+                  'pending' (still being written) files, and the total
+                  'images' now recorded
+        """
+        scanned = scan_folder(self.images_dir, self.recursive)
+        settled_before = time.time_ns() - _SETTLE_NS
+
+        changed = []
+        counts = dict.fromkeys(('added', 'modified', 'deleted', 'failed', 'pending'), 0)
+        for filename, (pet_label, size, mtime_ns) in scanned.items():
+            stat = (size, mtime_ns)
+            if self._known.get(filename) == stat or self.failed.get(filename) == stat:
+                continue
+            if mtime_ns > settled_before:
+                counts['pending'] += 1
+                continue
+            changed.append((filename, pet_label))
+        deleted = [filename for filename in self._known if filename not in scanned]
+        counts['deleted'] = len(deleted)
+        for filename in list(self.failed):
+            if filename not in scanned:
+                del self.failed[filename]
+
+        results = self._classify(changed)
+        updated = {}
+        for filename, _ in changed:
+            stat = scanned[filename][1:]
+            if filename in results:
+                counts['modified' if filename in self._known else 'added'] += 1
+                updated[filename] = stat + (results[filename],)
+                self.failed.pop(filename, None)
+            else:
+                counts['failed'] += 1
+                self.failed[filename] = stat
+                # The old results of a file that became unreadable are dropped
+                if filename in self._known:
+                    deleted.append(filename)
+        self.manifest.apply(updated, deleted)
+
+        for filename in deleted:
+            del self._known[filename]
+        for filename, (size, mtime_ns, _) in updated.items():
+            self._known[filename] = (size, mtime_ns)
+        counts['images'] = len(self._known)
+        return counts
+
+    def _classify(self, labeled_files):
+        """
+        Classifies files and adds the dog checks.
+
+        A batch stops at the first unreadable image (e.g. one deleted or
+        truncated after the scan), so the files are then retried one by one
+        and the unreadable ones left out.
+
+        Returns:
+            dict: {filename: {model: [pet_label, classifier_label, match,
+                  pet_is_dog, classifier_is_dog]}}
+        """
+        if not labeled_files:
+            return {}
+        try:
+            classified = list(self.classify(labeled_files))
+        except OSError:
+            classified = []
+            for labeled_file in labeled_files:
+                try:
+                    classified.extend(self.classify([labeled_file]))
+                except OSError as e:
+                    print("Warning: skipping {}: {}".format(labeled_file[0], e))
+
+        results = {filename: {} for filename, _, _ in classified}
+        for model in self.manifest.models:
+            results_dic = {filename: list(model_results[model])
+                           for filename, model_results, _ in classified}
+            adjust_results4_isadog(results_dic, self.dogfile,
+                                   {filename: predictions[model][0][0]
+                                    for filename, _, predictions in classified})
+            for filename, values in results_dic.items():
+                results[filename][model] = values
+        return results
+
+
+def format_refresh(counts, seconds):
+    """
+    Describes one refresh, e.g.
+    '[14:02:11] 3 added, 1 modified, 0 deleted in 0.42 s; 120 images'.
+
+    Args:
+        counts (dict): Output of FolderWatcher.refresh
+        seconds (float): Time the refresh took
+
+    Returns:
+        str: The summary line
+    """
+    line = "[{}] {} added, {} modified, {} deleted in {:.2f} s; {} images".format(
+        time.strftime('%H:%M:%S'), counts['added'], counts['modified'], counts['deleted'],
+        seconds, counts['images'])
+    if counts['pending']:
+        line += ", {} still being written".format(counts['pending'])
+    if counts['failed']:
+        line += ", {} unreadable".format(counts['failed'])
+    return line
+
+
+def format_watch_stats(model, results_stats):
+    """
+    Summarizes the running statistics of one architecture on one line.
+
+    Args:
+        model (str): Architecture name
+        results_stats (dict): Statistics, as from calculates_results_stats
+
+    Returns:
+        str: The summary line
+    """
+    return ("  {}: {:.1f}% match, {:.1f}% dogs, {:.1f}% breeds, {:.1f}% not dogs "
+            "correct").format(model, results_stats['pct_match'], results_stats['pct_correct_dogs'],
+                              results_stats['pct_correct_breed'],
+                              results_stats['pct_correct_notdogs'])